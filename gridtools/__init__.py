@@ -1,6 +1,6 @@
 
-__all__ = ["app", "bathyutils", "fileutils", "datasource", "gridutils",
-        "meshrefinement", "sanity", "spherical",
+__all__ = ["app", "bathyutils", "coordutils", "fileutils", "datasource", "gridutils",
+        "meshkernels", "meshrefinement", "sanity", "spherical",
         "sysinfo", "topoutils", "utils"]
 
 # Copied from sphinx/src/sphinx/__init__.py
@@ -25,6 +25,8 @@ import holoviews as hv
 import geoviews as gv
 gv.extension('bokeh')
 
+from . import utils
+
 # This is called by GridTools() and can't be
 # called by itself.
 
@@ -144,6 +146,7 @@ class App(object):
     def downloadNetCDF(self):
         # See if we have a race condition
         self.saveLocalGridButton.filename = self.gridFilenameLocal.value
+        utils.resolveHashes(self.grd.grid)
         bout = self.grd.grid.to_netcdf(encoding=self.grd.removeFillValueAttributes())
         bio = BytesIO()
         bio.write(bout)
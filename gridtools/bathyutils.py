@@ -3,12 +3,65 @@
 #  - https://github.com/nikizadehgfdl/ocean_model_topog_generator
 #    - compute_bathymetric_roughness_h2(**opts)
 
-import os, hashlib, logging
+import os, logging, tempfile
+import concurrent.futures
 import numpy as np
 import xarray as xr
 import pdb
 
+from . import coordutils
+from . import meshkernels
 from . import meshrefinement
+from . import utils
+
+# Classes
+
+class BlockLog(object):
+    '''Stand-in for the grid object when a block is processed in a worker
+    process.  Messages sent to printMsg() are collected so they can be
+    replayed to the real grid object by the parent process in block order.
+    '''
+
+    def __init__(self):
+        self.msgs = []
+
+    def printMsg(self, msg, level=logging.INFO):
+        self.msgs.append((msg, level))
+
+    def replay(self, grd):
+        for (msg, level) in self.msgs:
+            grd.printMsg(msg, level=level)
+
+class SharedArray(object):
+    '''Picklable handle to a read only copy of an array that is shared with
+    worker processes.  The array is copied once into a memory mapped numpy
+    file (in /dev/shm when available) and each worker memory maps it
+    instead of receiving a pickled copy of the data.  The file is the only
+    extra copy, /dev/shm must have room for the array.
+    '''
+
+    def __init__(self, data):
+        shmDir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fd, self.filename = tempfile.mkstemp(prefix='gridtools_', suffix='.npy', dir=shmDir)
+        os.close(fd)
+        data = np.asarray(data)
+        try:
+            shared = np.lib.format.open_memmap(self.filename, mode='w+', dtype=data.dtype, shape=data.shape)
+            shared[...] = data
+            shared.flush()
+            del shared
+        except:
+            self.unlink()
+            raise
+
+    def open(self):
+        '''Returns the shared array as a read only memory map.'''
+        return np.load(self.filename, mmap_mode='r')
+
+    def unlink(self):
+        '''Remove the shared copy.  Only the creating process should call this.'''
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
 
 # Functions
 
@@ -157,7 +210,7 @@ def applyExistingLandmask(grd, dsData, dsVariable, maskFile, maskVariable, **kwa
             grd.printMsg(msg, level=logging.INFO)
 
     # Update hash for the new grid
-    workData['newDepth'].attrs['sha256'] = hashlib.sha256( np.array( workData['newDepth'] ) ).hexdigest()
+    utils.hashVariable( workData['newDepth'] )
 
     return workData['newDepth']
 
@@ -311,7 +364,7 @@ def applyExistingOceanmask(grd, dsData, dsVariable, maskFile, maskVariable, **kw
             grd.printMsg(msg, level=logging.INFO)
 
     # Update hash for the new grid
-    workData['newDepth'].attrs['sha256'] = hashlib.sha256( np.array( workData['newDepth'] ) ).hexdigest()
+    utils.hashVariable( workData['newDepth'] )
 
     return workData['newDepth']
 
@@ -319,60 +372,47 @@ def applyExistingOceanmask(grd, dsData, dsVariable, maskFile, maskVariable, **kw
 # Original functions from create_topog_refinedSampling.py
 
 def break_array_to_blocks(a, xb=4, yb=1, useSupergrid=False):
+    """Break a 2D array of mesh nodes into yb rows by xb columns of blocks.
+    The blocks are returned in row major order.
+
+    Neighbouring blocks share one row and column of nodes.  The last
+    row and column of each block only receive partial values from
+    do_block() and are dropped again by undo_break_array_to_blocks(),
+    which removes the seams between blocks.  This applies to both the
+    supergrid and the q-point overlap (useSupergrid=False) layouts."""
+    jEdges = coordutils.block_edges(a.shape[0]-1, yb)
+    iEdges = coordutils.block_edges(a.shape[1]-1, xb)
     a_win = []
-    # TODO: xb==8 or other values are not completely supported
-    if ((xb == 4 or xb == 8) and yb == 1):
-        i1 = a.shape[1]//xb
-        i2 = 2*i1
-        i3 = 3*i1
-        i4 = a.shape[1]
-
-        j1 = a.shape[0]//yb
-
-        # If we are not using the super grid, we want to overlap
-        # the blocks to get rid of a zero band between the blocks
-        if not(useSupergrid):
-            a_win.append(a[0:j1,0:i1+1])
-            a_win.append(a[0:j1,i1:i2+1])
-            a_win.append(a[0:j1,i2:i3+1])
-            a_win.append(a[0:j1,i3:i4])
-        else:
-            a_win.append(a[0:j1,0:i1])
-            a_win.append(a[0:j1,i1:i2])
-            a_win.append(a[0:j1,i2:i3])
-            a_win.append(a[0:j1,i3:i4])
+    for jb in range(0, yb):
+        for ib in range(0, xb):
+            a_win.append(a[jEdges[jb]:jEdges[jb+1]+1, iEdges[ib]:iEdges[ib+1]+1])
 
-        return a_win
-    else:
-        raise Exception('This routine can only make 2x2 blocks!')
-        ##Niki: Implement a better algo and lift this restriction
+    return a_win
 
 def undo_break_array_to_blocks(a, xb=4, yb=1, useSupergrid=False):
-    if (xb == 4 and yb == 1):
-        if not(useSupergrid):
-            ao = np.append(a[0][:,:-1], a[1], axis=1)
-            ao = np.append(ao[:,:-1]  , a[2], axis=1)
-            ao = np.append(ao[:,:-1]  , a[3], axis=1)
-            # Trim y+1,x and y,x+1
-            ao = ao[:-1,:-1]
-            #pdb.set_trace()
-        else:
-            ao = np.append(a[0], a[1], axis=1)
-            ao = np.append(ao  , a[2], axis=1)
-            ao = np.append(ao  , a[3], axis=1)
-        return ao
-    elif (xb == 8 and yb == 1):
-        ao = np.append(a[0], a[1], axis=1)
-        ao = np.append(ao  , a[2], axis=1)
-        ao = np.append(ao  , a[3], axis=1)
-        ao = np.append(ao  , a[4], axis=1)
-        ao = np.append(ao  , a[5], axis=1)
-        ao = np.append(ao  , a[6], axis=1)
-        ao = np.append(ao  , a[7], axis=1)
-        return ao
-    else:
-        raise Exception('This routine can only make 2x2 blocks!')
-        ##TODO: Implement a better algorithm and lift this restriction
+    """Stitch a row major list of blocks created by break_array_to_blocks()
+    back into a single array.  The shared row and column of each block is
+    taken from the following block.  With useSupergrid=False the q-point
+    overlap column and row are also removed so the result is on the
+    h-point grid."""
+    rows = []
+    for jb in range(0, yb):
+        row = []
+        for ib in range(0, xb):
+            blk = a[jb*xb + ib]
+            if jb < yb-1:
+                blk = blk[:-1,:]
+            if ib < xb-1:
+                blk = blk[:,:-1]
+            row.append(blk)
+        rows.append(np.concatenate(row, axis=1))
+    ao = np.concatenate(rows, axis=0)
+
+    if not(useSupergrid):
+        # Trim y+1,x and y,x+1
+        ao = ao[:-1,:-1]
+
+    return ao
 
 def get_indices1D_old(lon_grid, lat_grid, x, y):
     """This function returns the j,i indices for the grid point closest to the input lon,lat coordinates."""
@@ -394,37 +434,47 @@ def mdist(x1, x2):
 
 def get_indices1D(lon_grid,lat_grid,x,y):
     """This function returns the j,i indices for the grid point closest to the input lon,lat coordinates."""
-    """It returns the j,i indices."""
-#    lons=np.fabs(lon_grid-x)
-    lons=np.fabs(mdist(lon_grid,x))
-    lonm=np.where(lons==lons.min())
-    lats=np.fabs(lat_grid-y)
-    latm=np.where(lats==lats.min())
-    j0=latm[0][0]
-    i0=lonm[0][0]
-    print(" wanted: %f %f" % (x,y))
-    print(" got:    %f %f" % (lon_grid[i0] , lat_grid[j0]))
-    good = False
-    if(abs(x-lon_grid[i0]) < abs(lon_grid[1]-lon_grid[0])):
-        good = True
-        print("  good")
-    else:
-        print("  bad")
-    print(" j,i=",j0,i0)
+    """It returns the j,i indices and whether the longitude is within one grid step.
+    The grids may be given as coordutils.CoordinateIndex to look up several points."""
+    if not(isinstance(lon_grid, coordutils.CoordinateIndex)):
+        lon_grid = coordutils.CoordinateIndex(np.asarray(lon_grid), periodic=True)
+    if not(isinstance(lat_grid, coordutils.CoordinateIndex)):
+        lat_grid = coordutils.CoordinateIndex(np.asarray(lat_grid))
+    j0=lat_grid.nearest(y)
+    i0=lon_grid.nearest(x)
+    lons=lon_grid.values
+    good = abs(x-lons[i0]) < abs(lons[1]-lons[0])
     return j0,i0,good
 
+def rectilinear_axes(lon_grid, lat_grid):
+    """Returns the longitude and latitude axes of a 2D grid as coordutils.CoordinateIndex
+    if the grid is rectilinear, longitudes constant along columns and latitudes along rows,
+    and None otherwise."""
+    lon_grid=np.asarray(lon_grid)
+    lat_grid=np.asarray(lat_grid)
+    if np.all(lon_grid == lon_grid[0:1,:]) and np.all(lat_grid == lat_grid[:,0:1]):
+        return coordutils.CoordinateIndex(lon_grid[0,:]),coordutils.CoordinateIndex(lat_grid[:,0])
+    return None
+
 def get_indices2D(lon_grid, lat_grid, x, y):
     """This function returns the j,i indices for the grid point closest to the input lon,lat coordinates."""
-    """It returns the j,i indices."""
+    """It returns the j,i indices.
+    The axes of a rectilinear grid may be given as coordutils.CoordinateIndex to look up several
+    points without checking the grid on each call, see rectilinear_axes()."""
+    if isinstance(lon_grid, coordutils.CoordinateIndex) and isinstance(lat_grid, coordutils.CoordinateIndex):
+        return lat_grid.nearest(y),lon_grid.nearest(x)
+    lon_grid=np.asarray(lon_grid)
+    lat_grid=np.asarray(lat_grid)
+    axes=rectilinear_axes(lon_grid, lat_grid)
+    if axes is not None:
+        # Rectilinear grid, look up the 1D axes
+        return get_indices2D(axes[0], axes[1], x, y)
     lons=np.fabs(lon_grid-x)
     lonm=np.where(lons==lons.min())
     lats=np.fabs(lat_grid-y)
     latm=np.where(lats==lats.min())
     j0=latm[0][0]
     i0=lonm[1][0]
-#    print("wanted: ",x,y)
-#    print("got:    ",lon_grid[j0,i0] , lat_grid[j0,i0])
-#    print(j0,i0)
     return j0,i0
 #Gibraltar
 #wanted:  32.0 -12.5
@@ -448,8 +498,292 @@ def extend_by_zeros(x, shape):
     ext[:x.shape[0],:x.shape[1]] = x
     return ext
 
+def plane_fit_roughness(Glist):
+    '''Returns the roughness on the coarsest mesh of Glist.  The finest
+    mesh of Glist holds the sampled source data and the coarser meshes the
+    moments coarsened from it.'''
+    #Roughness calculation by plane fitting
+    #Calculate the slopes of the planes on the coarsest (model) grid cells
+    G = Glist[0]
+    denom = (G.xxm-G.xm*G.xm)*(G.yym-G.ym*G.ym)-(G.xym-G.xm*G.ym)*(G.xym-G.xm*G.ym)
+    alphd = (G.xzm-G.xm*G.zm)*(G.yym-G.ym*G.ym)-(G.yzm-G.ym*G.zm)*(G.xym-G.xm*G.ym)
+    betad = (G.yzm-G.ym*G.zm)*(G.xxm-G.xm*G.xm)-(G.xzm-G.xm*G.zm)*(G.xym-G.xm*G.ym)
+    #alph = alphd/denom
+    #beta = betad/denom
+
+    rf = 2**(len(Glist)-1) #refinement factor
+    #Generate the refined arrays from coarse arrays by repeating the coarse elements rf times
+    #These arrays have the same values on finest mesh points inside each coarse cell by construction.
+    #They are being used to calculate the (least-square) distance of data points
+    #inside that cell from the fitted plane in that cell.
+    xmrf = refine_by_repeat(G.xm, rf)
+    ymrf = refine_by_repeat(G.ym, rf)
+    zmrf = refine_by_repeat(G.zm, rf)
+    alphdrf = refine_by_repeat(alphd, rf)
+    betadrf = refine_by_repeat(betad, rf)
+    denomrf = refine_by_repeat(denom, rf)
+    #The refined mesh has a shape of (2*nj-1,2*ni-1) rather than (2*nj,2*ni) and hence
+    #is missing the last row/column by construction!
+    #So, the finest mesh does not have (rf*nj,rf*ni) points but is smaller by ...
+    #Bring it to the same shape as (rf*nj,rf*ni) by padding with zeros.
+    #This is for algorithm convenience and we remove the contribution of them later.
+    xs = extend_by_zeros(Glist[-1].xm, zmrf.shape)
+    ys = extend_by_zeros(Glist[-1].ym, zmrf.shape)
+    zs = extend_by_zeros(Glist[-1].zm, zmrf.shape)
+    #Calculate the vertical distance D of each source point from the least-square plane
+    #Note that the least-square plane passes through the mean data point.
+    #The last rf rows and columns are for padding and denom is not zero on them.
+    #To avoid division by zero calculate denom*D instead
+    D_times_denom = denomrf*(zs-zmrf) - alphdrf*(xs-xmrf) - betadrf*(ys-ymrf)
+    #Calculate topography roughness as the standard deviation of D on each coarse (model) grid cell
+    #This is why we wanted to have a (nj*rf,ni*rf) shape arrays and padded with zeros above.
+    D_times_denom_coarse = np.reshape(D_times_denom,(G.xm.shape[0],rf,G.xm.shape[1],rf))
+    D_times_denom_coarse_std = D_times_denom_coarse.std(axis=(1,3))
+    D_std = np.zeros(G.zm.shape)
+    epsilon = 1.0e-20 #To avoid negative underflow
+    D_std[:,:] = D_times_denom_coarse_std[:,:]/(denom[:,:]+epsilon)
+    # Don't forget to chop off the zeros added before
+    #D_std = D_std[:-1,:-1]
+    #pdb.set_trace()
+
+    #print("")
+    #print("Writing ...")
+    #filename = 'topog_refsamp_BP.nc'+str(b)
+    #write_topog(Glist[0].height,fnam=filename,no_changing_meta=True)
+    #print("heights shape:", lons[b].shape,Hlist[b].shape)
+
+    return D_std
+
+def row_bands(nj, rows):
+    '''Returns the (j0, j1) node rows of bands of at most rows cells that
+    cover a mesh with nj rows of nodes.  Each band includes node row j1,
+    the first node row of the next band.'''
+    return [(j0, min(j0+rows, nj-1)) for j0 in range(0, max(nj-1, 1), rows)]
+
+def estimate_band(ni, rows, levels):
+    '''Returns the estimated memory in Mb for stream_block() to refine a
+    band of rows by ni cells levels times.  See plan_blocks().'''
+    rf = 2**levels
+    nFinest = (rf*rows+1)*(rf*ni+1)
+    nLevels = sum([(2**k*rows+1)*(2**k*ni+1) for k in range(0, levels)])
+    return 8*(PLAN_FINEST_ARRAYS*nFinest + PLAN_LEVEL_ARRAYS*nLevels)/1024/1024
+
+def refine_band(target_mesh, j0, j1, levels, workspace=None):
+    '''Returns the list of meshes refining node rows j0 to j1 of
+    target_mesh levels times.  The refinement is local so the meshes are
+    the same rows of the meshes refine_loop() makes for target_mesh.
+    The scratch arrays of workspace, a meshrefinement.Workspace, are
+    reused from band to band.'''
+    Glist = [meshrefinement.MeshRefinement(lon=target_mesh.lon[j0:j1+1,:], lat=target_mesh.lat[j0:j1+1,:],
+        kernels=target_mesh.kernels)]
+    for k in range(0, levels):
+        Glist.append(Glist[-1].refineby2(workspace=workspace))
+    return Glist
+
+def stream_hits(target_mesh, levels, max_mb, coverage, workspace=None):
+    '''Records the source cells hit by target_mesh refined levels times
+    as a new stage of coverage, a meshrefinement.SourceCoverage.  Returns
+    the number of cells hit.  The refined mesh is made and dropped band by
+    band.'''
+    nj, ni = target_mesh.lon.shape
+    rows = max(1, int(max_mb/estimate_band(ni-1, 1, levels)))
+    coverage.new_stage()
+    for (j0, j1) in row_bands(nj, rows):
+        coverage.add_mesh(refine_band(target_mesh, j0, j1, levels, workspace=workspace)[-1])
+    return coverage.nhits
+
+def stream_block(grd, target_mesh, source, topo_elv, max_mb=500, max_stages=32):
+    '''Streaming version of the refinement in do_block().
+
+    The number of refinements is found as in refine_loop().  The mesh is
+    then refined, sampled and coarsened band by band of target rows and the
+    results of each band are folded into the target arrays.  Only the
+    target arrays and one band of refined meshes are held at a time.
+    Bands are sized so that one band fits in max_mb.  Refinement stops
+    when a single target row no longer fits.  The results are the same as
+    do_block() when do_block() is not limited by max_mb.
+    '''
+    msg = ("Refining the target in bands to hit all source points ...")
+    grd.printMsg(msg, level=logging.INFO)
+    nj, ni = target_mesh.lon.shape
+
+    # Find the number of refinements, see refine_loop()
+    coverage = meshrefinement.SourceCoverage(source)
+    workspace = meshrefinement.Workspace()
+    levels = 0
+    nhits, prev_hits = stream_hits(target_mesh, levels, max_mb, coverage, workspace), 0
+    msg = ("Refinement %d hit %d out of %d cells" % (levels, nhits, coverage.size))
+    grd.printMsg(msg, level=logging.INFO)
+    converged = coverage.all() or (nhits==prev_hits)
+    while(not converged and levels+1<max_stages and estimate_band(ni-1, 1, levels+1)<max_mb):
+        nhits, prev_hits = stream_hits(target_mesh, levels+1, max_mb, coverage, workspace), nhits
+        converged = coverage.all() or (nhits<=prev_hits)
+        if nhits>prev_hits:
+            levels = levels + 1
+            msg = ("Refinement %d hit %d out of %d cells" % (levels, nhits, coverage.size))
+            grd.printMsg(msg, level=logging.INFO)
+    if not converged:
+        msg = ("Maximum number of allowed refinements reached without all source cells hit.")
+        grd.printMsg(msg, level=logging.WARNING)
+
+    # Sample, coarsen and fit planes band by band
+    rows = max(1, int(max_mb/estimate_band(ni-1, 1, levels)))
+    bands = row_bands(nj, rows)
+    msg = ("Sampling and coarsening %d bands of up to %d rows ..." % (len(bands), rows))
+    grd.printMsg(msg, level=logging.INFO)
+    height = np.zeros((nj, ni))
+    D_std = np.zeros((nj, ni))
+    h_min = np.zeros((nj, ni))
+    h_max = np.zeros((nj, ni))
+    # The hits of the final refinement are recorded as the bands are made
+    coverage.new_stage()
+    for (j0, j1) in bands:
+        Glist = refine_band(target_mesh, j0, j1, levels, workspace=workspace)
+        coverage.add_mesh(Glist[-1])
+        Glist[-1].compact()
+        Glist[-1].sample_source_data_on_target_mesh(source, None, topo_elv)
+        for i in reversed(range(1,len(Glist))):
+            Glist[i].coarsenby2(Glist[i-1])
+        bandStd = plane_fit_roughness(Glist)
+        # The shared node row j1 belongs to the next band unless this is the last band
+        n = j1-j0 if j1 < nj-1 else j1-j0+1
+        height[j0:j0+n,:] = Glist[0].height[:n,:]
+        D_std[j0:j0+n,:] = bandStd[:n,:]
+        h_min[j0:j0+n,:] = Glist[0].h_min[:n,:]
+        h_max[j0:j0+n,:] = Glist[0].h_max[:n,:]
+        del Glist
+    hits = coverage.hits()
+    msg = ("Non-hit ratio: %d%s%d" % (hits.size-hits.sum().astype(int)," / ",hits.size))
+    grd.printMsg(msg, level=logging.INFO)
+
+    return height, D_std, h_min, h_max, hits
+
+def estimate_bin_band(cells, ni, rows):
+    '''Returns the estimated memory in Mb for bin_block() to bin a band
+    of rows of ni source points into a mesh of cells.  See plan_blocks().'''
+    return 8*(PLAN_BIN_CELL_ARRAYS*cells + PLAN_BIN_POINT_ARRAYS*rows*ni)/1024/1024
+
+def bin_block(grd, target_mesh, source, topo_elv, max_mb=500):
+    '''Direct binning version of the sampling in do_block().
+
+    Each source point of a uniform source is placed in the target cell
+    that contains it and the statistics of each cell are computed by
+    grouped reductions over its source points: the mean height, the
+    minimum and maximum and the standard deviation of the distance of the
+    points from their least-square plane.  Every source point in a target
+    cell is used once, so there is no refinement.  Source points in no
+    target cell, such as those of the window outside the block, are the
+    non-hits.
+
+    The source is binned in bands of rows sized to fit max_mb.  The sums
+    of each band are accumulated about the nearest source point of each
+    cell, so the moments do not lose precision to large coordinates.
+
+    Values are returned on the nodes of the target mesh as in do_block(),
+    node (j,i) holding the values of cell (j,i).  The last row and column
+    of nodes and cells without source points take the nearest source value.
+    '''
+    msg = ("Binning the source points into target cells ...")
+    grd.printMsg(msg, level=logging.INFO)
+    nj, ni = target_mesh.shape
+    snj, sni = source.shape
+
+    # Nearest source value at each node for cells without source points
+    ti,tj = target_mesh.find_nn_uniform_source(source)
+    zNodes = np.asarray(topo_elv)[tj,ti]
+    height = zNodes.copy()
+    h_min = zNodes.copy()
+    h_max = zNodes.copy()
+    D_std = np.zeros(zNodes.shape)
+
+    # Origin of the sums of each cell
+    lon = np.asarray(source.lon, dtype=np.float64)
+    lat = np.asarray(source.lat, dtype=np.float64)
+    x0 = lon[ti[:-1,:-1].ravel()]
+    y0 = lat[tj[:-1,:-1].ravel()]
+    z0 = np.asarray(zNodes[:-1,:-1].ravel(), dtype=np.float64)
+
+    # Sums over the points of each cell, accumulated band by band
+    sums = np.zeros((10, nj*ni))
+    zmin = np.full(nj*ni, np.inf)
+    zmax = np.full(nj*ni, -np.inf)
+    rows = max(2, int((max_mb - estimate_bin_band(nj*ni, sni, 0))/estimate_bin_band(0, sni, 1)))
+    nBands = -(-snj // rows)
+    if nBands > 1:
+        msg = ("Binning in %d bands of %d source rows" % (nBands, rows))
+        grd.printMsg(msg, level=logging.INFO)
+    # The source points in target cells are the hits
+    hits = np.zeros((snj, sni), dtype=np.uint8)
+    search = target_mesh.cell_search()
+    nPoints = 0
+    for j0 in range(0, snj, rows):
+        j1 = min(j0 + rows, snj)
+        # Target cell of each source point of the band
+        cj, ci = target_mesh.find_cells(source.window(slice(j0, j1), slice(None)), search=search)
+        inCell = (cj >= 0)
+        hits[j0:j1] = inCell
+        if not(inCell.any()):
+            continue
+        jj, ii = np.nonzero(inCell)
+        cell = (cj*ni + ci)[inCell]
+        x = lon[ii] - x0[cell]
+        y = lat[jj + j0] - y0[cell]
+        zs = np.asarray(topo_elv[j0:j1], dtype=np.float64)[inCell]
+        z = zs - z0[cell]
+        nPoints = nPoints + cell.size
+        sums[0] += np.bincount(cell, minlength=nj*ni)
+        for (k, w) in enumerate([x, y, z, x*x, y*y, x*y, x*z, y*z, z*z]):
+            sums[k+1] += np.bincount(cell, weights=w, minlength=nj*ni)
+
+        # Minimum and maximum by reductions over the points sorted by cell
+        order = np.argsort(cell, kind='stable')
+        cell = cell[order]
+        starts = np.flatnonzero(np.diff(cell, prepend=-1))
+        zs = zs[order]
+        zmin[cell[starts]] = np.minimum(zmin[cell[starts]], np.minimum.reduceat(zs, starts))
+        zmax[cell[starts]] = np.maximum(zmax[cell[starts]], np.maximum.reduceat(zs, starts))
+    msg = ("Source points in target cells: %d%s%d" % (nPoints," / ",snj*sni))
+    grd.printMsg(msg, level=logging.INFO)
+
+    # Means, then second moments about the means of each cell
+    n = sums[0]
+    used = n > 0
+    nn = np.where(used, n, 1.0)
+    xm, ym, zm = sums[1]/nn, sums[2]/nn, sums[3]/nn
+    sxx = sums[4]/nn - xm*xm
+    syy = sums[5]/nn - ym*ym
+    sxy = sums[6]/nn - xm*ym
+    sxz = sums[7]/nn - xm*zm
+    syz = sums[8]/nn - ym*zm
+    szz = sums[9]/nn - zm*zm
+    zm = zm + z0
+
+    # Variance of the residuals from the least-square plane.  Where the
+    # points of a cell lie on a line, fit a line along that direction.
+    denom = sxx*syy - sxy*sxy
+    plane = denom > 1.0e-12*sxx*syy
+    safe = np.where(plane, denom, 1.0)
+    alph = (sxz*syy - syz*sxy)/safe
+    beta = (syz*sxx - sxz*sxy)/safe
+    var = np.where(plane, szz - alph*sxz - beta*syz,
+        np.where(sxx > 0, szz - sxz*sxz/np.where(sxx > 0, sxx, 1.0),
+        np.where(syy > 0, szz - syz*syz/np.where(syy > 0, syy, 1.0), szz)))
+    std = np.sqrt(np.maximum(var, 0.0))
+
+    # Fill the cells that have source points
+    used = used.reshape((nj, ni))
+    height[:-1,:-1] = np.where(used, zm.reshape((nj, ni)), height[:-1,:-1])
+    h_min[:-1,:-1] = np.where(used, zmin.reshape((nj, ni)), h_min[:-1,:-1])
+    h_max[:-1,:-1] = np.where(used, zmax.reshape((nj, ni)), h_max[:-1,:-1])
+    D_std[:-1,:-1] = np.where(used, std.reshape((nj, ni)), 0.0)
+
+    msg = ("Non-hit ratio: %d%s%d" % (hits.size-nPoints," / ",hits.size))
+    grd.printMsg(msg, level=logging.INFO)
+
+    return height, D_std, h_min, h_max, hits
+
 # Copied with slight modifications
-def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500):
+def do_block(grd, part, lon, lat, source, topo_elvs, max_mb=500, engine='refine', kernels=None):
     msg = ("Doing block number %d" % (part))
     grd.printMsg(msg, level=logging.INFO)
     msg = ("Target sub mesh shape: %s" % (str(lon.shape)))
@@ -457,7 +791,7 @@ def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500):
 
     #target_mesh = GMesh.GMesh( lon=lon, lat=lat )
     #target_mesh = GMesh.GMesh(lon=lon, lat=lat)
-    target_mesh = meshrefinement.MeshRefinement(lon=lon, lat=lat)
+    target_mesh = meshrefinement.MeshRefinement(lon=lon, lat=lat, kernels=kernels)
     #target_mesh.shape = lon.shape
     #target_mesh.ni = target_mesh.shape[0]
     #target_mesh.nj = target_mesh.shape[1]
@@ -467,24 +801,26 @@ def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500):
     #plot()
 
     # Indices in topographic data
-    ti,tj = target_mesh.find_nn_uniform_source(topo_lons, topo_lats)
+    ti,tj = target_mesh.find_nn_uniform_source(source)
 
     #Sample every other source points
     ##Niki: This is only for efficeincy and we want to remove the constraint for the final product.
     ##Niki: But in some cases it may not work!
     #tis,tjs = slice(ti.min(), ti.max()+1,2), slice(tj.min(), tj.max()+1,2)
     #tis,tjs = slice(ti.min(), ti.max()+1,1), slice(tj.min(), tj.max()+1,1)
-    tis,tjs = slice(ti.min().data.tolist(), ti.max().data.tolist()+1,1),\
-        slice(tj.min().data.tolist(), tj.max().data.tolist()+1,1)
+    tis,tjs = slice(int(ti.min()), int(ti.max())+1,1),\
+        slice(int(tj.min()), int(tj.max())+1,1)
     #print('  Slices j,i:', tjs, tis )
     msg = ('Topographic grid slice: %s %s' % (str(tjs), str(tis)))
     grd.printMsg(msg, level=logging.INFO)
 
-    # Read elevation data
-    topo_elv = topo_elvs[tjs,tis]
-    # Extract appropriate coordinates
-    topo_lon = topo_lons[tis]
-    topo_lat = topo_lats[tjs]
+    # Read elevation data for this block only.  source.lon is a
+    # PeriodicLongitude view that maps tis to the source columns.
+    topo_elv = source.lon.read(topo_elvs, tjs, tis)
+    # Describe the window of the source used by this block
+    window = source.window(tjs, tis)
+    topo_lon = window.lon
+    topo_lat = window.lat
 
     msg = ('Topo shape: %s' % (str(topo_elv.shape)))
     grd.printMsg(msg, level=logging.INFO)
@@ -502,19 +838,24 @@ def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500):
     msg = ("Target     latitude  range: %f %f" % (lat.min(), lat.max()))
     grd.printMsg(msg, level=logging.INFO)
 
+    if engine == 'stream':
+        return stream_block(grd, target_mesh, window, topo_elv, max_mb=max_mb)
+    if engine == 'binning':
+        return bin_block(grd, target_mesh, window, topo_elv, max_mb=max_mb)
+
     # Refine grid by 2 till all source points are hit
     msg = ("Refining the target to hit all source points ...")
     grd.printMsg(msg, level=logging.INFO)
     #pdb.set_trace()
-    Glist = target_mesh.refine_loop(topo_lon, topo_lat, max_mb=max_mb);
-    hits = Glist[-1].source_hits(topo_lon, topo_lat)
+    Glist = target_mesh.refine_loop(window, max_mb=max_mb);
+    hits = Glist[-1].source_hits(window)
     msg = ("Non-hit ratio: %d%s%d" % (hits.size-hits.sum().astype(int)," / ",hits.size))
     grd.printMsg(msg, level=logging.INFO)
 
     # Sample the topography on the refined grid
     msg = ("Sampling the source points on target mesh ...")
     grd.printMsg(msg, level=logging.INFO)
-    Glist[-1].sample_source_data_on_target_mesh(topo_lon, topo_lat, topo_elv)
+    Glist[-1].sample_source_data_on_target_mesh(window, None, topo_elv)
     msg = ("Sampling finished ...")
     grd.printMsg(msg, level=logging.INFO)
 
@@ -528,57 +869,239 @@ def do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=500):
 
     msg = ("Roughness calculation via plane fit")
     grd.printMsg(msg, level=logging.INFO)
-    #Roughness calculation by plane fitting
-    #Calculate the slopes of the planes on the coarsest (model) grid cells
-    G = Glist[0]
-    denom = (G.xxm-G.xm*G.xm)*(G.yym-G.ym*G.ym)-(G.xym-G.xm*G.ym)*(G.xym-G.xm*G.ym)
-    alphd = (G.xzm-G.xm*G.zm)*(G.yym-G.ym*G.ym)-(G.yzm-G.ym*G.zm)*(G.xym-G.xm*G.ym)
-    betad = (G.yzm-G.ym*G.zm)*(G.xxm-G.xm*G.xm)-(G.xzm-G.xm*G.zm)*(G.xym-G.xm*G.ym)
-    #alph = alphd/denom
-    #beta = betad/denom
-
-    rf = 2**(len(Glist)-1) #refinement factor
-    #Generate the refined arrays from coarse arrays by repeating the coarse elements rf times
-    #These arrays have the same values on finest mesh points inside each coarse cell by construction.
-    #They are being used to calculate the (least-square) distance of data points
-    #inside that cell from the fitted plane in that cell.
-    xmrf = refine_by_repeat(G.xm, rf)
-    ymrf = refine_by_repeat(G.ym, rf)
-    zmrf = refine_by_repeat(G.zm, rf)
-    alphdrf = refine_by_repeat(alphd, rf)
-    betadrf = refine_by_repeat(betad, rf)
-    denomrf = refine_by_repeat(denom, rf)
-    #The refined mesh has a shape of (2*nj-1,2*ni-1) rather than (2*nj,2*ni) and hence
-    #is missing the last row/column by construction!
-    #So, the finest mesh does not have (rf*nj,rf*ni) points but is smaller by ...
-    #Bring it to the same shape as (rf*nj,rf*ni) by padding with zeros.
-    #This is for algorithm convenience and we remove the contribution of them later.
-    xs = extend_by_zeros(Glist[-1].xm, zmrf.shape)
-    ys = extend_by_zeros(Glist[-1].ym, zmrf.shape)
-    zs = extend_by_zeros(Glist[-1].zm, zmrf.shape)
-    #Calculate the vertical distance D of each source point from the least-square plane
-    #Note that the least-square plane passes through the mean data point.
-    #The last rf rows and columns are for padding and denom is not zero on them.
-    #To avoid division by zero calculate denom*D instead
-    D_times_denom = denomrf*(zs-zmrf) - alphdrf*(xs-xmrf) - betadrf*(ys-ymrf)
-    #Calculate topography roughness as the standard deviation of D on each coarse (model) grid cell
-    #This is why we wanted to have a (nj*rf,ni*rf) shape arrays and padded with zeros above.
-    D_times_denom_coarse = np.reshape(D_times_denom,(G.xm.shape[0],rf,G.xm.shape[1],rf))
-    D_times_denom_coarse_std = D_times_denom_coarse.std(axis=(1,3))
-    D_std = np.zeros(G.zm.shape)
-    epsilon = 1.0e-20 #To avoid negative underflow
-    D_std[:,:] = D_times_denom_coarse_std[:,:]/(denom[:,:]+epsilon)
-    # Don't forget to chop off the zeros added before
-    #D_std = D_std[:-1,:-1]
-    #pdb.set_trace()
+    D_std = plane_fit_roughness(Glist)
 
-    #print("")
-    #print("Writing ...")
-    #filename = 'topog_refsamp_BP.nc'+str(b)
-    #write_topog(Glist[0].height,fnam=filename,no_changing_meta=True)
-    #print("heights shape:", lons[b].shape,Hlist[b].shape)
     return Glist[0].height, D_std, Glist[0].h_min, Glist[0].h_max, hits
 
+def do_block_worker(part, lon, lat, source, topo_elvs, max_mb=500, engine='refine', kernels='auto'):
+    '''Process pool entry point for do_block().  The topography is passed
+    as a SharedArray handle or as a data array opened with chunks and messages
+    are returned to the parent process with the block results.  The
+    meshkernels backend of the parent is passed as kernels, the serial
+    kernels are used in workers.
+    '''
+    log = BlockLog()
+    if isinstance(topo_elvs, SharedArray):
+        topo_elvs = topo_elvs.open()
+    result = do_block(log, part, lon, lat, source, topo_elvs, max_mb=max_mb, engine=engine,
+        kernels=meshkernels.Kernels(kernels, parallel=False))
+    return log.msgs, result
+
+def is_lazy(data):
+    '''Returns True if data is an xarray object backed by dask, opened with
+    chunks.  These pickle as a task graph reading the file.  Data without
+    chunks is loaded when its values are taken.'''
+    return isinstance(data, xr.DataArray) and data.chunks is not None
+
+def run_blocks(grd, lons, lats, source, topo_elvs, max_mb=500, workers=None, executor=None, engine='refine', kernels=None):
+    '''Run do_block() for each block and return the results in block order.
+
+    Blocks are run serially unless an executor is supplied or workers is
+    greater than one.  For parallel runs, a topography opened with chunks
+    is passed as is and each worker reads its own window from the file.
+    Topography already in memory is placed in a SharedArray so it is not
+    pickled for every block.  Results and any messages are collected in
+    the same order as a serial run.  kernels is the meshkernels.Kernels
+    of a serial run, workers use the serial kernels of its backend.
+
+    The memory budget max_mb is shared by the blocks that run at once, so
+    each of the workers refines its block within max_mb/workers.  With an
+    executor, workers should be the number of blocks it runs at once.
+    '''
+
+    nBlocks = len(lons)
+    if executor is None and (workers is None or workers <= 1):
+        return [do_block(grd, part, lons[part], lats[part], source, topo_elvs,
+                    max_mb=max_mb, engine=engine, kernels=kernels)
+                for part in range(0, nBlocks)]
+
+    block_mb = max_mb / max(workers or 1, 1)
+
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        msg = ("Computing %d blocks using %d worker processes." % (nBlocks, workers))
+        grd.printMsg(msg, level=logging.INFO)
+    msg = ("RAM allocation to refinements per block (Mb): %f" % (block_mb))
+    grd.printMsg(msg, level=logging.INFO)
+
+    sharedTopo = None
+    if is_lazy(topo_elvs):
+        blockTopo = topo_elvs
+    else:
+        sharedTopo = SharedArray(topo_elvs)
+        blockTopo = sharedTopo
+    try:
+        futures = [executor.submit(do_block_worker, part, lons[part], lats[part],
+                    source, blockTopo, max_mb=block_mb, engine=engine,
+                    kernels=(kernels or meshkernels.DEFAULT).backend)
+                   for part in range(0, nBlocks)]
+        results = []
+        for future in futures:
+            msgs, result = future.result()
+            for (msg, level) in msgs:
+                grd.printMsg(msg, level=level)
+            results.append(result)
+    finally:
+        if ownExecutor:
+            executor.shutdown(wait=True)
+        if sharedTopo:
+            sharedTopo.unlink()
+
+    return results
+
+# Memory model used by plan_blocks().  These are the number of float64
+# arrays the size of a refinement level that do_block() holds at its peak.
+# The finest level holds the coordinates, the sampled heights and moments
+# and the plane fit work arrays.  Each coarser level holds its coordinates
+# and coarsened heights and moments.  A refined level also holds its 3d
+# coordinates until its (lon,lat) are computed.
+PLAN_FINEST_ARRAYS = 29
+PLAN_LEVEL_ARRAYS = 14
+# The source window and the hit mask are held at the source resolution
+PLAN_SOURCE_ARRAYS = 2
+# bin_block() holds the cell corners, edge normals and sums for each target
+# cell and, for each source point of a band, its 3d coordinates, the cell
+# search candidates and edge normals and the deviations from the origin of
+# its cell.  A band has at least two rows.
+PLAN_BIN_CELL_ARRAYS = 64
+PLAN_BIN_POINT_ARRAYS = 72
+
+def estimate_block(lon, lat, dlon, dlat, margin=2, engine='refine'):
+    """Returns the estimated number of refinement stages needed by
+    refine_loop() for every source cell of spacing (dlon, dlat) to be hit
+    by a node of the target mesh (lon, lat) and the estimated peak memory
+    in Mb for do_block().  With engine='binning' there are no refinement
+    stages and the memory is that of bin_block() binning the fewest
+    source rows at a time.
+
+    A mesh hits every source cell once the extent of each of its cells is
+    no larger than a source cell in both directions.  Each stage halves the
+    extent of the cells.  Refined edges follow great circles rather than
+    lines of latitude and nodes on the edge of the source window tie
+    between source cells, so a margin of extra stages is added.
+    """
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    nj, ni = lon.shape[0]-1, lon.shape[1]-1
+    lonSpan = np.ptp(lon)
+    if lonSpan > 180.0:
+        lonSpan = min(lonSpan, np.ptp(np.mod(lon, 360.0)))
+    nSource = (lonSpan/dlon + 2)*(np.ptp(lat)/dlat + 2)
+    if engine == 'binning':
+        return 0, 8*PLAN_SOURCE_ARRAYS*nSource/1024/1024 + estimate_bin_band(nj*ni, lonSpan/dlon + 2, 2)
+
+    dlon_i = mdist(lon[:,1:], lon[:,:-1])
+    dlon_j = mdist(lon[1:,:], lon[:-1,:])
+    dlat_i = np.abs(lat[:,1:] - lat[:,:-1])
+    dlat_j = np.abs(lat[1:,:] - lat[:-1,:])
+    extLon = np.maximum(dlon_i[:-1,:], dlon_i[1:,:]) + np.maximum(dlon_j[:,:-1], dlon_j[:,1:])
+    extLat = np.maximum(dlat_i[:-1,:], dlat_i[1:,:]) + np.maximum(dlat_j[:,:-1], dlat_j[:,1:])
+    ratio = max((extLon/dlon).max(), (extLat/dlat).max())
+    stages = int(np.ceil(np.log2(ratio))) if ratio > 1.0 else 0
+    stages = stages + margin
+
+    return stages, block_mb(nj, ni, stages, nSource)
+
+def block_mb(nj, ni, stages, nSource):
+    """Returns the estimated peak memory in Mb for do_block() to refine a
+    block of (nj, ni) cells by stages against nSource source points."""
+    rf = 2**stages
+    nFinest = (rf*nj+1)*(rf*ni+1)
+    nLevels = sum([(2**k*nj+1)*(2**k*ni+1) for k in range(0, stages)])
+    return 8*(PLAN_FINEST_ARRAYS*nFinest + PLAN_LEVEL_ARRAYS*nLevels + PLAN_SOURCE_ARRAYS*nSource)/1024/1024
+
+def plan_blocks(target_lon, target_lat, topo_lons, topo_lats, max_mb, blocks=None, blockShape=None, workers=None, max_stages=32, margin=2, engine='refine'):
+    """Plan the block decomposition for computeBathymetricRoughness().
+
+    For a given layout (blocks or blockShape) the estimates for that layout
+    are returned.  With blocks='auto' the grid is split into blocks of at
+    most (n, n) cells, with the largest n for which every block can be
+    refined to hit all source cells within the memory budget.  The memory
+    of a block is about in proportion to its cells, so a starting n is
+    computed directly from the estimate for the whole grid and the
+    largest n that fits is then found by bisection.  When blocks run in parallel the
+    budget is shared by the workers.  The memory of the binning engine is
+    estimated for engine='binning', otherwise that of the refine engine.
+    Only the coordinates are used; the source data is not read.
+
+    Returns a dictionary with the layout (blocks), the refinement stages and
+    memory (Mb) for each block, the peak memory of any block, the per block
+    budget and whether the plan fits the budget.
+    """
+    nWorkers = max(workers or 1, 1)
+    budget = max_mb / nWorkers
+    sni, snj = topo_lons.shape[0], topo_lats.shape[0]
+    dlon = abs(float(topo_lons[-1]-topo_lons[0]))/(sni-1)
+    dlat = abs(float(topo_lats[-1]-topo_lats[0]))/(snj-1)
+
+    estimated = {}
+    def estimate_layout(layout):
+        if not(layout in estimated.keys()):
+            yb, xb = layout
+            lons = break_array_to_blocks(target_lon, xb, yb)
+            lats = break_array_to_blocks(target_lat, xb, yb)
+            estimates = [estimate_block(lons[part], lats[part], dlon, dlat, margin=margin, engine=engine) for part in range(0, len(lons))]
+            stages = [est[0] for est in estimates]
+            mb = [est[1] for est in estimates]
+            estimated[layout] = (stages, mb, max(mb) <= budget and max(stages) < max_stages)
+        return estimated[layout]
+
+    autoLayout = isinstance(blocks, str) and blocks == 'auto'
+    if autoLayout:
+        layout = (1, 1)
+    else:
+        layout = coordutils.block_layout(target_lon.shape, blocks=blocks, blockShape=blockShape)
+    stages, mb, fits = estimate_layout(layout)
+
+    if autoLayout and not(fits):
+        # The memory is about in proportion to the cells of a block, size
+        # square blocks from the whole grid and halve them until they fit
+        def square_fits(n):
+            return estimate_layout(coordutils.block_layout(target_lon.shape, blockShape=(n, n)))[2]
+        nj, ni = target_lon.shape[0]-1, target_lon.shape[1]-1
+        hi = max(nj, ni)
+        lo = int(min(max(np.sqrt(nj*ni*budget/max(mb)), 1), hi))
+        while lo > 1 and not(square_fits(lo)):
+            hi, lo = lo, lo//2
+        # Bisect for the largest block that fits: lo fits and hi does not
+        while hi - lo > 1 and square_fits(lo):
+            mid = (lo + hi)//2
+            if square_fits(mid):
+                lo = mid
+            else:
+                hi = mid
+        layout = coordutils.block_layout(target_lon.shape, blockShape=(lo, lo))
+        stages, mb, fits = estimate_layout(layout)
+    yb, xb = layout
+
+    plan = {
+        'blocks': (yb, xb),
+        'stages': stages,
+        'mb': mb,
+        'peakMb': max(mb),
+        'budgetMb': budget,
+        'workers': nWorkers,
+        'fits': fits
+    }
+
+    return plan
+
+def show_plan(grd, plan):
+    """Report a plan from plan_blocks() through the grid message system."""
+    msg = ("Block plan: layout (rows, columns) %d %d; %d blocks; refinement stages %d to %d;"
+           " peak %.1f Mb of %.1f Mb per block" %\
+           (plan['blocks'][0], plan['blocks'][1], len(plan['stages']), min(plan['stages']),
+            max(plan['stages']), plan['peakMb'], plan['budgetMb']))
+    grd.printMsg(msg, level=logging.INFO)
+    for part in range(0, len(plan['stages'])):
+        msg = ("  Block %d: %d stages, %.1f Mb" % (part, plan['stages'][part], plan['mb'][part]))
+        grd.printMsg(msg, level=logging.INFO)
+    if not(plan['fits']):
+        msg = ("WARNING: The block plan does not fit within the memory budget.  Refinements may stop"
+               " before all source points are hit.")
+        grd.printMsg(msg, level=logging.WARNING)
+
 # Rebuilt from main() function
 def computeBathymetricRoughness(grd, dsName, **kwargs):
     '''This generates h2 and other variables and returns an xarray DataSet.
@@ -609,6 +1132,33 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
         * *useFixByOverlapQHGridShift* (``boolean``) --
           When using a regular grid, use overlapping grid technique to fill in partition boundaries.
           See IMPLEMENTATION NOTES below. Default: True
+        * *blocks* (``tuple`` or ``string``) --
+          Number of (rows, columns) of blocks the target grid is partitioned
+          into.  Use 'auto' to choose the layout from the memory budget
+          (maxMb) so that each block can be refined until all source points
+          are hit. Default: (1, 4)
+        * *blockShape* (``tuple``) --
+          Maximum number of (j, i) grid cells per block.  Takes precedence
+          over *blocks*. Default: None
+        * *dryRun* (``boolean``) --
+          If ``True``, only plan the block layout and return the plan (see
+          :py:func:`plan_blocks`) without reading the bathymetry. Default: False
+        * *workers* (``int``) --
+          Number of worker processes used to compute the grid partitions in parallel.
+          Bathymetry already in memory is shared with the workers through a file in
+          /dev/shm, which must have room for a copy of it.  Bathymetry that is not
+          loaded is read by each worker from its source. Default: None (serial)
+        * *executor* (``concurrent.futures.Executor``) --
+          An existing executor to submit the grid partitions to.  This takes
+          precedence over *workers* and is not shut down by this routine.  Set
+          *workers* to the number of partitions it runs at once so they share
+          *maxMb*. Default: None
+        * *engine* (``string``) --
+          Method used to sample the bathymetry on each grid partition.  See
+          IMPLEMENTATION NOTES below. Default: refine
+        * *kernels* (``string``) --
+          Backend of the mesh refinement kernels: 'auto', 'numba' or 'numpy'.
+          See :py:mod:`gridtools.meshkernels`. Default: auto
 
     This routine is based on a paper by Adcroft :cite:p:`Adcroft_2013` and python code from
     `OMtopogen/create_topog_refinedSampling.py` :cite:p:`Zadeh_2020_ocean_model_topog_generator`.
@@ -642,9 +1192,9 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
           the bathymetric roughness.  This will require more RAM. Default: False
 
     IMPLEMENTATION NOTES:
-      * For the supergrid, four zero bands along longitude are returned
-        representing the four grid partitions.  This needs to be fixed
-        in the future.
+      * The target grid is partitioned into blocks that overlap by one
+        row and column of grid points.  Finer blocks reduce the memory
+        needed per block and provide more work for parallel workers.
       * For h-points, h2 is created on the q-points and shifted by 1/2
         a grid cell back to the h-points.  Accuracy of the roughness
         and other resultant variables are off by a 1/2 grid cell.
@@ -653,6 +1203,24 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
         This reduces the available memory footprint available to
         this routine.  This will also reduce the number of available
         refinements against the bathymetry data source.
+      * When running partitions in parallel, maxMb is shared by the
+        worker processes and each refines its partition within
+        maxMb/workers.
+      * engine='refine' holds every refinement of a partition in memory
+        at once.  engine='stream' refines, samples and coarsens each
+        partition in bands of rows sized to fit maxMb, so refinement is
+        only limited by maxMb for a single row of the partition.  Both
+        give the same results when 'refine' is not limited by maxMb.
+      * engine='binning' places every point of a uniform source in the
+        target cell that contains it and computes the cell statistics
+        directly, without refinement.  All source points in the grid are
+        used once.  The non-hits are the source points of each partition's
+        window that fall in none of its cells.  hMin and hMax are the
+        extremes of the source points in each cell rather than of refined
+        sub-cell means.
+      * With kernels='auto' the refinement, sampling and coarsening use
+        compiled kernels if numba is installed.  The results are bitwise
+        identical to the numpy kernels.
     '''
     # Provide defaults if a kwarg is not set
     if not('depthName' in kwargs.keys()):
@@ -673,6 +1241,29 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
         kwargs['maxMb'] = 8000
     max_mb = kwargs['maxMb']
 
+    if not('blocks' in kwargs.keys()):
+        kwargs['blocks'] = None
+    if not('blockShape' in kwargs.keys()):
+        kwargs['blockShape'] = None
+    if not('dryRun' in kwargs.keys()):
+        kwargs['dryRun'] = False
+
+    if not('engine' in kwargs.keys()):
+        kwargs['engine'] = 'refine'
+    if not(kwargs['engine'] in ['refine', 'stream', 'binning']):
+        grd.printMsg("ERROR: Unknown engine (%s)." % (kwargs['engine']), level=logging.ERROR)
+        return None
+
+    if not('kernels' in kwargs.keys()):
+        kwargs['kernels'] = 'auto'
+    if not(kwargs['kernels'] in meshkernels.BACKENDS) or\
+        (kwargs['kernels'] == 'numba' and meshkernels.numba is None):
+        grd.printMsg("ERROR: Kernel backend (%s) is not available." % (kwargs['kernels']), level=logging.ERROR)
+        return None
+
+    workers = kwargs.get('workers', None)
+    executor = kwargs.get('executor', None)
+
     #TODO: Not using the supergrid implies useFixByOverlapQHGridShift
     #if not('useFixByOverlapQHGridShift' in kwargs.keys()):
     #    kwargs['useFixByOverlapQHGridShift'] = True
@@ -684,8 +1275,10 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     if not('gridPoint' in kwargs.keys()):
         kwargs['gridPoint'] = 'h'
 
-    # Attempt to open the selected dataset
-    bathyData = grd.openDataset(dsName)
+    # Attempt to open the selected dataset.  Only the tiles of a tiled
+    # data source near the grid are opened.
+    bbox = coordutils.gridExtent(grd.grid['x'].values, grd.grid['y'].values, margin=1.0)
+    bathyData = grd.openDataset(dsName, bbox=bbox)
     if not(bathyData):
         grd.printMsg("ERROR: The datasource (%s) did not return a usable variable." %\
                 (dsName), level=logging.ERROR)
@@ -707,7 +1300,7 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
 
     # Fix the topography to open some channels
     # Not fully integrated
-    if(kwargs['open_channels']):
+    if(kwargs['open_channels'] and not(kwargs['dryRun'])):
         #Bosporus mouth at Marmara Sea (29.03,41.04)
         j0,i0=15724,39483 #get_indices1D(topo_lons, topo_lats ,29.03, 41.04)
         #One grid cell thick (not survived ice9)
@@ -749,19 +1342,41 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     msg = ("Target mesh shape: %s" % (str(target_lon.shape)))
     grd.printMsg(msg, level=logging.INFO)
 
-    # Not fully understood
-    #   Allows interpolation to work on the grid center say if grid center is near 0 latitude (prime
-    #   meridian) or 180 latitude (dateline)
-    # Translate topo data to start at target_mesh.lon_m[0]
-    # Why/When? TODO: Investigate get_indices1D() function
-    jllc, illc, status1 = get_indices1D(topo_lons, topo_lats ,target_lon[0,0] ,target_lat[0,0])
-    jurc, iurc, status2 = get_indices1D(topo_lons, topo_lats ,target_lon[0,-1],target_lat[-1,0])
+    # Plan the block layout against the memory budget
+    if kwargs['dryRun'] or isinstance(kwargs['blocks'], str):
+        plan = plan_blocks(np.asarray(target_lon), np.asarray(target_lat),
+            np.asarray(topo_lons), np.asarray(topo_lats), max_mb,
+            blocks=kwargs['blocks'], blockShape=kwargs['blockShape'], workers=workers,
+            engine=kwargs['engine'])
+        show_plan(grd, plan)
+        if kwargs['dryRun']:
+            return plan
+        kwargs['blocks'] = plan['blocks']
+        kwargs['blockShape'] = None
+
+    # Find the topo points nearest to the corners of the target grid.  If a
+    # corner is not within one topo step of its nearest point, such as when
+    # the target crosses the seam of the topo longitudes, the topo is viewed
+    # from the lower left corner so the window of each block is contiguous.
+    lonIndex = coordutils.CoordinateIndex(np.asarray(topo_lons), periodic=True)
+    latIndex = coordutils.CoordinateIndex(np.asarray(topo_lats))
+    jllc, illc, status1 = get_indices1D(lonIndex, latIndex ,target_lon[0,0] ,target_lat[0,0])
+    jurc, iurc, status2 = get_indices1D(lonIndex, latIndex ,target_lon[0,-1],target_lat[-1,0])
+    for (j, i, x, y, good) in [(jllc, illc, target_lon[0,0], target_lat[0,0], status1),
+                               (jurc, iurc, target_lon[0,-1], target_lat[-1,0], status2)]:
+        msg = ('Nearest topo point to %f %f is %f %f j,i=%d,%d %s' %
+            (x, y, lonIndex.values[i], latIndex.values[j], j, i, 'good' if good else 'bad'))
+        grd.printMsg(msg, level=logging.DEBUG)
+    # The topo longitudes are viewed through a periodic accessor.  Neither
+    # the longitudes nor the depth data are copied to move the seam, each
+    # block reads its window of depth data through the accessor.
+    lon_shift = 0
     if(not status1 or not status2):
-        msg = ('Shifting topo data to start at target lon.')
+        msg = ('Shifting topo longitudes to start at target lon.')
         grd.printMsg(msg, level=logging.INFO)
-        topo_lons = np.roll(topo_lons,-illc,axis=0) #Roll data longitude to right
-        topo_lons = np.where(topo_lons>=topo_lons[0] , topo_lons-360, topo_lons) #Rename (0,60) as (-300,-180)
-        topo_elvs = np.roll(topo_elvs,-illc,axis=1) #Roll data depth to the right by the same amount.
+        lon_shift = illc
+    #Rotate data longitude to the right and rename (0,60) as (-300,-180)
+    topo_lons = coordutils.PeriodicLongitude(topo_lons, shift=lon_shift)
 
     # TODO: This section needs to be reworked
     msg = ('Topography grid array shapes: lon:%s lat:%s' % (str(topo_lons.shape),str(topo_lats.shape)))
@@ -774,7 +1389,10 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     grd.printMsg(msg, level=logging.INFO)
     #print(' Is mesh uniform?', GMesh.is_mesh_uniform( topo_lons, topo_lats ) )
     #print(' Is mesh uniform?', GMesh.is_mesh_uniform( topo_lons, topo_lats ).data.tolist() )
-    msg = ('Is mesh uniform?', meshrefinement.is_mesh_uniform( topo_lons, topo_lats ).data.tolist() )
+    # Describe the source once, this checks that it is uniform
+    source = meshrefinement.UniformSource(topo_lons, topo_lats)
+    msg = ('Topography source: %s' % (str(source)))
+    grd.printMsg(msg, level=logging.INFO)
     ### Partition the Target grid into non-intersecting blocks
     #This works only if the target mesh is "regular"! Niki: Find the mathematical buzzword for "regular"!!
     #Is this a regular mesh?
@@ -782,29 +1400,39 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     msg = ('RAM allocation to refinements (Mb): %f' % (max_mb))
     grd.printMsg(msg, level=logging.INFO)
 
-    # Rework partitioning (dask opportunity)
-    # Niki: Why 4,1 partition?
-    xb = 4
-    yb = 1
+    # Partition the target mesh into (yb, xb) blocks
+    yb, xb = coordutils.block_layout(target_lon.shape, blocks=kwargs['blocks'], blockShape=kwargs['blockShape'])
+    msg = ('Block layout (rows, columns): %d %d' % (yb, xb))
+    grd.printMsg(msg, level=logging.INFO)
     lons = break_array_to_blocks(target_lon, xb, yb, useSupergrid=useSupergrid)
     lats = break_array_to_blocks(target_lat, xb, yb, useSupergrid=useSupergrid)
 
-    # We must loop over the 4 partitions
+    # We must loop over the partitions
     # TODO: The number of points being collected and the number of hits algorithm does not
     # compute things correctly due to issues with different bounding boxes.  This issue
     # should be addressed with previous section.
+    # Results are returned in block order regardless of how they are computed
+    kernels = meshkernels.Kernels(kwargs['kernels'])
+    msg = ('Mesh kernels: %s' % ('numba' if kernels.enabled() else 'numpy'))
+    grd.printMsg(msg, level=logging.INFO)
+    blockResults = run_blocks(grd, lons, lats, source, topo_elvs,
+        max_mb=max_mb, workers=workers, executor=executor, engine=kwargs['engine'], kernels=kernels)
     Hlist=[]
     Hstdlist=[]
     Hminlist=[]
     Hmaxlist=[]
-    for part in range(0,xb):
-        lon = lons[part]
-        lat = lats[part]
-        h, hstd, hmin, hmax, hits = do_block(grd, part, lon, lat, topo_lons, topo_lats, topo_elvs, max_mb=max_mb)
+    Hitslist=[]
+    for (h, hstd, hmin, hmax, hits) in blockResults:
         Hlist.append(h)
         Hstdlist.append(hstd)
         Hminlist.append(hmin)
         Hmaxlist.append(hmax)
+        Hitslist.append(hits)
+
+    nHits = sum([hits.sum().astype(int) for hits in Hitslist])
+    nCells = sum([hits.size for hits in Hitslist])
+    msg = ("Total non-hit ratio: %d%s%d" % (nCells-nHits, " / ", nCells))
+    grd.printMsg(msg, level=logging.INFO)
 
     msg = ("Merging the blocks ...")
     grd.printMsg(msg, level=logging.INFO)
@@ -837,47 +1465,47 @@ def computeBathymetricRoughness(grd, dsName, **kwargs):
     bathymetricRoughness[h2Name].attrs['units'] = 'meters^2'
     bathymetricRoughness[h2Name].attrs['standard_name'] =\
             'Subgrid scale topography height variance at Arakawa C %s-points' % (kwargs['gridPoint'])
-    bathymetricRoughness[h2Name].attrs['sha256'] = hashlib.sha256( np.array( hstd_refsamp * hstd_refsamp ) ).hexdigest()
+    utils.hashVariable( bathymetricRoughness[h2Name] )
 
     if 'hStd' in kwargs['auxVariables']:
         bathymetricRoughness['hStd'] = (('ny','nx'), hstd_refsamp)
         bathymetricRoughness['hStd'].attrs['units'] = 'meters'
         bathymetricRoughness['hStd'].attrs['standard_name'] =\
                 'Subgrid scale topography height standard deviation at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['hStd'].attrs['sha256'] = hashlib.sha256( np.array( hstd_refsamp ) ).hexdigest()
+        utils.hashVariable( bathymetricRoughness['hStd'] )
 
     if 'hMin' in kwargs['auxVariables']:
         bathymetricRoughness['hMin'] = (('ny','nx'), hmin_refsamp)
         bathymetricRoughness['hMin'].attrs['units'] = 'meters'
         bathymetricRoughness['hMin'].attrs['standard_name'] =\
                 'Subgrid scale topography height standard deviation minimum at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['hMin'].attrs['sha256'] = hashlib.sha256( np.array( hmin_refsamp ) ).hexdigest()
+        utils.hashVariable( bathymetricRoughness['hMin'] )
 
     if 'hMax' in kwargs['auxVariables']:
         bathymetricRoughness['hMax'] = (('ny','nx'), hmax_refsamp)
         bathymetricRoughness['hMax'].attrs['units'] = 'meters'
         bathymetricRoughness['hMax'].attrs['standard_name'] =\
                 'Subgrid scale topography height standard deviation maximum at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['hMax'].attrs['sha256'] = hashlib.sha256( np.array( hmax_refsamp ) ).hexdigest()
+        utils.hashVariable( bathymetricRoughness['hMax'] )
 
     if 'depth' in kwargs['auxVariables']:
         # Do not invert the value here, it is done later!
         bathymetricRoughness['depth'] = (('ny','nx'), height_refsamp)
         bathymetricRoughness['depth'].attrs['units'] = 'meters'
         bathymetricRoughness['depth'].attrs['standard_name'] = 'topographic depth at Arakawa C %s-points' % (kwargs['gridPoint'])
-        bathymetricRoughness['depth'].attrs['sha256'] = hashlib.sha256( np.array( height_refsamp ) ).hexdigest()
+        utils.hashVariable( bathymetricRoughness['depth'] )
 
     # xarray=0.19.0 requires unpacking of Dataset variables by using .data
     bathymetricRoughness['x'] = (('ny','nx'), target_lon.data)
     bathymetricRoughness['x'].attrs['units'] = 'degrees_east'
     bathymetricRoughness['x'].attrs['standard_name'] = 'longitude'
-    bathymetricRoughness['x'].attrs['sha256'] = hashlib.sha256( np.array( target_lon ) ).hexdigest()
+    utils.hashVariable( bathymetricRoughness['x'] )
 
     # xarray=0.19.0 requires unpacking of Dataset variables by using .data
     bathymetricRoughness['y'] = (('ny','nx'), target_lat.data)
     bathymetricRoughness['y'].attrs['units'] = 'degrees_north'
     bathymetricRoughness['y'].attrs['standard_name'] = 'latitude'
-    bathymetricRoughness['y'].attrs['sha256'] = hashlib.sha256( np.array( target_lat ) ).hexdigest()
+    utils.hashVariable( bathymetricRoughness['y'] )
 
     # Return finished dataset
     return bathymetricRoughness
@@ -0,0 +1,287 @@
+# Coordinate utility functions
+'''
+Coordinate utility functions shared by the bathymetry, mesh refinement
+and topography regridding routines.
+'''
+
+import numpy as np
+
+class PeriodicLongitude(object):
+    '''
+    Periodic view of a longitude axis.  The view moves the seam of a
+    longitude axis without making a shifted copy of the axis or of any
+    data on it.  Values are computed from the original array only for the
+    positions that are requested.
+
+    There are two ways to move the seam:
+
+        * *shift* (``integer``) -- rotate a 1D longitude axis so that
+          column *shift* of the original axis becomes column 0.  Longitudes
+          at or past the original value at *shift* are moved down by
+          *period* so the rotated axis is increasing.  This is the same as
+          ``np.roll(lon, -shift)`` followed by
+          ``np.where(lon >= lon[0], lon - period, lon)``.
+        * *lonMin* (``float``) -- re-base longitudes of any shape to the
+          range (lonMin, lonMin + period] without changing their order.
+          For lonMin=-180.0 this is the same as
+          ``np.where(lon > 180., lon - 360., lon)``.
+
+    Data on the original axis is read in the rotated frame with
+    :py:meth:`read`.  Windows that wrap around the end of the original
+    axis are read as two sub-windows that are joined.
+    '''
+
+    def __init__(self, lon, shift=0, lonMin=None, period=360.):
+        self.lon = np.asarray(lon)
+        self.period = period
+        self.lonMin = lonMin
+        self.shift = 0
+        self.seam = None
+        if lonMin is not None:
+            self.seam = lonMin + period
+        elif shift:
+            if self.lon.ndim != 1:
+                raise Exception("PeriodicLongitude: a shifted longitude axis must be 1D")
+            self.shift = int(shift) % self.lon.shape[0]
+            self.seam = self.lon[self.shift]
+
+    @property
+    def shape(self):
+        return self.lon.shape
+
+    @property
+    def ndim(self):
+        return self.lon.ndim
+
+    @property
+    def dtype(self):
+        return self.lon.dtype
+
+    @property
+    def size(self):
+        return self.lon.size
+
+    @property
+    def T(self):
+        if self.shift:
+            return self
+        return PeriodicLongitude(self.lon.T, lonMin=self.lonMin, period=self.period)
+
+    @property
+    def values(self):
+        '''Returns the longitudes of the view as an array.  This is the
+        original array when the view does not move the seam.'''
+        return self[...]
+
+    def __len__(self):
+        return self.lon.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.values
+        return self.values.astype(dtype)
+
+    def __repr__(self):
+        return "<PeriodicLongitude shape:%s shift:%d lonMin:%s>" % (str(self.shape), self.shift, str(self.lonMin))
+
+    def wrap(self, lon):
+        '''Move longitudes past the seam down by one period.'''
+        if self.seam is None:
+            return lon
+        if self.lonMin is not None:
+            # Longitudes already in range are returned without a copy
+            past = lon > self.seam
+            if not(np.any(past)):
+                return lon
+            return np.where(past, lon - self.period, lon)
+        return np.where(lon >= self.seam, lon - self.period, lon)
+
+    def index(self, k):
+        '''Returns the positions in the original axis of positions k in
+        the rotated axis.'''
+        return (np.asarray(k) + self.shift) % self.lon.shape[0]
+
+    def __getitem__(self, key):
+        if not(self.shift):
+            return self.wrap(self.lon[key])
+        n = self.lon.shape[0]
+        if isinstance(key, slice) or key is Ellipsis:
+            k = np.arange(n)[key]
+        else:
+            k = np.asarray(key)
+            k = np.where(k < 0, k + n, k)
+        return self.wrap(self.lon[self.index(k)])
+
+    def min(self):
+        return self.values.min()
+
+    def max(self):
+        return self.values.max()
+
+    def read(self, data, jslice, islice):
+        '''Read the window data[jslice, islice] where islice is a step 1
+        slice of positions in the rotated axis.  The last dimension of
+        data must be on the original longitude axis.  Only the window is
+        read from lazily loaded (netCDF/HDF5) data.'''
+        if not(self.shift):
+            return np.asarray(data[jslice, islice])
+        ni = data.shape[-1]
+        i0, i1, step = islice.indices(ni)
+        nw = i1 - i0
+        i0 = (i0 + self.shift) % ni
+        if i0 + nw <= ni:
+            return np.asarray(data[jslice, i0:i0+nw])
+        return np.concatenate((np.asarray(data[jslice, i0:ni]),
+            np.asarray(data[jslice, 0:i0+nw-ni])), axis=-1)
+
+def gridExtent(lon, lat, margin=0.):
+    '''
+    Returns the box [lonMin, latMin, lonMax, latMax] covering the points
+    (lon, lat) extended by margin degrees.  The longitudes of the box are
+    the shortest periodic range covering the points, so a grid across the
+    seam of its longitudes, such as 170 to -170, gives 170 to 190 and not
+    the whole globe.  lonMax may be larger than 180 and the box covers all
+    longitudes when lonMax - lonMin is 360.
+    '''
+    lon = np.unique(np.mod(np.asarray(lon, dtype=np.float64).ravel(), 360.))
+    lat = np.asarray(lat, dtype=np.float64)
+    latMin = max(float(np.nanmin(lat)) - margin, -90.)
+    latMax = min(float(np.nanmax(lat)) + margin, 90.)
+    lon = lon[np.isfinite(lon)]
+    # The box starts past the largest gap between the longitudes
+    gaps = np.diff(np.append(lon, lon[0] + 360.))
+    k = int(np.argmax(gaps))
+    lonMin = float(lon[(k + 1) % lon.size])
+    lonMax = lonMin + 360. - float(gaps[k])
+    if lonMin > 180.:
+        lonMin, lonMax = lonMin - 360., lonMax - 360.
+    if lonMax - lonMin + 2.*margin >= 360.:
+        return [lonMin, latMin, lonMin + 360., latMax]
+    return [lonMin - margin, latMin, lonMax + margin, latMax]
+
+def block_edges(n, nb):
+    '''Returns nb+1 indices splitting n cells into nb contiguous runs
+    that differ in length by at most one cell.'''
+    return [(k*n)//nb for k in range(0, nb+1)]
+
+def block_layout(shape, blocks=None, blockShape=None):
+    '''Returns the (nby, nbx) block layout for a mesh of nodes with the given
+    shape.  The layout is either given directly by blocks=(nby, nbx) or
+    derived from a maximum number of cells per block with blockShape=(nj, ni).
+    The default layout is one row of four blocks.'''
+    nj, ni = shape[0]-1, shape[1]-1
+    if blockShape is not None:
+        nby = -(-nj // max(blockShape[0], 1))
+        nbx = -(-ni // max(blockShape[1], 1))
+    elif blocks is not None:
+        nby, nbx = blocks
+    else:
+        nby, nbx = 1, 4
+    # Each block must have at least one cell in each direction
+    nby = min(max(nby, 1), max(nj, 1))
+    nbx = min(max(nbx, 1), max(ni, 1))
+    return nby, nbx
+
+class CoordinateIndex(object):
+    '''
+    Nearest point lookups on a 1D coordinate axis.
+
+    The axis is examined once when the index is made.  Lookups then take
+    O(1) time on a uniform axis and O(log n) time with ``np.searchsorted``
+    on any other axis, instead of a scan of the whole axis per point.
+    Decreasing axes and axes that are not monotonic, such as a longitude
+    axis with its seam moved, are looked up through a sorted copy.
+
+    The closest one or two points found are checked against their
+    neighbors with the same distance as a full scan, so :py:meth:`nearest`
+    returns the same index as ``np.abs(values - x).argmin()``, including
+    the first index when two points are as close.  For a *periodic* axis
+    the distance is taken modulo *period*.  A periodic axis that covers a
+    period or more, such as one holding both -180 and 180, is looked up on
+    its points wrapped into one period.  A point that repeats another one
+    a period away is dropped and the first index of the two is returned.
+    '''
+
+    def __init__(self, values, periodic=False, period=360.):
+        self.values = np.asarray(values)
+        if self.values.ndim != 1:
+            raise Exception("CoordinateIndex: the coordinate axis must be 1D")
+        self.periodic = periodic
+        self.period = period
+        values = self.values
+        # Indexes of the points kept from an axis covering a period or more,
+        # np.unique keeps the first index of repeated points
+        self.keep = None
+        if periodic and values.shape[0] > 1 and np.ptp(values) >= period:
+            first = np.min(values)
+            values, self.keep = np.unique(first + np.mod(values - first, period), return_index=True)
+        n = values.shape[0]
+        delta = np.diff(values)
+        if np.all(delta > 0):
+            self.order = None
+        elif np.all(delta < 0):
+            self.order = np.arange(n - 1, -1, -1)
+        else:
+            self.order = np.argsort(values, kind='stable')
+        self.sorted = values if self.order is None else values[self.order]
+        self.step = None
+        if n > 1:
+            step = (self.sorted[-1] - self.sorted[0]) / (n - 1)
+            if step > 0 and np.allclose(np.diff(self.sorted), step, rtol=1e-6, atol=0.):
+                self.step = step
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def __repr__(self):
+        return "<CoordinateIndex size:%d uniform:%s periodic:%s>" % (len(self), self.step is not None, self.periodic)
+
+    def distance(self, a, x):
+        '''Returns the distance between coordinates a and x.'''
+        if self.periodic:
+            return np.minimum(np.mod(a - x, self.period), np.mod(x - a, self.period))
+        return np.abs(a - x)
+
+    def position(self, x):
+        '''Returns the insertion positions of x in the sorted axis.'''
+        s0, n = self.sorted[0], self.sorted.shape[0]
+        if self.periodic:
+            x = s0 + np.mod(x - s0, self.period)
+        if self.step is None:
+            return np.searchsorted(self.sorted, x)
+        with np.errstate(invalid='ignore'):
+            k = np.floor((x - s0) / self.step) + 1
+        return np.clip(np.nan_to_num(k), 0, n).astype(np.intp)
+
+    def nearest(self, x):
+        '''Returns the index of the point of the axis nearest to each x.'''
+        x = np.asarray(x)
+        n = self.sorted.shape[0]
+        if n < 2:
+            flat = x.reshape(-1)
+            idx = np.array([self.distance(self.values, v).argmin() for v in flat], dtype=np.intp)
+            return idx.reshape(x.shape) if x.ndim else int(idx[0])
+        k = self.position(x)
+        # Neighbors of the insertion position, a uniform position can be
+        # off by one from round-off.  The ends are neighbors across the
+        # seam of a periodic axis.
+        offsets = [-2, -1, 0, 1] if self.step is not None else [-1, 0]
+        candidates = [np.clip(k + o, 0, n - 1) for o in offsets]
+        if self.periodic:
+            candidates += [np.zeros_like(k), np.full_like(k, n - 1)]
+        best = best_d = None
+        for c in candidates:
+            if self.order is not None:
+                c = self.order[c]
+            if self.keep is not None:
+                c = self.keep[c]
+            d = self.distance(self.values[c], x)
+            if best is None:
+                best, best_d = c, d
+                continue
+            better = (d < best_d) | ((d == best_d) & (c < best))
+            best = np.where(better, c, best)
+            best_d = np.where(better, d, best_d)
+        # As argmin, a NaN is nearest to the first point
+        best = np.where(np.isnan(x), 0, best)
+        return best if x.ndim else int(best)
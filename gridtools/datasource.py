@@ -1,6 +1,8 @@
 # This package will manage data sources
 
-import os, json, yaml
+import os, re, ast, json, yaml, operator, threading, collections
+import numpy as np
+import xarray as xr
 import pdb
 
 class DataSource(object):
@@ -14,6 +16,9 @@ class DataSource(object):
         #       'dimMap': dict()
         #       'xRef': None,
         #       'xArgs': None,
+        #       'tiles': [{'url': '', 'bbox': [lonMin, latMin, lonMax, latMax]}, ...],
+        #       'tileIndex': '',
+        #       'overviews': [{'factor': 2, 'url': ''}, ...],
         #     }
         self.catalog = dict()
         self._default_catalogEntry = {
@@ -21,8 +26,13 @@ class DataSource(object):
                 'variableMap': None,
                 'dimensionMap': None,
                 'xRef': None,
-                'xArgs': None
+                'xArgs': None,
+                'tiles': None,
+                'tileIndex': None,
+                'overviews': None
             }
+        # Tile indexes read from files: {path: (mtime, tiles)}
+        self._tileIndexes = dict()
 
     def addDataSource(self, newDataSource, delete=False):
         '''Add a new dataset to the catalog.  This will not delete an
@@ -37,7 +47,7 @@ class DataSource(object):
                 # Skip existing keys when delete is False
                 continue
             dsMap = newDataSource[dsKey]
-            self.catalog[dsKey] = self._default_catalogEntry
+            self.catalog[dsKey] = dict(self._default_catalogEntry)
             for mapKey in dsMap.keys():
                 self.catalog[dsKey][mapKey] = dsMap[mapKey]
 
@@ -100,7 +110,7 @@ class DataSource(object):
                     entriesAdded = entriesAdded + 1
 
             if updateKey:
-                self.catalog[catKeyNew] = self._default_catalogEntry
+                self.catalog[catKeyNew] = dict(self._default_catalogEntry)
                 for refKey in newCatalogEntries[catKeyNew].keys():
                     self.catalog[catKeyNew][refKey] = newCatalogEntries[catKeyNew][refKey]
 
@@ -108,6 +118,108 @@ class DataSource(object):
 
         return
 
+    def isTiled(self, dsObj):
+        '''Returns True if a catalog entry is a tiled data source.'''
+        return bool(dsObj.get('tiles', None) or dsObj.get('tileIndex', None))
+
+    def getTiles(self, dsObj):
+        '''Returns the tiles of a tiled catalog entry: a list of
+        {'url': url, 'bbox': [lonMin, latMin, lonMax, latMax]}.  The tiles
+        are listed in the entry under 'tiles' or in a JSON index file named
+        by 'tileIndex', see :py:meth:`writeTileIndex`.  Relative tile paths
+        in an index are relative to the index file.  Index files are only
+        read again when they change.
+        '''
+        if dsObj.get('tiles', None):
+            return dsObj['tiles']
+        indexFile = dsObj['tileIndex']
+        if indexFile.startswith('file:'):
+            indexFile = indexFile[5:]
+        mtime = os.stat(indexFile).st_mtime_ns
+        if not(indexFile in self._tileIndexes) or self._tileIndexes[indexFile][0] != mtime:
+            with open(indexFile, 'r') as infd:
+                tiles = json.load(infd)
+            if isinstance(tiles, dict):
+                tiles = tiles['tiles']
+            indexDir = os.path.dirname(os.path.abspath(indexFile))
+            for tile in tiles:
+                url = tile['url'][5:] if tile['url'].startswith('file:') else tile['url']
+                if not('://' in url) and not(os.path.isabs(url)):
+                    tile['url'] = os.path.join(indexDir, url)
+            self._tileIndexes[indexFile] = (mtime, tiles)
+        return self._tileIndexes[indexFile][1]
+
+    @staticmethod
+    def intersects(bbox, tileBbox):
+        '''Returns True if two [lonMin, latMin, lonMax, latMax] boxes
+        intersect.  Longitudes are periodic.'''
+        if tileBbox[1] > bbox[3] or tileBbox[3] < bbox[1]:
+            return False
+        if bbox[2] - bbox[0] >= 360.:
+            return True
+        for shift in [-360., 0., 360.]:
+            if tileBbox[0] + shift <= bbox[2] and tileBbox[2] + shift >= bbox[0]:
+                return True
+        return False
+
+    @staticmethod
+    def selectTiles(tiles, bbox=None):
+        '''Returns the tiles intersecting bbox, all tiles if bbox is None.
+        Tiles are mosaicked along their own longitudes.  When the tiles of
+        bbox would leave a gap in longitude, as for a box across the seam of
+        the tile longitudes, all tiles of the latitudes of bbox are returned
+        so the mosaic is continuous.'''
+        if bbox is None:
+            return list(tiles)
+        selected = [tile for tile in tiles if DataSource.intersects(bbox, tile['bbox'])]
+        lonRanges = sorted(set([(tile['bbox'][0], tile['bbox'][2]) for tile in selected]))
+        for k in range(1, len(lonRanges)):
+            if lonRanges[k][0] > max([lonRange[1] for lonRange in lonRanges[:k]]) + 1.e-6:
+                band = [bbox[0], bbox[1], bbox[0] + 360., bbox[3]]
+                return [tile for tile in tiles if DataSource.intersects(band, tile['bbox'])]
+        return selected
+
+    def writeTileIndex(self, urls, indexFile, lonName='lon', latName='lat'):
+        '''Writes a JSON tile index for the files or urls of a tiled data
+        source.  The box of each tile is the extent of its cells, the
+        extent of the cell centers lonName and latName extended by half a
+        cell.  Returns the tiles.'''
+        tiles = list()
+        for url in urls:
+            path = url[5:] if url.startswith('file:') else url
+            dsData = xr.open_dataset(path)
+            lon = dsData[lonName].values
+            lat = dsData[latName].values
+            dsData.close()
+            dlon = abs(lon[1] - lon[0]) if lon.size > 1 else 0.
+            dlat = abs(lat[1] - lat[0]) if lat.size > 1 else 0.
+            bbox = [float(lon.min() - 0.5*dlon), float(lat.min() - 0.5*dlat),
+                    float(lon.max() + 0.5*dlon), float(lat.max() + 0.5*dlat)]
+            tiles.append({'url': url, 'bbox': bbox})
+        with open(indexFile, 'w') as outfd:
+            json.dump({'tiles': tiles}, outfd, indent=2)
+        return tiles
+
+    def getOverviews(self, dsObj):
+        '''Returns the overviews of a catalog entry, a list of
+        {'factor': factor, 'url': url} sorted by factor.  Overviews are
+        averaged, minimum and maximum copies of the data source coarsened by
+        factor, see :py:meth:`~gridtools.gridutils.GridUtils.writeOverviews`.'''
+        overviews = dsObj.get('overviews', None)
+        if not(overviews):
+            return list()
+        return sorted(overviews, key=lambda overview: overview['factor'])
+
+    def nearestOverview(self, dsObj, coarsenInt):
+        '''Returns the overview with the largest factor that divides
+        coarsenInt, or None.  Coarsening the overview by coarsenInt/factor
+        gives the blocks of coarsening the data source by coarsenInt.'''
+        nearest = None
+        for overview in self.getOverviews(dsObj):
+            if overview['factor'] > 1 and coarsenInt % overview['factor'] == 0:
+                nearest = overview
+        return nearest
+
     def saveCatalog(self, outFile):
         '''Save currently stored catalog to a file in the chosen format by
         the extension.  Supported extensions are: json, yaml
@@ -124,3 +236,249 @@ class DataSource(object):
         if extType == 'yaml':
             yaml.dump(self.cleanCatalog(self.catalog), outfd)
         outfd.close()
+
+class DatasetPool(object):
+    '''
+    Pool of open datasets.  Opening a dataset reads and parses its header,
+    which for large or remote datasets is slow, so datasets are kept open
+    and handed out again when the same url is opened with the same
+    chunks.  The least recently used datasets are closed when more than
+    *maxSize* datasets are open.  A local file that changed since it was
+    opened is opened again.
+
+    Each :py:meth:`open` returns a shallow copy of the pooled dataset.
+    Variables can be added, renamed or replaced in the copy without
+    changing the pooled dataset.  Closing the copy does not close the
+    pooled dataset, use :py:meth:`close` for that.  Used as a context
+    manager, the pool closes all of its datasets on exit.
+
+    The pool may be used from several threads at once.
+    '''
+
+    def __init__(self, maxSize=8):
+        self.maxSize = maxSize
+        self._datasets = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def resolve(url):
+        '''Returns the resolved url: the real path of local files.'''
+        if '://' in url:
+            return url
+        return os.path.realpath(url)
+
+    @staticmethod
+    def key(url, chunks=None):
+        '''Returns the pool key of a url opened with chunks.'''
+        return (DatasetPool.resolve(url), json.dumps(chunks, sort_keys=True, default=str))
+
+    @staticmethod
+    def modified(url):
+        '''Returns the modification time of a local file or None.'''
+        try:
+            return os.stat(url).st_mtime_ns
+        except (OSError, ValueError):
+            return None
+
+    def __len__(self):
+        return len(self._datasets)
+
+    def __contains__(self, url):
+        with self._lock:
+            resolved = DatasetPool.resolve(url)
+            return any([key[0] == resolved for key in self._datasets.keys()])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def open(self, url, chunks=None, **kwargs):
+        '''Returns a dataset for url opened with chunks, from the pool if
+        it is already open.  Other keyword arguments are passed to
+        xarray.open_dataset when the dataset is opened.'''
+        key = DatasetPool.key(url, chunks)
+        with self._lock:
+            entry = self._datasets.get(key, None)
+            if entry is not None and entry[1] != DatasetPool.modified(key[0]):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                if chunks is not None:
+                    dsData = xr.open_dataset(url, chunks=chunks, **kwargs)
+                else:
+                    dsData = xr.open_dataset(url, **kwargs)
+                entry = (dsData, DatasetPool.modified(key[0]))
+                self._datasets[key] = entry
+                while len(self._datasets) > self.maxSize:
+                    self._remove(next(iter(self._datasets)))
+            self._datasets.move_to_end(key)
+            dsCopy = entry[0].copy(deep=False)
+        # The pool closes the dataset
+        dsCopy.set_close(None)
+        return dsCopy
+
+    def _remove(self, key):
+        dsData, mtime = self._datasets.pop(key)
+        dsData.close()
+
+    def close(self, url=None):
+        '''Closes the datasets of url, opened with any chunks, or all
+        datasets if url is None.  Returns the number of datasets closed.'''
+        with self._lock:
+            if url is None:
+                keys = list(self._datasets.keys())
+            else:
+                resolved = DatasetPool.resolve(url)
+                keys = [key for key in self._datasets.keys() if key[0] == resolved]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+class EvalExpression(object):
+    '''
+    Compiled evalMap expression of a data source catalog entry.  Variables
+    of the dataset are written in brackets: e.g. ``-[elevation]``.
+
+    The expression is parsed once into a tree of the allowed operations,
+    nothing else of the expression is run, so catalogs from untrusted
+    sources are safe to use.  Allowed are:
+
+        * numbers and dataset variables ``[name]``
+        * the operators ``+ - * / // % **`` and the comparisons ``< <= > >= == !=``,
+          the exponent of ``**`` must be a number, or an operation on numbers,
+          no larger than :py:attr:`MAX_EXPONENT` in magnitude
+
+    Operations on numbers alone are folded when the expression is compiled.
+    They are checked in float64 first and an expression whose numbers
+    overflow, or divide by zero, is rejected.
+        * the functions in :py:attr:`FUNCTIONS`
+
+    Applying the expression does not compute it.  Variables that are not
+    already dask arrays are chunked first, so the derived variable is a
+    dask array that is computed, and read from disk, only for the parts
+    that are used.
+    '''
+
+    BINARY = {
+        ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+        ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod, ast.Pow: operator.pow
+    }
+    UNARY = {ast.USub: operator.neg, ast.UAdd: operator.pos}
+    COMPARE = {
+        ast.Lt: operator.lt, ast.LtE: operator.le, ast.Gt: operator.gt,
+        ast.GtE: operator.ge, ast.Eq: operator.eq, ast.NotEq: operator.ne
+    }
+    FUNCTIONS = {
+        'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log,
+        'log10': np.log10, 'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+        'minimum': np.minimum, 'maximum': np.maximum, 'where': xr.where
+    }
+
+    # Larger exponents or exponents of variables can take arbitrarily
+    # long to evaluate
+    MAX_EXPONENT = 64
+
+    # Same pattern as GridUtils.convertToMathExpression()
+    reVariable = re.compile(r'\[([a-zA-Z0-9_].*?)\]')
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.variables = list()
+
+        def placeholder(match):
+            if not(match.group(1) in self.variables):
+                self.variables.append(match.group(1))
+            return '_v%d' % (self.variables.index(match.group(1)))
+
+        try:
+            tree = ast.parse(EvalExpression.reVariable.sub(placeholder, expression).strip(), mode='eval')
+        except SyntaxError:
+            raise Exception("The evalMap expression (%s) could not be parsed." % (expression))
+        self._evaluate = self.compileNode(tree.body)
+
+    def compileNode(self, node):
+        '''Returns a function of the list of variables that evaluates node.'''
+        value = self.foldConstant(node)
+        if value is not None:
+            return lambda variables: value
+        if isinstance(node, ast.Name) and re.fullmatch('_v[0-9]+', node.id):
+            k = int(node.id[2:])
+            return lambda variables: variables[k]
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            exponent = self.foldConstant(node.right)
+            if exponent is None or abs(exponent) > EvalExpression.MAX_EXPONENT:
+                raise Exception("The evalMap expression (%s) has an exponent that is not a number"
+                    " no larger than %d in magnitude." % (self.expression, EvalExpression.MAX_EXPONENT))
+        if isinstance(node, ast.BinOp) and type(node.op) in EvalExpression.BINARY:
+            op = EvalExpression.BINARY[type(node.op)]
+            left, right = self.compileNode(node.left), self.compileNode(node.right)
+            return lambda variables: op(left(variables), right(variables))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in EvalExpression.UNARY:
+            op = EvalExpression.UNARY[type(node.op)]
+            operand = self.compileNode(node.operand)
+            return lambda variables: op(operand(variables))
+        if isinstance(node, ast.Compare) and len(node.ops) == 1 and type(node.ops[0]) in EvalExpression.COMPARE:
+            op = EvalExpression.COMPARE[type(node.ops[0])]
+            left, right = self.compileNode(node.left), self.compileNode(node.comparators[0])
+            return lambda variables: op(left(variables), right(variables))
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and\
+            node.func.id in EvalExpression.FUNCTIONS and not(node.keywords):
+            func = EvalExpression.FUNCTIONS[node.func.id]
+            args = [self.compileNode(arg) for arg in node.args]
+            return lambda variables: func(*[arg(variables) for arg in args])
+        raise Exception("The evalMap expression (%s) uses an operation that is not allowed (%s)." %
+            (self.expression, ast.dump(node)))
+
+    def foldConstant(self, node):
+        '''Returns the value of node if it is a number or an operation on
+        numbers, otherwise None.  Each operation is checked in float64
+        before it is done with the Python numbers, so that large powers
+        are rejected without being computed.'''
+        if isinstance(node, ast.Constant) and type(node.value) in [int, float]:
+            value = node.value
+            operands = [value]
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in EvalExpression.UNARY:
+            operands = [self.foldConstant(node.operand)]
+            op = EvalExpression.UNARY[type(node.op)]
+        elif isinstance(node, ast.BinOp) and type(node.op) in EvalExpression.BINARY:
+            operands = [self.foldConstant(node.left), self.foldConstant(node.right)]
+            op = EvalExpression.BINARY[type(node.op)]
+        else:
+            return None
+        if any([operand is None for operand in operands]):
+            return None
+        try:
+            with np.errstate(all='ignore'):
+                check = [np.float64(operand) for operand in operands]
+                if not(isinstance(node, ast.Constant)):
+                    check = [op(*check)]
+        except (OverflowError, ZeroDivisionError):
+            check = [np.inf]
+        if not(np.all(np.isfinite(check))):
+            raise Exception("The evalMap expression (%s) has numbers that overflow or divide by zero." %
+                (self.expression))
+        if isinstance(node, ast.Constant):
+            return value
+        return op(*operands)
+
+    def __call__(self, dsData):
+        '''Returns the expression applied to the variables of dsData.'''
+        variables = list()
+        for varName in self.variables:
+            variable = dsData[varName]
+            if variable.chunks is None and variable.ndim > 0:
+                variable = variable.chunk('auto')
+            variables.append(variable)
+        return self._evaluate(variables)
+
+_compiledExpressions = dict()
+
+def compileExpression(expression):
+    '''Returns the compiled :py:class:`EvalExpression`, which is only
+    compiled the first time an expression is seen.'''
+    if not(expression in _compiledExpressions):
+        _compiledExpressions[expression] = EvalExpression(expression)
+    return _compiledExpressions[expression]
@@ -1,6 +1,6 @@
 # General imports and definitions
 import os, re, sys, datetime, logging, importlib, copy
-import cartopy, warnings, hashlib
+import cartopy, warnings
 import numpy as np
 import xarray as xr
 from pyproj import CRS, Transformer
@@ -21,6 +21,8 @@ from matplotlib.backends.backend_agg import FigureCanvas
 from . import spherical
 
 # Other utilities
+from . import coordutils
+from . import datasource
 from . import fileutils
 from . import utils
 from . import sanity
@@ -46,6 +48,8 @@ class GridUtils(object):
         self.nativeGrid = None
         # Allow setting of chunk parameter for grids
         self.xrChunks = None
+        # Datasets kept open by openDataset()
+        self.datasetPool = datasource.DatasetPool()
         # Internal parameters
         self.usePaneMatplotlib = False
         self.msgBox = None
@@ -571,11 +575,11 @@ class GridUtils(object):
         self.grid['dx'] = (('nyp', 'nx'),  R * spherical.angle_through_center( (lat[ :,1:],lon[ :,1:]), (lat[:  ,:-1],lon[:  ,:-1]) ))
         self.grid['dx'].attrs['standard_name'] = 'grid_edge_x_distance'
         self.grid['dx'].attrs['units'] = 'meters'
-        self.grid['dx'].attrs['sha256'] = hashlib.sha256( np.array( self.grid['dx'] ) ).hexdigest()
+        utils.hashVariable( self.grid['dx'] )
         self.grid['dy'] = (('ny' , 'nxp'), R * spherical.angle_through_center( (lat[1:, :],lon[1:, :]), (lat[:-1,:  ],lon[:-1,:  ]) ))
         self.grid['dy'].attrs['standard_name'] = 'grid_edge_y_distance'
         self.grid['dy'].attrs['units'] = 'meters'
-        self.grid['dy'].attrs['sha256'] = hashlib.sha256( np.array( self.grid['dy'] ) ).hexdigest()
+        utils.hashVariable( self.grid['dy'] )
 
         # Scaling by latitude?
         cos_lat = np.cos(np.radians(lat))
@@ -591,12 +595,12 @@ class GridUtils(object):
         #self.grid.angle_dx.attrs['standard_name'] = 'grid_vertex_x_angle_WRT_geographic_east'
         #self.grid.angle_dx.attrs['units'] = 'degrees_east'
         self.grid['angle_dx'].attrs['units'] = 'radians'
-        self.grid['angle_dx'].attrs['sha256'] = hashlib.sha256( np.array( angle_dx ) ).hexdigest()
+        utils.hashVariable( self.grid['angle_dx'] )
 
         self.grid['area'] = (('ny','nx'), R * R * spherical.quad_area(lat, lon))
         self.grid['area'].attrs['standard_name'] = 'grid_cell_area'
         self.grid['area'].attrs['units'] = 'm2'
-        self.grid['area'].attrs['sha256'] = hashlib.sha256( np.array( self.grid['area'] ) ).hexdigest()
+        utils.hashVariable( self.grid['area'] )
 
         return
 
@@ -804,11 +808,11 @@ class GridUtils(object):
                     self.grid['x'] = (('nyp','nxp'), lonGrid)
                     self.grid['x'].attrs['standard_name'] = 'geographic_longitude'
                     self.grid['x'].attrs['units'] = 'degrees_east'
-                    self.grid['x'].attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
+                    utils.hashVariable( self.grid['x'] )
                     self.grid['y'] = (('nyp','nxp'), latGrid)
                     self.grid['y'].attrs['standard_name'] = 'geographic_latitude'
                     self.grid['y'].attrs['units'] = 'degrees_north'
-                    self.grid['y'].attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+                    utils.hashVariable( self.grid['y'] )
 
                     newGridCreated = True
 
@@ -851,11 +855,11 @@ class GridUtils(object):
                         self.grid['x'] = (('nyp','nxp'), lonGrid)
                         self.grid.x.attrs['standard_name'] = 'geographic_longitude'
                         self.grid.x.attrs['units'] = 'degrees_east'
-                        self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
+                        utils.hashVariable( self.grid.x )
                         self.grid['y'] = (('nyp','nxp'), latGrid)
                         self.grid.y.attrs['standard_name'] = 'geographic_latitude'
                         self.grid.y.attrs['units'] = 'degrees_north'
-                        self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+                        utils.hashVariable( self.grid.y )
 
                         newGridCreated = True
                     
@@ -887,11 +891,11 @@ class GridUtils(object):
                         self.grid['x'] = (('nyp','nxp'), lonGrid)
                         self.grid.x.attrs['standard_name'] = 'geographic_longitude'
                         self.grid.x.attrs['units'] = 'degrees_east'
-                        self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
+                        utils.hashVariable( self.grid.x )
                         self.grid['y'] = (('nyp','nxp'), latGrid)
                         self.grid.y.attrs['standard_name'] = 'geographic_latitude'
                         self.grid.y.attrs['units'] = 'degrees_north'
-                        self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+                        utils.hashVariable( self.grid.y )
 
                         newGridCreated = True
                     
@@ -912,11 +916,11 @@ class GridUtils(object):
             self.grid['x'] = (('nyp','nxp'), lonGrid)
             self.grid.x.attrs['standard_name'] = 'geographic_longitude'
             self.grid.x.attrs['units'] = 'degrees_east'
-            self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
+            utils.hashVariable( self.grid.x )
             self.grid['y'] = (('nyp','nxp'), latGrid)
             self.grid.y.attrs['standard_name'] = 'geographic_latitude'
             self.grid.y.attrs['units'] = 'degrees_north'
-            self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+            utils.hashVariable( self.grid.y )
 
             newGridCreated = True
 
@@ -942,11 +946,11 @@ class GridUtils(object):
             self.grid['x'] = (('nyp','nxp'), lonGrid)
             self.grid.x.attrs['standard_name'] = 'geographic_longitude'
             self.grid.x.attrs['units'] = 'degrees_east'
-            self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
+            utils.hashVariable( self.grid.x )
             self.grid['y'] = (('nyp','nxp'), latGrid)
             self.grid.y.attrs['standard_name'] = 'geographic_latitude'
             self.grid.y.attrs['units'] = 'degrees_north'
-            self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+            utils.hashVariable( self.grid.y )
 
             newGridCreated = True
 
@@ -1003,11 +1007,11 @@ class GridUtils(object):
             self.grid['x'] = (('nyp','nxp'), lonGrid)
             self.grid.x.attrs['standard_name'] = 'geographic_longitude'
             self.grid.x.attrs['units'] = 'degrees_east'
-            self.grid.x.attrs['sha256'] = hashlib.sha256( np.array( lonGrid ) ).hexdigest()
+            utils.hashVariable( self.grid.x )
             self.grid['y'] = (('nyp','nxp'), latGrid)
             self.grid.y.attrs['standard_name'] = 'geographic_latitude'
             self.grid.y.attrs['units'] = 'degrees_north'
-            self.grid.y.attrs['sha256'] = hashlib.sha256( np.array( latGrid ) ).hexdigest()
+            utils.hashVariable( self.grid.y )
 
             # This technique seems to return a Lambert Conformal Projection with the following properties
             # This only works if the grid does not overlap a polar point
@@ -1439,6 +1443,8 @@ class GridUtils(object):
         if self.xrOpen:
             self.xrDS.close()
             self.xrOpen = False
+            if self.xrFilename:
+                self.closeDataset(self.xrFilename)
 
     def convertGrid(self, target, **kwargs):
         '''Convert current grid to another grid type.
@@ -1808,13 +1814,14 @@ class GridUtils(object):
 
         # Generic longitude check
         if self.grid['x'].attrs['units'] == 'degrees_east':
-            self.grid['x'].values = np.where(self.grid['x'].values>180, self.grid['x'].values-360, self.grid['x'].values)
+            self.grid['x'].values = coordutils.PeriodicLongitude(self.grid['x'].values, lonMin=-180.).values
 
         #Duplicate
         #self.grid.to_netcdf(self.xrFilename, encoding=self.removeFillValueAttributes())
 
         # Save the grid here
         try:
+            utils.resolveHashes(self.grid)
             self.grid.to_netcdf(self.xrFilename, encoding=self.removeFillValueAttributes())
             msg = "Successfully wrote netCDF file to %s" % (self.xrFilename)
             self.printMsg(msg, level=logging.INFO)
@@ -2499,14 +2506,27 @@ class GridUtils(object):
         The url can be an OpenDAP dataset: e.g.
         https://opendap.jpl.nasa.gov/opendap/allData/ghrsst/data/L4/GLOB/NCDC/AVHRR_AMSR_OI/2011/001/20110101-NCDC-L4LRblend-GLOB-v01-fv02_0-AVHRR_AMSR_OI.nc.bz2
 
+        Datasets are kept open in a pool, see :py:class:`~gridtools.datasource.DatasetPool`,
+        and opening the same url with the same chunks again does not read the dataset
+        header again.  Each call returns a new shallow copy that may be changed freely.
+        Use :py:meth:`closeDataset` to close a pooled dataset.
+
         **Keyword arguments**
 
             * *chunks* (``int, tuple of int or mapping of hashable to int``) -- xarray chunk description.
             * *gridid* (``ROMS model grid ID``) -- Model grid identification using the gridid.txt file.
               The environment variable `ROMS_GRIDID_FILE` must be set.
+            * *pool* (``boolean``) -- set to False to open the dataset outside of the pool.
+              Default: True
+            * *bbox* (``list``) -- [lonMin, latMin, lonMax, latMax] of the region that is
+              needed.  For a tiled catalog entry only the tiles intersecting bbox are opened,
+              see :py:meth:`openTiledDataset`.  Other data sources are opened whole.
+              Default: None (all tiles)
 	'''
         # Process keyword arguments
         chunks = kwargs.pop('chunks', None)
+        pool = kwargs.pop('pool', True)
+        bbox = kwargs.pop('bbox', None)
 
         dsUrl = urllib.parse.urlparse(dsName)
         # At this point, we assume the dsName is a local filename
@@ -2514,11 +2534,10 @@ class GridUtils(object):
 
         # OpenDAP
         if dsUrl.scheme in ['http','https']:
-            urlToOpen = dsObj['url']
             try:
-                dsData = xr.open_dataset(urlToOpen)
+                dsData = self.openPooledDataset(dsName, chunks=chunks, pool=pool)
             except:
-                self.printMsg("ERROR: The remote data source (%s) is was not found or could not be opened." % (urlToOpen), level=logging.ERROR)
+                self.printMsg("ERROR: The remote data source (%s) is was not found or could not be opened." % (dsName), level=logging.ERROR)
                 return None
             return dsData
 
@@ -2528,7 +2547,7 @@ class GridUtils(object):
             if not(os.path.isfile(urlToOpen)):
                 self.printMsg("ERROR: The data source (%s) is was not found." % (urlToOpen), level=logging.ERROR)
                 return None
-            dsData = xr.open_dataset(urlToOpen)
+            dsData = self.openPooledDataset(urlToOpen, pool=pool)
             return dsData
 
         # Gridtools catalog entry
@@ -2544,22 +2563,17 @@ class GridUtils(object):
             # Parse the catalog url, what to pass to xarray open_dataset
             # scheme='file' => path
             # scheme='http', scheme='https' => dsObj['url']
-            dsUrl = urllib.parse.urlparse(dsObj['url'])
-            urlToOpen = None
-            if dsUrl.scheme in ['http','https']:
-                urlToOpen = dsObj['url']
-            if dsUrl.scheme == 'file':
-                urlToOpen = dsUrl.path
+            urlToOpen = self.dataSourceUrl(dsName)
             if 'chunks' in dsObj.keys():
                 if not(chunks):
                     chunks = dsObj['chunks']
 
         dsData = None
         try:
-            if chunks:
-                dsData = xr.open_dataset(urlToOpen, chunks=chunks)
+            if dsObj and self.dataSourcesObj.isTiled(dsObj):
+                dsData = self.openTiledDataset(dsName, dsObj, bbox=bbox, chunks=chunks, pool=pool)
             else:
-                dsData = xr.open_dataset(urlToOpen)
+                dsData = self.openPooledDataset(urlToOpen, chunks=chunks, pool=pool)
         except:
             self.printMsg("ERROR: The data source (%s) could not be opened." % (dsName), level=logging.ERROR)
             return dsData
@@ -2576,6 +2590,109 @@ class GridUtils(object):
 
         return dsData
 
+    def openTiledDataset(self, dsName, dsObj, bbox=None, chunks=None, pool=True):
+        '''Open the tiles of a tiled catalog entry that intersect bbox and mosaic
+        them by their coordinates.  Tiles are opened with dask chunks, the tile
+        files are only read when the mosaic is computed.  The tiles must be on
+        the same regular grid and the selected tiles must fill a rectangle.
+        See :py:meth:`~gridtools.datasource.DataSource.getTiles`.'''
+        tiles = self.dataSourcesObj.selectTiles(self.dataSourcesObj.getTiles(dsObj), bbox)
+        if len(tiles) == 0:
+            self.printMsg("ERROR: No tiles of the data source (%s) intersect the box %s." % (dsName, str(bbox)), level=logging.ERROR)
+            return None
+        msg = ("Opening %d tiles of the data source (%s)" % (len(tiles), dsName))
+        self.printMsg(msg, level=logging.INFO)
+        if not(chunks):
+            chunks = {}
+        tileData = [self.openPooledDataset(self.dataSourceUrl(tile['url']), chunks=chunks, pool=pool) for tile in tiles]
+        if len(tileData) == 1:
+            return tileData[0]
+        return xr.combine_by_coords(tileData, combine_attrs='override')
+
+    def findOverview(self, dsName, coarsenInt):
+        '''Returns the overview {'factor': factor, 'url': url} of a catalog
+        entry with the largest factor that divides coarsenInt, or None.
+        See :py:meth:`writeOverviews`.'''
+        dsUrl = urllib.parse.urlparse(dsName)
+        if dsUrl.scheme != 'ds' or not(dsUrl.path in self.dataSourcesObj.catalog.keys()):
+            return None
+        if not(isinstance(coarsenInt, int)):
+            return None
+        return self.dataSourcesObj.nearestOverview(self.dataSourcesObj.catalog[dsUrl.path], coarsenInt)
+
+    def openOverview(self, dsName, coarsenInt):
+        '''Open the data source dsName to be coarsened by coarsenInt, for
+        plots and previews.  Returns the nearest overview and the factor it
+        still has to be coarsened by, or the data source and coarsenInt if
+        there is no overview.'''
+        overview = self.findOverview(dsName, coarsenInt)
+        if overview:
+            return self.openDataset(overview['url']), coarsenInt // overview['factor']
+        dsData = self.openDataset(dsName)
+        if urllib.parse.urlparse(dsName).scheme == 'ds':
+            self.applyEvalMap(dsName, dsData)
+        return dsData, coarsenInt
+
+    def writeOverviews(self, dsName, outDir, **kwargs):
+        '''Precompute overviews of a data source: copies coarsened by 2, 4, 8, ...
+        with the average, minimum and maximum of each block.  The overviews are
+        recorded under 'overviews' in the catalog entry of dsName, save the
+        catalog to keep them.  See :func:`gridtools.topoutils.TopoUtils.writeOverviews`.
+        '''
+        from . import topoutils
+
+        topoObj = topoutils.TopoUtils()
+        overviews = topoObj.writeOverviews(self, dsName, outDir, **kwargs)
+        dsUrl = urllib.parse.urlparse(dsName)
+        if dsUrl.scheme == 'ds' and dsUrl.path in self.dataSourcesObj.catalog.keys():
+            self.dataSourcesObj.catalog[dsUrl.path]['overviews'] = overviews
+        return overviews
+
+    def openPooledDataset(self, urlToOpen, chunks=None, pool=True):
+        '''Open a url with xarray, through the dataset pool unless pool is False.'''
+        if pool:
+            return self.datasetPool.open(urlToOpen, chunks=chunks)
+        if chunks is not None:
+            return xr.open_dataset(urlToOpen, chunks=chunks)
+        return xr.open_dataset(urlToOpen)
+
+    def dataSourceUrl(self, dsName):
+        '''Returns the url or local path opened for a data source name: a
+        catalog entry (ds:), a local file (file:), a remote url or a filename.'''
+        dsUrl = urllib.parse.urlparse(dsName)
+        if dsUrl.scheme == 'ds':
+            if not(dsUrl.path in self.dataSourcesObj.catalog.keys()):
+                return None
+            dsName = self.dataSourcesObj.catalog[dsUrl.path].get('url', None)
+            if not(dsName):
+                return None
+            dsUrl = urllib.parse.urlparse(dsName)
+        if dsUrl.scheme in ['http','https']:
+            return dsName
+        if dsUrl.scheme == 'file':
+            return dsUrl.path
+        return dsName
+
+    def closeDataset(self, dsName=None):
+        '''Close the pooled dataset of a data source name or url, opened with
+        any chunks, or all pooled datasets if dsName is None.  For a tiled
+        catalog entry every tile is closed.  Datasets returned by
+        :py:meth:`openDataset` can still be used if they were loaded into
+        memory.'''
+        if dsName is None:
+            self.datasetPool.close()
+            return
+        dsUrl = urllib.parse.urlparse(dsName)
+        if dsUrl.scheme == 'ds' and dsUrl.path in self.dataSourcesObj.catalog.keys():
+            dsObj = self.dataSourcesObj.catalog[dsUrl.path]
+            if self.dataSourcesObj.isTiled(dsObj):
+                for tile in self.dataSourcesObj.getTiles(dsObj):
+                    self.datasetPool.close(self.dataSourceUrl(tile['url']))
+                return
+        urlToClose = self.dataSourceUrl(dsName)
+        if urlToClose:
+            self.datasetPool.close(urlToClose)
+
     def saveDataset(self, dsName, dsData, **kwargs):
         '''This allows saving variables to a file.
 
@@ -2589,7 +2706,9 @@ class GridUtils(object):
         **Keyword arguments**
 
             * *overwrite* (``boolean``) -- set to True to allow overwriting. Default: False
-            * *hashVariables* (``list()``) -- names of variables to add a sha256sum attribute
+            * *hashVariables* (``list()``) -- names of variables to add a content hash attribute,
+              see :py:func:`~gridtools.utils.setHashPolicy`.  Hashes deferred by a lazy policy are
+              computed before writing.
             * *mapVariables* (``dict()``) -- map variable names to names stored in the
               output file.  This argument takes precidence over all arguments.
 
@@ -2656,12 +2775,12 @@ class GridUtils(object):
         if len(hashVariables) > 0:
             for hVar in hashVariables:
                 if hVar in dsData or hVar in dsData.coords:
-                    dsData[hVar].attrs['sha256'] = utils.sha256sum(dsData[hVar])
+                    utils.hashVariable( dsData[hVar] )
             # Edge case where dsData is only one variable
             if not(hasattr(dsData, 'variables')):
                 if hasattr(dsData, 'name'):
                     if dsData.name in hashVariables:
-                        dsData.attrs['sha256'] = utils.sha256sum(dsData)
+                        utils.hashVariable( dsData )
 
         if os.path.isfile(urlToOpen) and not(overwrite):
             msg = ("WARNING: Use overwrite=True to overwrite existing file (%s)." % (urlToOpen))
@@ -2669,6 +2788,7 @@ class GridUtils(object):
             return
 
         try:
+            utils.resolveHashes(dsData)
             dsData.to_netcdf(urlToOpen, encoding=self.removeFillValueAttributes(data=dsData))
             msg = ("INFO: Successfully wrote to file (%s)." % (urlToOpen))
             self.printMsg(msg, level=logging.INFO)
@@ -2680,7 +2800,9 @@ class GridUtils(object):
             return
 
     def applyEvalMap(self, dsName, dsData):
-        '''Apply constructed equations through python eval() to manipulate data source fields.
+        '''Apply the evalMap expressions of a data source catalog entry to manipulate data source
+           fields.  Expressions are compiled once into a restricted expression tree and applied
+           lazily, see :py:class:`~gridtools.datasource.EvalExpression`.
            Data source catalog entries must be prefixed with ds:.  If GEBCO is defined
            as a data source in the catalog, use: ds:GEBCO.  All catalog entries start
            with a slash.
@@ -2707,12 +2829,13 @@ class GridUtils(object):
             # If using chunks, evaluate later
             # Evaluations will create additional fields
             # if the name is unique, otherwise it will overwrite the field.
+            # Expressions are compiled once and evaluated lazily, see datasource.EvalExpression
             for varTarget in dsObj['evalMap'].keys():
-                mathExpression = self.convertToMathExpression(dsObj['evalMap'][varTarget])
                 try:
-                    dsData[varTarget] = eval(mathExpression)
-                except:
-                    msg = ("ERROR: Failed to apply evalMap to (%s)." % (varTarget))
+                    expression = datasource.compileExpression(dsObj['evalMap'][varTarget])
+                    dsData[varTarget] = expression(dsData)
+                except Exception as e:
+                    msg = ("ERROR: Failed to apply evalMap to (%s): %s" % (varTarget, str(e)))
                     self.printMsg(msg, level=logging.ERROR)
 
     def useDataSource(self, dsObj):
@@ -2771,7 +2894,9 @@ class GridUtils(object):
         topoVarName = "elevation", coarsenInt = 10, method = 'conservative',
         superGrid = True, periodic = True, gridDimX = None, gridDimY = None,
         gridLatName = None, gridLonName = None, topoDimX = None, topoDimY = None,
-        topoLatName = None, topoLonName = None, convert_to_depth = True):
+        topoLatName = None, topoLonName = None, convert_to_depth = True,
+        weightsCache = True, weightsDir = None, tiles = None, tileShape = None,
+        backend = 'auto', minSourceCells = 2, useOverviews = True):
         '''Generate a bathymetry and ocean mask for a given data source
         topography or bathymetry.  See :func:`gridtools.topoutils.TopoUtils.regridTopo`.
         '''
@@ -2785,4 +2910,7 @@ class GridUtils(object):
             gridLatName = gridLatName, gridLonName = gridLonName,\
             topoDimX = topoDimX, topoDimY = topoDimY,\
             topoLatName = topoLatName, topoLonName = topoLonName,\
-            convert_to_depth = convert_to_depth)
+            convert_to_depth = convert_to_depth,\
+            weightsCache = weightsCache, weightsDir = weightsDir,\
+            tiles = tiles, tileShape = tileShape, backend = backend,\
+            minSourceCells = minSourceCells, useOverviews = useOverviews)
@@ -0,0 +1,194 @@
+# Compiled kernels for mesh refinement
+'''
+Optional compiled kernels for the hot paths of
+:py:mod:`gridtools.meshrefinement`.
+
+When Numba is installed, the refinement, nearest neighbor search,
+sampling and coarsening of a mesh are each done in a single parallel
+pass over the mesh.  Every kernel does the same floating point operations
+in the same order as the NumPy code in
+:py:mod:`gridtools.meshrefinement`, so both give bitwise identical results
+and the checksums of the roughness fields do not depend on the backend.
+The trigonometric conversions between (lon,lat) and 3d coordinates are
+always done by NumPy.
+
+The backend is chosen with a :py:class:`Kernels` passed to the meshes
+and sources that use the kernels:
+
+    * *auto* -- use Numba if it is installed (the default)
+    * *numba* -- use Numba, raises an exception if it is not installed
+    * *numpy* -- use the NumPy code
+
+The kernels run in parallel threads unless *parallel* is False.  Blocks
+run by worker processes or threads use the serial kernels, as the
+threading layer of Numba cannot be used after a fork or from several
+threads at once.
+
+Blocks are run by forked worker processes and a process that has used
+the TBB threading layer can hang at exit after forking.  When the
+parallel kernels are first run, the threading layers that do not are
+preferred unless a layer is chosen with the ``NUMBA_THREADING_LAYER``
+environment variable.  Set it to choose the layer for the whole process.
+'''
+
+import numpy as np
+
+import os
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKENDS = ['auto', 'numba', 'numpy']
+# Serial versions of the kernels, compiled when first used
+_serial = {}
+_threadingLayerSet = False
+
+def _setThreadingLayer():
+    '''Prefers the threading layers of Numba that can be forked, unless a
+    layer is chosen in the environment.  Called before the parallel
+    kernels are first run.'''
+    global _threadingLayerSet
+    if _threadingLayerSet:
+        return
+    _threadingLayerSet = True
+    if not('NUMBA_THREADING_LAYER' in os.environ):
+        numba.config.THREADING_LAYER_PRIORITY = ['omp', 'workqueue', 'tbb']
+
+class Kernels(object):
+    '''
+    The kernel backend, auto, numba or numpy, and whether the compiled
+    kernels run in parallel.  It is passed to the meshes and sources that
+    use the kernels, so refinements with different backends can run at
+    the same time.
+    '''
+
+    def __init__(self, backend='auto', parallel=True):
+        if not(backend in BACKENDS):
+            raise Exception("Unknown kernel backend '%s', use one of %s" % (backend, ", ".join(BACKENDS)))
+        if backend == 'numba' and numba is None:
+            raise Exception("The numba kernel backend was requested but numba is not installed.")
+        self.backend = backend
+        self.parallel = parallel
+
+    def __repr__(self):
+        return '<Kernels backend:%s parallel:%s enabled:%s>' % (self.backend, self.parallel, self.enabled())
+
+    def enabled(self):
+        '''Returns True if the compiled kernels are used.'''
+        return numba is not None and self.backend != 'numpy'
+
+    def kernel(self, name):
+        '''Returns the compiled kernel name, parallel or serial.'''
+        if self.parallel:
+            _setThreadingLayer()
+            return globals()[name]
+        if not(name in _serial):
+            # Not cached, the numba cache does not tell the parallel and
+            # serial compilations of a function apart
+            _serial[name] = numba.njit(globals()[name].py_func)
+        return _serial[name]
+
+# Used by meshes and sources that are not given a backend
+DEFAULT = Kernels()
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def refine_xyz(X, Y, Z, xyz):
+        '''Sets xyz, shape (3,2*nj-1,2*ni-1), to the refinement of
+        (X,Y,Z), shape (nj,ni), projected onto the unit sphere.'''
+        nj, ni = X.shape
+        for jj in numba.prange(2*nj-1):
+            j, oj = jj//2, jj%2
+            for ii in range(2*ni-1):
+                i, oi = ii//2, ii%2
+                if oj == 0 and oi == 0:
+                    x, y, z = X[j,i], Y[j,i], Z[j,i]
+                elif oj == 0:
+                    x = (X[j,i] + X[j,i+1])*0.5
+                    y = (Y[j,i] + Y[j,i+1])*0.5
+                    z = (Z[j,i] + Z[j,i+1])*0.5
+                elif oi == 0:
+                    x = (X[j,i] + X[j+1,i])*0.5
+                    y = (Y[j,i] + Y[j+1,i])*0.5
+                    z = (Z[j,i] + Z[j+1,i])*0.5
+                else:
+                    x = ((X[j,i] + X[j+1,i+1]) + (X[j+1,i] + X[j,i+1]))*0.25
+                    y = ((Y[j,i] + Y[j+1,i+1]) + (Y[j+1,i] + Y[j,i+1]))*0.25
+                    z = ((Z[j,i] + Z[j+1,i+1]) + (Z[j+1,i] + Z[j,i+1]))*0.25
+                r = 1./np.sqrt((x*x + y*y) + z*z)
+                xyz[0,jj,ii] = x*r
+                xyz[1,jj,ii] = y*r
+                xyz[2,jj,ii] = z*r
+
+    @numba.njit(parallel=True, cache=True)
+    def nearest(lon, lat, lon0, lat0, dlon, dlat, sni, snj, nn_i, nn_j):
+        '''Sets nn_i, nn_j to the indexes of the nearest uniform source
+        point to each (lon,lat).  Returns the number of points, such as
+        NaNs, without a valid index.'''
+        nj, ni = lon.shape
+        bad = 0
+        for j in numba.prange(nj):
+            for i in range(ni):
+                fi = np.floor(np.mod(lon[j,i]-lon0+0.5*dlon, 360.)/dlon)
+                fj = np.floor(0.5+(lat[j,i]-lat0)/dlat)
+                fi = np.maximum(np.minimum(fi, sni-1), 0)
+                fj = np.maximum(np.minimum(fj, snj-1), 0)
+                if not(fi >= 0 and fj >= 0):
+                    bad += 1
+                    nn_i[j,i], nn_j[j,i] = 0, 0
+                else:
+                    nn_i[j,i], nn_j[j,i] = int(fi), int(fj)
+        return bad
+
+    @numba.njit(parallel=True, cache=True)
+    def sample(zs, xs, ys, nn_i, nn_j, height, xm, ym, zm, xxm, yym, xym, xzm, yzm):
+        '''Sets the heights and moments of the mesh nodes from the nearest
+        source points (nn_i, nn_j).'''
+        nj, ni = nn_i.shape
+        for j in numba.prange(nj):
+            for i in range(ni):
+                z = np.float64(zs[nn_j[j,i],nn_i[j,i]])
+                x = np.float64(xs[nn_i[j,i]])
+                y = np.float64(ys[nn_j[j,i]])
+                height[j,i], zm[j,i] = z, z
+                xm[j,i], ym[j,i] = x, y
+                xxm[j,i] = x*x
+                yym[j,i] = y*y
+                xym[j,i] = x*y
+                xzm[j,i] = x*z
+                yzm[j,i] = y*z
+
+    @numba.njit(cache=True)
+    def _min(a, b):
+        # np.minimum, NaNs propagate
+        return a if (a <= b or a != a) else b
+
+    @numba.njit(cache=True)
+    def _max(a, b):
+        # np.maximum, NaNs propagate
+        return a if (a >= b or a != a) else b
+
+    @numba.njit(parallel=True, cache=True)
+    def coarsen(fine, coarse, h_min, h_max, moments, coarse_moments):
+        '''Sets the coarse height, minimum, maximum and the coarse moments
+        (fourPointAve) from the nodes of a mesh refined by 2.'''
+        nj, ni = coarse.shape
+        nm = moments.shape[0]
+        for j in numba.prange(nj):
+            for i in range(ni):
+                if j == nj-1 or i == ni-1:
+                    h = fine[2*j,2*i]
+                    coarse[j,i], h_min[j,i], h_max[j,i] = h, h, h
+                    for m in range(nm):
+                        coarse_moments[m,j,i] = moments[m,2*j,2*i]
+                    continue
+                a, b, c, d = fine[2*j,2*i], fine[2*j+1,2*i+1], fine[2*j+1,2*i], fine[2*j,2*i+1]
+                coarse[j,i] = 0.25*(((a + b) + c) + d)
+                h_min[j,i] = _min(_min(_min(a, b), c), d)
+                h_max[j,i] = _max(_max(_max(a, b), c), d)
+                for m in range(nm):
+                    coarse_moments[m,j,i] = 0.25*(((moments[m,2*j,2*i] + moments[m,2*j+1,2*i+1])
+                        + moments[m,2*j+1,2*i]) + moments[m,2*j,2*i+1])
@@ -1,9 +1,13 @@
 '''This was originally GMesh.py from Niki Zahdah.  :cite:p:`Zadeh_2020_ocean_model_topog_generator`
 
 '''
+import logging
 import numpy as np
 import pdb
 
+from . import coordutils
+from . import meshkernels
+
 def fourPointAve(x):
     xave = np.copy(x[::2,::2])
     xave[:-1,:-1]=0.25*(x[:-1:2,:-1:2]+x[1::2,1::2]+x[1::2,0:-1:2]+x[0:-1:2,1::2])
@@ -12,14 +16,13 @@ def fourPointAve(x):
 def is_mesh_uniform(lon,lat):
     """Returns True if the input grid (lon,lat) is uniform and False otherwise"""
     def compare(array):
+        array = np.asarray(array)
         eps = np.finfo( array.dtype ).eps # Precision of datatype
         delta = np.abs( array[1:] - array[:-1] ) # Difference along first axis
         error = np.abs( array )
         error = np.maximum( error[1:], error[:-1] ) # Error in difference
-        #derror = np.abs( delta - delta.flatten()[0] ) # Tolerance to which comparison can be made
-        derror = np.abs( delta - delta.stack(z=(delta.coords)).reset_index('z')[0] )
-        #return np.all( derror < ( error + error.flatten()[0] ) )
-        return np.all( derror < ( error + error.stack(z=(error.coords)).reset_index('z')[0] ) )
+        derror = np.abs( delta - delta.flatten()[0] ) # Tolerance to which comparison can be made
+        return np.all( derror < ( error + error.flatten()[0] ) )
     assert len(lon.shape) == len(lat.shape), "Arguments lon and lat must have the same rank"
     if len(lon.shape)==2: # 2D arralat
         assert lon.shape == lat.shape, "Arguments lon and lat must have the same shape"
@@ -29,6 +32,194 @@ def is_mesh_uniform(lon,lat):
     #pdb.set_trace()
     return compare(lat) and compare(lon.T)
 
+def index_range(v, lo, hi):
+    """Returns the bounds [i0,i1) of the indexes of the monotonic 1D array v
+       with lo <= v < hi, for arrays of bounds lo and hi"""
+    v = np.asarray(v)
+    if v.size>1 and v[-1]<v[0]:
+        # Decreasing values, search the reversed array
+        k0 = np.searchsorted(v[::-1], lo, side='left')
+        k1 = np.searchsorted(v[::-1], hi, side='left')
+        return v.size-np.maximum(k0,k1), v.size-k0
+    return np.searchsorted(v, lo, side='left'), np.searchsorted(v, hi, side='left')
+
+class UniformSource(object):
+    """Describes a uniform source grid of cell centers for nearest neighbor searches.
+
+    The source is checked to be uniform once when it is described.  Windows of the
+    source made by window() are not checked again.
+
+    Attributes:
+
+    lon      - longitudes of the source (1d), may be a coordutils.PeriodicLongitude
+    lat      - latitudes of the source (1d)
+    shape    - (nj,ni)
+    lon0     - first longitude
+    lat0     - first latitude
+    dlon     - spacing in longitude
+    dlat     - spacing in latitude
+    repeated - True if the last longitude repeats the first
+    periodic - True if the source covers all longitudes
+    """
+
+    def __init__(self, lon, lat, check=True):
+        """Constructor for UniformSource:
+        lon   - longitudes of the source (1d or 2d)
+        lat   - latitudes of the source (1d or 2d)
+        check - check that the source is uniform
+        """
+        if isinstance(lon, coordutils.PeriodicLongitude):
+            # A periodic view of a global source is uniform if the original
+            # longitudes are.  Only the few values used below are computed.
+            if check: assert is_mesh_uniform(lon.lon,lat), 'Grid (lon,lat) is not uniform, this method will not work properly'
+        else:
+            if check: assert is_mesh_uniform(lon,lat), 'Grid (lon,lat) is not uniform, this method will not work properly'
+            if len(lon.shape)==2:
+                # Convert to 1D arrays
+                lon,lat = lon[0,:],lat[:,0]
+            lon = np.asarray(lon)
+        self.lon,self.lat = lon,np.asarray(lat)
+        sni,snj = lon.shape[0],self.lat.shape[0] # Shape of source
+        self.shape = (snj,sni)
+        # Spacing on uniform mesh
+        dellon, dellat = (lon[-1]-lon[0])/(sni-1), (self.lat[-1]-self.lat[0])/(snj-1)
+        # Convert to numbers
+        self.dlon = float(dellon)
+        self.dlat = float(dellat)
+        self.lon0 = float(lon[0])
+        self.lat0 = float(self.lat[0])
+        self.repeated = bool(abs( (lon[-1]-lon[0])-360 )<=360.*np.finfo( lon.dtype ).eps)
+        self.periodic = self.repeated or bool(abs( sni*self.dlon-360 )<=360.*np.finfo( lon.dtype ).eps*sni)
+        if self.repeated:
+            logging.getLogger(__name__).debug("Detected repeated longitude %g %g", lon[0], lon[-1])
+
+    def __repr__(self):
+        return '<UniformSource nj:%i ni:%i dlon:%g dlat:%g periodic:%s>'%(self.shape[0],self.shape[1],self.dlon,self.dlat,self.periodic)
+
+    @staticmethod
+    def of(xs, ys):
+        """Returns xs if it is a UniformSource, otherwise a UniformSource for (xs,ys)"""
+        if isinstance(xs, UniformSource): return xs
+        return UniformSource(xs, ys)
+
+    def window(self, js, is_):
+        """Returns a UniformSource for the window of slices (js,is_) of this source.
+           The coordinates of the window are extracted, the window is not checked again."""
+        return UniformSource(self.lon[is_], self.lat[js], check=False)
+
+    def nearest(self, lon, lat, kernels=None):
+        """Returns the i,j arrays for the indexes of the nearest neighbor point to (lon,lat).
+           kernels is the meshkernels.Kernels used, meshkernels.DEFAULT if None."""
+        kernels = kernels or meshkernels.DEFAULT
+        sni,snj = self.shape[1],self.shape[0]
+        dellon,dellat = self.dlon,self.dlat
+        if self.repeated:
+            sni-=1 # Account for repeated longitude
+        if kernels.enabled():
+            lon,lat = np.asarray(lon, dtype=np.float64),np.asarray(lat, dtype=np.float64)
+            nn_i,nn_j = np.empty(lon.shape, dtype=int),np.empty(lat.shape, dtype=int)
+            bad = kernels.kernel('nearest')(np.atleast_2d(lon), np.atleast_2d(lat), self.lon0, self.lat0,
+                dellon, dellat, sni, snj, np.atleast_2d(nn_i), np.atleast_2d(nn_j))
+            assert bad==0, 'Invalid index calculated for '+str(bad)+' points'
+            return nn_i,nn_j
+        # Nearest integer (the upper one if equidistant)
+        nn_i = np.floor(np.mod(lon-self.lon0+0.5*dellon,360)/dellon)
+        nn_j = np.floor(0.5+(lat-self.lat0)/dellat)
+        nn_i = np.minimum(nn_i, sni-1)
+        nn_j = np.minimum(nn_j, snj-1)
+        nn_i = np.maximum(nn_i, 0)
+        nn_j = np.maximum(nn_j, 0)
+        assert nn_j.min()>=0, 'Negative j index calculated! j='+str(nn_j.min())
+        assert nn_j.max()<snj, 'Out of bounds j index calculated! j='+str(nn_j.max())+'snj='+str(snj)
+        assert nn_i.min()>=0, 'Negative i index calculated! i='+str(nn_i.min())
+        assert nn_i.max()<sni, 'Out of bounds i index calculated! i='+str(nn_i.max())+'sni='+str(sni)
+        return nn_i.astype(int),nn_j.astype(int)
+
+class SourceCoverage(object):
+    """Records the cells of a uniform source hit by the nodes of a mesh, stage by stage.
+
+    The record is a uint8 array the size of the source holding the last stage that hit each
+    cell.  Starting a new stage does not clear the array, so counting the cells hit by a stage
+    costs in proportion to the number of mesh nodes rather than the size of the source.
+
+    Attributes:
+
+    source - the UniformSource
+    size   - number of source cells
+    stage  - current stage, starting at 1
+    nhits  - number of cells hit in the current stage
+    newly  - number of cells hit in the current stage that were never hit before
+    """
+
+    # Cells near the poles that are always counted as hit
+    SINGULAR = 255
+
+    def __init__(self, source, singularity_radius=0.25):
+        self.source = source
+        self.mask = np.zeros(source.shape, dtype=np.uint8)
+        if singularity_radius>0: self.mask[np.abs(source.lat)>90-singularity_radius] = SourceCoverage.SINGULAR
+        self.singular = int(np.count_nonzero(self.mask))
+        self.size = self.mask.size
+        self.stage = 0
+        self.nhits = self.singular
+        self.newly = 0
+
+    def new_stage(self):
+        """Starts a new stage with no cells hit other than the singular cells"""
+        if self.stage+1 >= SourceCoverage.SINGULAR:
+            # Renumber the stages, cells hit earlier are kept as hit before
+            self.mask[(self.mask>0) & (self.mask<SourceCoverage.SINGULAR)] = 1
+            self.stage = 1
+        self.stage += 1
+        self.nhits = self.singular
+        self.newly = 0
+
+    def add(self, i, j):
+        """Marks the source cells (j,i) as hit in the current stage.  Returns the number of cells
+           newly hit in this stage."""
+        flat = self.mask.reshape(-1)
+        f = (np.asarray(j)*self.mask.shape[1] + np.asarray(i)).ravel()
+        f = f[(flat[f]!=self.stage) & (flat[f]!=SourceCoverage.SINGULAR)]
+        f = np.unique(f)
+        self.newly += int(np.count_nonzero(flat[f]==0))
+        flat[f] = self.stage
+        self.nhits += f.size
+        return f.size
+
+    def add_mesh(self, mesh):
+        """Marks the source cells nearest to the nodes of mesh as hit in the current stage"""
+        i,j = mesh.find_nn_uniform_source(self.source)
+        return self.add(i, j)
+
+    def all(self):
+        """Returns True if all the source cells are hit in the current stage"""
+        return self.nhits == self.size
+
+    def hits(self):
+        """Returns a uint8 mask of 1's for the source cells hit in the current stage"""
+        return ((self.mask==self.stage) | (self.mask==SourceCoverage.SINGULAR)).astype(np.uint8)
+
+class Workspace(object):
+    """Reusable scratch arrays for refineby2().
+
+    Each named buffer is a flat float64 array that only grows.  A buffer asked for with a smaller
+    shape is returned as a view of the start of the array, so one workspace passed through the
+    stages of a refinement, or through the bands of a streamed refinement, allocates its scratch
+    arrays once at the size of the finest mesh.
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, name, shape):
+        """Returns an uninitialized float64 array of shape from buffer name"""
+        n = int(np.prod(shape))
+        buf = self.buffers.get(name)
+        if buf is None or buf.size < n:
+            buf = np.empty(n)
+            self.buffers[name] = buf
+        return buf[:n].reshape(shape)
+
 class MeshRefinement(object):
     """Describes 2D meshes for ESMs.
 
@@ -45,10 +236,16 @@ class MeshRefinement(object):
     nj    - number of cells in j-direction (first)
     lon   - longitude of mesh (cell corners), shape (nj+1,ni=1)
     lat   - latitude of mesh (cell corners), shape (nj+1,ni=1)
+    xyz   - 3d coordinates (X,Y,Z) of the mesh nodes kept by refineby2() or None
     area  - area of cells, shape (nj,ni)
+    kernels - meshkernels.Kernels used by the mesh and its refinements
+
+    Meshes made by refineby2() hold their nodes in 3d and compute (lon,lat) the first time
+    they are used.  The 3d coordinates are then dropped and the next refinement starts from
+    (lon,lat), as the original lon/lat round trip did.
     """
 
-    def __init__(self, shape=None, lon=None, lat=None, area=None, lon0=-180., from_cell_center=False, rfl=0):
+    def __init__(self, shape=None, lon=None, lat=None, area=None, lon0=-180., from_cell_center=False, rfl=0, xyz=None, workspace=None, kernels=None):
         """Constructor for Mesh:
         shape - shape of cell array, (nj,ni)
         ni    - number of cells in i-direction (last index)
@@ -58,7 +255,21 @@ class MeshRefinement(object):
         area  - area of cells (2d)
         lon0  - used when generating a spherical grid in absence of (lon,lat)
         rfl   - refining level of this mesh
+        xyz   - 3d coordinates (X,Y,Z) of the mesh nodes (2d) used in place of (lon,lat)
+        workspace - Workspace for scratch arrays
+        kernels - meshkernels.Kernels, meshkernels.DEFAULT if None
         """
+        self._lon, self._lat, self.xyz = None, None, None
+        self.workspace = workspace
+        self.kernels = kernels or meshkernels.DEFAULT
+        if xyz is not None:
+            (nj,ni) = xyz[0].shape
+            self.ni, self.nj = ni-1, nj-1
+            self.shape = (nj-1,ni-1)
+            self.xyz = xyz
+            self.area = None
+            self.rfl = rfl
+            return
         if (shape is None) and (lon is None) and (lat is None): raise Exception('Either shape must be specified or both lon and lat')
         if (lon is None) and (lat is not None): raise Exception('Either shape must be specified or both lon and lat')
         if (lon is not None) and (lat is None): raise Exception('Either shape must be specified or both lon and lat')
@@ -115,6 +326,30 @@ class MeshRefinement(object):
 
         self.rfl = rfl #refining level
 
+    @property
+    def lon(self):
+        if self._lon is None and self.xyz is not None: self.__to_lonlat()
+        return self._lon
+
+    @lon.setter
+    def lon(self, value):
+        if self._lat is None and self.xyz is not None: self.__to_lonlat()
+        self._lon, self.xyz = value, None
+
+    @property
+    def lat(self):
+        if self._lat is None and self.xyz is not None: self.__to_lonlat()
+        return self._lat
+
+    @lat.setter
+    def lat(self, value):
+        if self._lon is None and self.xyz is not None: self.__to_lonlat()
+        self._lat, self.xyz = value, None
+
+    def compact(self):
+        """Drops the 3d coordinates of the nodes if (lon,lat) are held"""
+        if self._lon is not None: self.xyz = None
+
     def __repr__(self):
         return '<MeshRefinement nj:%i ni:%i shape:(%i,%i)>'%(self.nj,self.ni,self.shape[0],self.shape[1])
 
@@ -153,41 +388,62 @@ class MeshRefinement(object):
         lon = np.where( Y>=0, lon, -lon ) # Handle -180 .. 0
         return lon,lat
 
-    def refineby2(self, work_in_3d=True):
-        """Returns new Mesh instance with twice the resolution"""
-
-        def local_refine(A):
-            """Retruns a refined variable a with shape (2*nj-1,2*ni-1) by linearly interpolation A with shape (nj,ni)."""
-            nj,ni = A.shape
-            a = np.zeros( (2*nj-1,2*ni-1) )
+    def __to_lonlat(self):
+        """Private method. Sets (lon,lat) from the 3d coordinates of the nodes.  This is
+           __XYZ_to_lonlat() computed in place with one scratch array."""
+        X,Y,Z = self.xyz
+        rad2deg = 180./np.pi
+        lon, lat = np.empty(X.shape), np.empty(X.shape)
+        T = (self.workspace or Workspace()).get('T', X.shape)
+        np.arcsin(Z, out=lat) ; lat *= rad2deg # -90 .. 90
+        # Normalize X,Y to unit circle
+        sub_roundoff = 2./np.finfo(X[0,0]).max
+        np.multiply(X, X, out=lon) ; np.multiply(Y, Y, out=T) ; lon += T
+        np.sqrt(lon, out=lon) ; lon += sub_roundoff ; np.divide(1., lon, out=lon)
+        lon *= X ; np.arccos(lon, out=lon) ; lon *= rad2deg # 0 .. 180
+        np.negative(lon, out=lon, where=(Y<0)) # Handle -180 .. 0
+        # Further refinement and searches start from the snapped (lon,lat)
+        self._lon, self._lat, self.xyz = lon, lat, None
+
+    def refineby2(self, work_in_3d=True, workspace=None):
+        """Returns new Mesh instance with twice the resolution.
+           workspace is a Workspace for the scratch arrays, reused by the new mesh."""
+        workspace = workspace or self.workspace or Workspace()
+        nj,ni = self.nj+1, self.ni+1
+
+        def local_refine(A, a):
+            """Sets a with shape (2*nj-1,2*ni-1) by linearly interpolation A with shape (nj,ni)."""
             a[::2,::2] = A[:,:] # Shared nodes
-            a[::2,1::2] = 0.5 * ( A[:,:-1] + A[:,1:] ) # Mid-point along i-direction on original mesh
-            a[1::2,::2] = 0.5 * ( A[:-1,:] + A[1:,:] ) # Mid-point along j-direction on original mesh
-            a[1::2,1::2] = 0.25 * ( ( A[:-1,:-1] + A[1:,1:] ) + ( A[1:,:-1] + A[:-1,1:] ) ) # Mid-point of cell on original mesh
-            return a
+            c = a[::2,1::2] ; np.add( A[:,:-1], A[:,1:], out=c ) ; c *= 0.5 # Mid-point along i-direction on original mesh
+            c = a[1::2,::2] ; np.add( A[:-1,:], A[1:,:], out=c ) ; c *= 0.5 # Mid-point along j-direction on original mesh
+            c = a[1::2,1::2] ; s = workspace.get('T', (nj-1,ni-1)) # Mid-point of cell on original mesh
+            np.add( A[:-1,:-1], A[1:,1:], out=c ) ; np.add( A[1:,:-1], A[:-1,1:], out=s ) ; c += s ; c *= 0.25
 
         if work_in_3d:
-            # Calculate 3d coordinates of nodes (X,Y,Z), Z points along pole, Y=0 at lon=0,180, X=0 at lon=+-90
+            # 3d coordinates of nodes (X,Y,Z), Z points along pole, Y=0 at lon=0,180, X=0 at lon=+-90
+            # The nodes are always taken from (lon,lat) so that each stage reproduces the lon/lat
+            # round trip of the original refinement bit for bit.
             X,Y,Z = MeshRefinement.__lonlat_to_XYZ(self.lon, self.lat)
 
-            # Refine mesh in 3d and project onto sphere
-            X,Y,Z = local_refine(X), local_refine(Y), local_refine(Z)
-            R = 1. / np.sqrt((X*X + Y*Y) + Z*Z)
-            X,Y,Z = R*X, R*Y, R*Z
-
-            # Normalize X,Y to unit circle
-            #sub_roundoff = 2./np.finfo(X[0,0]).max
-            #R = 1. / ( np.sqrt(X*X + Y*Y) + sub_roundoff )
-            #X = R * X
-            #Y = R * Y
-
-            # Convert from 3d to spherical coordinates
-            lon,lat = MeshRefinement.__XYZ_to_lonlat(X, Y, Z)
-
-        else:
-            lon,lat = local_refine(self.lon), local_refine(self.lat)
-
-        return MeshRefinement(lon=lon, lat=lat, rfl=self.rfl+1)
+            # Refine mesh in 3d and project onto sphere, the refined mesh stays in 3d
+            xyz = np.empty( (3,2*nj-1,2*ni-1) )
+            if self.kernels.enabled():
+                self.kernels.kernel('refine_xyz')(np.asarray(X, dtype=np.float64), np.asarray(Y, dtype=np.float64),
+                    np.asarray(Z, dtype=np.float64), xyz)
+                return MeshRefinement(xyz=xyz, rfl=self.rfl+1, workspace=workspace, kernels=self.kernels)
+            local_refine(X, xyz[0]) ; local_refine(Y, xyz[1]) ; local_refine(Z, xyz[2])
+            X,Y,Z = xyz
+            R, T = workspace.get('R', X.shape), workspace.get('T', X.shape)
+            np.multiply(X, X, out=R) ; np.multiply(Y, Y, out=T) ; R += T
+            np.multiply(Z, Z, out=T) ; R += T
+            np.sqrt(R, out=R) ; np.divide(1., R, out=R)
+            X *= R ; Y *= R ; Z *= R
+
+            return MeshRefinement(xyz=xyz, rfl=self.rfl+1, workspace=workspace, kernels=self.kernels)
+
+        lon,lat = np.empty( (2*nj-1,2*ni-1) ), np.empty( (2*nj-1,2*ni-1) )
+        local_refine(self.lon, lon) ; local_refine(self.lat, lat)
+        return MeshRefinement(lon=lon, lat=lat, rfl=self.rfl+1, workspace=workspace, kernels=self.kernels)
 
     def rotate(self, y_rot=0, z_rot=0):
         """Sequentially apply a rotation about the Y-axis and then the Z-axis."""
@@ -211,6 +467,16 @@ class MeshRefinement(object):
         if(self.rfl == 0):
             raise Exception('Coarsest grid, no more coarsening possible!')
 
+        if self.kernels.enabled() and getattr(self, 'moments', None) is not None:
+            shape = self.height[::2,::2].shape
+            coarser_mesh.height, coarser_mesh.h_min, coarser_mesh.h_max = np.empty(shape), np.empty(shape), np.empty(shape)
+            coarser_mesh.set_moments(np.empty((len(MeshRefinement.MOMENTS),)+shape))
+            self.kernels.kernel('coarsen')(self.height, coarser_mesh.height, coarser_mesh.h_min, coarser_mesh.h_max,
+                self.moments, coarser_mesh.moments)
+            coarser_mesh.h_std = np.zeros(coarser_mesh.height.shape)
+            coarser_mesh.zm = coarser_mesh.height
+            return
+
         coarser_mesh.height = np.copy(self.height[::2,::2])
         coarser_mesh.height[:-1,:-1] = 0.25*(self.height[:-1:2,:-1:2]
                                            + self.height[1::2,1::2]
@@ -237,22 +503,22 @@ class MeshRefinement(object):
         coarser_mesh.xzm = fourPointAve(self.xzm)
         coarser_mesh.yzm = fourPointAve(self.yzm)
 
+    # Moments averaged by coarsenby2(), held in one array by the compiled kernels
+    MOMENTS = ['xm', 'ym', 'xxm', 'yym', 'xym', 'xzm', 'yzm']
+
+    def set_moments(self, moments):
+        """Sets the moments (xm,ym,...) as views of the array moments, shape (7,nj+1,ni+1)"""
+        self.moments = moments
+        for k,name in enumerate(MeshRefinement.MOMENTS):
+            setattr(self, name, moments[k])
+
     def mdist(x1,x2):
         """Returns positive distance modulo 360."""
         return np.minimum( np.mod(x1-x2,360.), np.mod(x2-x1,360.) )
 
-    def find_nn_uniform_source(self, lon, lat):
-        """Returns the i,j arrays for the indexes of the nearest neighbor point to grid (lon,lat)"""
-        assert is_mesh_uniform(lon,lat), 'Grid (lon,lat) is not uniform, this method will not work properly'
-        if len(lon.shape)==2:
-            # Convert to 1D arrays
-            lon,lat = lon[0,:],lat[:,0]
-        sni,snj =lon.shape[0],lat.shape[0] # Shape of source
-        # Spacing on uniform mesh
-        dellon, dellat = (lon[-1]-lon[0])/(sni-1), (lat[-1]-lat[0])/(snj-1)
-        # Convert to numbers
-        dellon = dellon.data.tolist()
-        dellat = dellat.data.tolist()
+    def find_nn_uniform_source(self, lon, lat=None):
+        """Returns the i,j arrays for the indexes of the nearest neighbor point to grid (lon,lat).
+           lon may be a UniformSource describing the grid, lat is then not used."""
 #original
 #        assert self.lat.max()<=lat.max()+0.5*dellat, 'Mesh has latitudes above range of regular grid '+str(self.lat.max())+' '+str(lat.max()+0.5*dellat)
 #        assert self.lat.min()>=lat.min()-0.5*dellat, 'Mesh has latitudes below range of regular grid '+str(self.lat.min())+' '+str(lat.min()-0.5*dellat)
@@ -260,69 +526,121 @@ class MeshRefinement(object):
 #        assert self.lat.max()>=lat.max()-0.5*dellat, 'Source has latitudes above range of target mesh '+str(self.lat.max())+' '+str(lat.max()-0.5*dellat)
 #        assert self.lat.min()<=lat.min()+0.5*dellat, 'Source has latitudes below range of target mesh '+str(self.lat.min())+' '+str(lat.min()+0.5*dellat)
 #neither works for bipole
-
-        if abs( (lon[-1]-lon[0])-360 )<=360.*np.finfo( lon.dtype ).eps:
-            print("Detected repeated longitude ",lon[0],lon[-1])
-            sni-=1 # Account for repeated longitude
-        # Nearest integer (the upper one if equidistant)
-        #pdb.set_trace()
-        #nn_i = np.floor(np.mod(self.lon-lon[0]+0.5*dellon,360)/dellon)
-        #nn_j = np.floor(0.5+(self.lat-lat[0])/dellat)
-        nn_i = np.floor(np.mod(self.lon-lon[0].data.tolist()+0.5*dellon,360)/dellon)
-        nn_j = np.floor(0.5+(self.lat-lat[0].data.tolist())/dellat)
-        nn_i = np.minimum(nn_i, sni-1)
-        nn_j = np.minimum(nn_j, snj-1)
-        nn_i = np.maximum(nn_i, 0)
-        nn_j = np.maximum(nn_j, 0)
-        assert nn_j.min()>=0, 'Negative j index calculated! j='+str(nn_j.min())
-        assert nn_j.max()<snj, 'Out of bounds j index calculated! j='+str(nn_j.max())+'snj='+str(snj)
-        assert nn_i.min()>=0, 'Negative i index calculated! i='+str(nn_i.min())
-        assert nn_i.max()<sni, 'Out of bounds i index calculated! i='+str(nn_i.max())+'sni='+str(sni)
-        return nn_i.astype(int),nn_j.astype(int)
-
-    def source_hits(self, xs, ys, singularity_radius=0.25):
-        """Returns an mask array of 1's if a cell with center (xs,ys) is intercepted by a node
-           on the mesh, 0 if no node falls in a cell"""
+        return UniformSource.of(lon, lat).nearest(self.lon, self.lat, kernels=self.kernels)
+
+    def cell_search(self, k=8):
+        """Returns the search structure used by find_cells(): the normals of the great circles
+           through the cell edges and a tree of the cell centers.  It is made once and passed to
+           find_cells() as search to look up several sources, such as the bands of a source, in
+           the same mesh."""
+        from scipy.spatial import cKDTree
+        nj,ni = self.shape
+        # Corners of each cell in 3d in order around the cell
+        X,Y,Z = MeshRefinement.__lonlat_to_XYZ(self.lon, self.lat)
+        V = np.stack((X,Y,Z), axis=-1)
+        corners = np.stack((V[:-1,:-1], V[:-1,1:], V[1:,1:], V[1:,:-1]), axis=2).reshape((nj*ni,4,3))
+        # Normals of the great circles through each edge
+        normals = np.cross(corners, np.roll(corners, -1, axis=1))
+        return {'normals': normals, 'tree': cKDTree(corners.mean(axis=1)), 'k': min(k, nj*ni)}
+
+    def find_cells(self, xs, ys=None, k=8, search=None):
+        """Returns the j,i arrays of the indexes of the mesh cell containing each point (xs,ys)
+           of a uniform source, shape (ys.size,xs.size).  Points outside the mesh are given
+           index -1.  Cell edges are taken as great circles, as in refineby2().
+           xs may be a UniformSource describing the source, ys is then not used.
+           search is the structure made by cell_search(), made with k if None."""
+        src = UniformSource.of(xs, ys)
+        xs,ys = src.lon,src.lat
+        nj,ni = self.shape
+        if search is None:
+            search = self.cell_search(k=k)
+        normals, k = search['normals'], search['k']
+        # Source points in 3d
+        lon,lat = np.meshgrid(np.asarray(xs), np.asarray(ys))
+        P = np.stack(MeshRefinement.__lonlat_to_XYZ(lon.ravel(), lat.ravel()), axis=-1)
+        cell = np.full(P.shape[0], -1)
+        # Test the nearest cell centers until a containing cell is found
+        dist,candidates = search['tree'].query(P, k=k)
+        candidates = candidates.reshape((P.shape[0],k))
+        for n in range(0,k):
+            todo = np.nonzero(cell<0)[0]
+            if todo.size==0: break
+            c = candidates[todo,n]
+            side = np.einsum('pec,pc->pe', normals[c], P[todo])
+            # Either orientation of the corners, degenerate cells have no inside
+            inside = (np.all(side>=0, axis=1) & np.any(side>0, axis=1)) |\
+                     (np.all(side<=0, axis=1) & np.any(side<0, axis=1))
+            cell[todo[inside]] = c[inside]
+        j = np.where(cell<0, -1, cell//ni)
+        i = np.where(cell<0, -1, cell%ni)
+        return j.reshape(lon.shape), i.reshape(lon.shape)
+
+    def source_hits(self, xs, ys=None, singularity_radius=0.25):
+        """Returns an mask array (uint8) of 1's if a cell with center (xs,ys) is intercepted by a node
+           on the mesh, 0 if no node falls in a cell.
+           xs may be a UniformSource describing the source, ys is then not used."""
+        coverage = SourceCoverage(UniformSource.of(xs, ys), singularity_radius=singularity_radius)
+        coverage.new_stage()
         # Indexes of nearest xs,ys to each node on the mesh
-        i,j = self.find_nn_uniform_source(xs,ys)
-        sni,snj = xs.shape[0],ys.shape[0] # Shape of source
-        hits = np.zeros((snj,sni))
-        if singularity_radius>0: hits[np.abs(ys)>90-singularity_radius] = 1
-        hits[j,i] = 1
-        return hits
-
-    def refine_loop(self, src_lon, src_lat, max_stages=32, max_mb=500, verbose=True, singularity_radius=0.25):
+        coverage.add_mesh(self)
+        return coverage.hits()
+
+    def refine_loop(self, src_lon, src_lat=None, max_stages=32, max_mb=500, verbose=True, singularity_radius=0.25):
         """Repeatedly refines the mesh until all cells in the source grid are intercepted by mesh nodes.
-           Returns a list of the refined meshes starting with parent mesh."""
-        Mesh_list, this = [self], self
-        hits = this.source_hits(src_lon, src_lat, singularity_radius=singularity_radius)
-        nhits, prev_hits, mb = hits.sum().astype(int), 0, 2*8*this.shape[0]*this.shape[1]/1024/1024
-        if verbose: print(this, 'Hit', nhits, 'out of', hits.size, 'cells (%.4f'%mb,'Mb)')
+           Returns a list of the refined meshes starting with parent mesh.
+           src_lon may be a UniformSource describing the source, src_lat is then not used."""
+        # Describe and check the source once for all stages.  The hits of
+        # each stage are counted without summing over the source.
+        coverage = SourceCoverage(UniformSource.of(src_lon, src_lat), singularity_radius=singularity_radius)
+        Mesh_list, this, workspace = [self], self, Workspace()
+        coverage.new_stage()
+        coverage.add_mesh(this)
+        nhits, prev_hits, mb = coverage.nhits, 0, 2*8*this.shape[0]*this.shape[1]/1024/1024
+        if verbose: print(this, 'Hit', nhits, 'out of', coverage.size, 'cells (%.4f'%mb,'Mb)')
         # Conditions to refine
         # 1) Not all cells are intercepted
         # 2) A refinement intercepted more cells
-        converged = np.all(hits) or (nhits==prev_hits)
+        converged = coverage.all() or (nhits==prev_hits)
         while(not converged and len(Mesh_list)<max_stages and 4*mb<max_mb):
-            this = this.refineby2()
-            hits = this.source_hits(src_lon, src_lat, singularity_radius=singularity_radius)
-            nhits, prev_hits, mb = hits.sum().astype(int), nhits, 2*8*this.shape[0]*this.shape[1]/1024/1024
-            converged = np.all(hits) or (nhits==prev_hits)
+            parent, this = this, this.refineby2(workspace=workspace)
+            coverage.new_stage()
+            coverage.add_mesh(this)
+            parent.compact()
+            nhits, prev_hits, mb = coverage.nhits, nhits, 2*8*this.shape[0]*this.shape[1]/1024/1024
+            # Round off in the refinement can lose a hit; stop refining so
+            # that every mesh in the list is a refinement of the previous one
+            converged = coverage.all() or (nhits<=prev_hits)
             if nhits>prev_hits:
                 Mesh_list.append( this )
-                if verbose: print(this, 'Hit', nhits, 'out of', hits.size, 'cells (%.4f'%mb,'Mb)')
+                if verbose: print(this, 'Hit', nhits, 'out of', coverage.size, 'cells (%.4f'%mb,'Mb)')
 
         if not converged:
             print("Warning: Maximum number of allowed refinements reached without all source cells hit.")
+        this.compact()
 
         return Mesh_list
 
     def sample_source_data_on_target_mesh(self,xs,ys,zs):
-        """Returns the array on target mesh with values equal to the nearest-neighbor source point data"""
+        """Returns the array on target mesh with values equal to the nearest-neighbor source point data.
+           xs may be a UniformSource describing the source, ys is then not used."""
+        src = UniformSource.of(xs, ys)
+        xs,ys = src.lon,src.lat
         # Indexes of nearest xs,ys to each node on the mesh
-        i,j = self.find_nn_uniform_source(xs,ys)
+        i,j = self.find_nn_uniform_source(src)
+        if self.kernels.enabled():
+            zs = np.asarray(zs)
+            shape = self.lon.shape
+            self.height, self.zm = np.empty(shape), np.empty(shape)
+            self.set_moments(np.empty((len(MeshRefinement.MOMENTS),)+shape))
+            self.kernels.kernel('sample')(zs, np.asarray(xs), ys, i, j, self.height, self.xm, self.ym, self.zm,
+                self.xxm, self.yym, self.xym, self.xzm, self.yzm)
+            self.h_std = np.zeros(shape)
+            self.h_min = np.zeros(shape)
+            self.h_max = np.zeros(shape)
+            return
         self.height = np.zeros(self.lon.shape)
         #self.height[:,:] = zs[j[:],i[:]]
-        self.height[:,:] = zs.data[j[:],i[:]]
+        self.height[:,:] = np.asarray(zs)[j[:],i[:]]
         self.h_std = np.zeros(self.lon.shape)
         self.h_min = np.zeros(self.lon.shape)
         self.h_max = np.zeros(self.lon.shape)
@@ -337,9 +655,9 @@ class MeshRefinement(object):
         self.xzm = np.zeros(self.lon.shape)
         self.yzm = np.zeros(self.lon.shape)
         #self.xm[:,:] = xs[i[:]]
-        self.xm[:,:] = xs.data[i[:]]
+        self.xm[:,:] = np.asarray(xs)[i[:]]
         #self.ym[:,:] = ys[j[:]]
-        self.ym[:,:] = ys.data[j[:]]
+        self.ym[:,:] = np.asarray(ys)[j[:]]
         # We just need a copy here
         #self.zm[:,:] = zs[j[:],i[:]]
         self.zm = self.height.copy()
@@ -360,17 +678,19 @@ class MeshRefinement(object):
         """h  is estiamted as the value of plane for z calculated at the corner of the grid cell."""
 
         epsilon=1.0e-5
+        src = UniformSource.of(xs, ys)
+        xs,ys,zs = np.asarray(src.lon),src.lat,np.asarray(zs)
         #indices of nearest neighbor source point to each target mesh point
-        ti,tj = self.find_nn_uniform_source(xs,ys)
+        ti,tj = self.find_nn_uniform_source(src)
 
-        #Initialize with nans as missing values
-        #This will leave some mesh point values as nans
-        Zmean=np.empty(self.lon.shape)*np.nan
-        Zmin =np.empty(self.lon.shape)*np.nan
-        Zmax =np.empty(self.lon.shape)*np.nan
-        Zstd =np.empty(self.lon.shape)*np.nan
+        #Initialize to the NN source value. Reasonable?
+        znn = zs[tj,ti]
+        Zmean = znn.astype(float)
+        Zmin  = znn.astype(float)
+        Zmax  = znn.astype(float)
+        Zstd  = np.zeros(self.lon.shape)
 
-        #Loop over each grid cell. Is there a numpy way of doing this?
+        #bounds of each target cell and of the indexes of the NN source cells
         dlon=np.roll(self.lon,shift=-1,axis=1)-self.lon
         dlat=np.roll(self.lat,shift=-1,axis=0)-self.lat
         dti =np.roll(ti,shift=-1,axis=1)-ti
@@ -379,90 +699,73 @@ class MeshRefinement(object):
         dlon[:,-1]=dlon[:,-2]
         dlat[-1,:]=dlat[-2,:]
         dti[:,-1]=dti[:,-2]
-        #print(dtj)
         dtj[-1,:]=dtj[-2,:]
-        #print(dtj)
-        for J in range(0,self.lat.shape[0]):
-            for I in range(0,self.lon.shape[1]):
-                #Initialize to the NN source value. Reasonable?
-                znn=zs[tj[J,I],ti[J,I]]
-                Zmean[J,I]= znn
-                Zmin[J,I] = znn
-                Zmax[J,I] = znn
-                Zstd[J,I] = 0.0
-
-                #bounds of a target cell
-                lon_min=self.lon[J,I]
-                lon_max=lon_min+dlon[J,I]
-                lat_min=self.lat[J,I]
-                lat_max=lat_min+dlat[J,I]
-                #bounds of indexes of NN source cell
-                tj_min=tj[J,I]
-                tj_max=tj_min+dtj[J,I]
-                ti_min=ti[J,I]
-                ti_max=ti_min+dti[J,I]
-                ti_max=min(ti_max,xs.shape[0]-1)
-                tj_max=min(tj_max,ys.shape[0]-1)
-                #We don't know how many data points are in each grid cell. Let's say it's M.
-                #According to the algorithm, we need to create
-                X=[]
-                Y=[]
-                Z=[]
-                #print('J,I ',J,I)
-                #print(lon_min,lon_max)
-                #print(ti_min,ti_max)
-                #print(lat_min,lat_max)
-                #print(tj_min,tj_max,dtj[J,I])
-                for jj in range(tj_min,tj_max+1):
-                    #print(ys[jj],lat_min,lat_max)
-                    if((ys[jj]>=lat_min) and (ys[jj]<lat_max)):
-                        for ii in range(ti_min,ti_max+1):
-                            if(xs[ii] >= lon_min and xs[ii] < lon_max):
-                                #print('jj,ii',jj,ii)
-                                X.append(np.array(xs[ii]))
-                                Y.append(np.array(ys[jj]))
-                                Z.append(np.array(zs[jj,ii]))
-                #print(len(Z))
-                if(len(Z)==0):
-                    continue
-                #cast these in numpy arrays
-                X = np.asarray(X)
-                Y = np.asarray(Y)
-                Z = np.asarray(Z)
-                #The algorithm fits a plane z=P(x,y) by minimizing \sum_i (z_i - P(x_i,y_i))
-                #It shows that
-                #1. P is of the form P = zm + ax*(x-xm) + ay*(y-ym),
-                #                    xm,ym,zm being the means of data x_i,y_i,z_i respectively
-                #     I.e., the least square plane passes through the point (xm,ym,zm)
-                #2. It gives the following formula for ax and ay (solution of 2by2 linear system)
-
-                N=X.size
-                xm=np.sum(X)/N
-                ym=np.sum(Y)/N
-                zm=np.sum(Z)/N
-                sxx=np.dot(X-xm,X-xm)#/N
-                syy=np.dot(Y-ym,Y-ym)#/N
-                sxy=np.dot(X-xm,Y-ym)#/N
-                syz=np.dot(Y-ym,Z-zm)#/N
-                sxz=np.dot(X-xm,Z-zm)#/N
-
-                det=(sxx*syy-sxy*sxy)
-                if(abs(det) < epsilon): #No solutions
-                    continue
-                ax=(sxz*syy-syz*sxy)/det
-                ay=(syz*sxx-sxz*sxy)/det
-                d=Z-zm - ax*(X-xm) - ay*(Y-ym)
-
-                Zstd[J,I]=d.std()
-                #Zij[J,I] = zm + ax*(self.lon[J,I]-xm)+ay*(self.lat[J,I]-ym) #corner fit value
-                Zmean[J,I]= zm
-                Zmin[J,I] = Z.min()
-                Zmax[J,I] = Z.max()
-
-                #Check: The sum of Distances must be very small, almost zero
-                #assert abs(d.sum())<0.00001, "Bad fit: The sum of Distances is large at "+str(I)+","+str(J)+" = "+str(d.sum())+" compared to min  "+str(Zmin[J,I])
-                if(abs(d.sum())>epsilon):
-                    print("Bad fit: The sum of Distances is large at ("+str(I)+","+str(J)+") = "+str(d.sum())+" compared to min  "+str(Zmin[J,I]))
+        ti_max=np.minimum(ti+dti,xs.shape[0]-1)
+        tj_max=np.minimum(tj+dtj,ys.shape[0]-1)
+
+        #The source points of a cell are those in the NN index bounds that are
+        #also in [lon_min,lon_max) x [lat_min,lat_max).  For a uniform source
+        #these form a rectangle [j0,j1) x [i0,i1) of source indexes.
+        i0,i1 = index_range(xs, self.lon, self.lon+dlon)
+        j0,j1 = index_range(ys, self.lat, self.lat+dlat)
+        i0,i1 = np.maximum(i0,ti).ravel(), np.minimum(i1,ti_max+1).ravel()
+        j0,j1 = np.maximum(j0,tj).ravel(), np.minimum(j1,tj_max+1).ravel()
+        nI,nJ = np.maximum(i1-i0,0), np.maximum(j1-j0,0)
+        N = nI*nJ
+
+        #Gather the source points of all cells, ordered by cell
+        cells = np.nonzero(N>0)[0]
+        if cells.size==0:
+            return Zstd,Zmean,Zmin,Zmax
+        Nc = N[cells]
+        cell = np.repeat(np.arange(cells.size), Nc)
+        start = np.cumsum(Nc)-Nc
+        k = np.arange(cell.size)-start[cell]
+        jj = j0[cells][cell] + k//nI[cells][cell]
+        ii = i0[cells][cell] + k%nI[cells][cell]
+        X,Y,Z = xs[ii],ys[jj],zs[jj,ii]
+
+        #The algorithm fits a plane z=P(x,y) by minimizing \sum_i (z_i - P(x_i,y_i))
+        #It shows that
+        #1. P is of the form P = zm + ax*(x-xm) + ay*(y-ym),
+        #                    xm,ym,zm being the means of data x_i,y_i,z_i respectively
+        #     I.e., the least square plane passes through the point (xm,ym,zm)
+        #2. It gives the following formula for ax and ay (solution of 2by2 linear system)
+        def cellsum(w):
+            return np.bincount(cell, weights=w, minlength=cells.size)
+        xm=cellsum(X)/Nc
+        ym=cellsum(Y)/Nc
+        zm=cellsum(Z)/Nc
+        dX,dY,dZ = X-xm[cell],Y-ym[cell],Z-zm[cell]
+        sxx=cellsum(dX*dX)
+        syy=cellsum(dY*dY)
+        sxy=cellsum(dX*dY)
+        syz=cellsum(dY*dZ)
+        sxz=cellsum(dX*dZ)
+
+        det=(sxx*syy-sxy*sxy)
+        fit=(np.abs(det)>=epsilon) #No solutions otherwise
+        det=np.where(fit,det,1.0)
+        ax=(sxz*syy-syz*sxy)/det
+        ay=(syz*sxx-sxz*sxy)/det
+        d=dZ - ax[cell]*dX - ay[cell]*dY
+        dsum=cellsum(d)
+        dm=dsum/Nc
+        std=np.sqrt(cellsum((d-dm[cell])**2)/Nc)
+        zmin=np.minimum.reduceat(Z,start)
+        zmax=np.maximum.reduceat(Z,start)
+
+        fitted=cells[fit]
+        Zstd.flat[fitted]=std[fit]
+        #Zij = zm + ax*(self.lon-xm)+ay*(self.lat-ym) #corner fit value
+        Zmean.flat[fitted]=zm[fit]
+        Zmin.flat[fitted]=zmin[fit]
+        Zmax.flat[fitted]=zmax[fit]
+
+        #Check: The sum of Distances must be very small, almost zero
+        bad=fit & (np.abs(dsum)>epsilon)
+        if np.any(bad):
+            print("Bad fit: The sum of Distances is large in "+str(bad.sum())+" cells, at most "+str(np.abs(dsum[bad]).max()))
 
         return Zstd,Zmean,Zmin,Zmax
 
@@ -20,9 +20,10 @@ def writeLandmask(grd, dsData, dsVariable, outVariable, outFile, **kwargs):
 
     dsDataset = xr.Dataset()
     dsDataset[outVariable] = xr.where(dsData[dsVariable] <= masking_depth, 1.0, 0.0)
-    dsDataset[outVariable].attrs['sha256'] = utils.sha256sum(dsDataset[outVariable])
+    utils.hashVariable( dsDataset[outVariable] )
     dsDataset['x'] = dsData['x']
     dsDataset['y'] = dsData['y']
+    utils.resolveHashes(dsDataset)
     dsDataset.to_netcdf(outFile, encoding=grd.removeFillValueAttributes(data=dsDataset))
 
     return
@@ -44,7 +45,8 @@ def writeOceanmask(grd, dsData, dsVariable, outVariable, outFile, **kwargs):
 
     dsDataset = xr.Dataset()
     dsDataset[outVariable] = xr.where(dsData[dsVariable] > masking_depth, 1.0, 0.0)
-    dsDataset[outVariable].attrs['sha256'] = utils.sha256sum(dsDataset[outVariable])
+    utils.hashVariable( dsDataset[outVariable] )
     dsDataset['x'] = dsData['x']
     dsDataset['y'] = dsData['y']
+    utils.resolveHashes(dsDataset)
     dsDataset.to_netcdf(outFile, encoding=grd.removeFillValueAttributes(data=dsDataset))
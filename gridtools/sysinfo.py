@@ -1,9 +1,21 @@
-import os, sys, re
+import os, sys, re, copy
 import psutil, shlex, subprocess
-import logging
+import logging, threading
 from packaging.version import Version, parse
 from . import utils
 
+# Version data is collected once per process for each version mode and
+# package manager, see SysInfo.loadVersionData()
+_versionCache = dict()
+_versionCacheLock = threading.Lock()
+
+def clearVersionCache():
+    '''Discard version data cached for this process.  The next call to
+    :py:meth:`SysInfo.loadVersionData` collects it again.'''
+
+    with _versionCacheLock:
+        _versionCache.clear()
+
 class SysInfo(object):
     '''
     A small helper class to provide basic system information and misc
@@ -86,12 +98,8 @@ class SysInfo(object):
 
     def get_python_loaded_modules(self):
 
-        loadedModules = []
         # Take only the root elements
-        for mdl in list(sys.modules.keys()):
-            data = mdl.split('.')
-            if not(data[0] in loadedModules):
-                loadedModules.append(data[0])
+        loadedModules = dict.fromkeys([mdl.split('.')[0] for mdl in list(sys.modules.keys())])
         for mdl in loadedModules:
             if not(mdl) in self.loadedPackages:
                 try:
@@ -149,6 +157,8 @@ class SysInfo(object):
             * *packageManager* (``string``) Specify `conda` or `venv` as the
               package manager to use to show versions of installed software.
               Default: auto
+            * *refresh* (``boolean``) Collect version data again instead of
+              using the data cached for this process. Default: False
 
         .. note::
 
@@ -162,14 +172,19 @@ class SysInfo(object):
 
             The conda python module may be installed within the environment:
             `conda install -c conda-forge conda`
-        '''
 
-        # Do not allow this to run if it is already populated
-        if self.versionDataLoaded:
-            return
+            Scanning the environment is slow, so the result is cached for the
+            lifetime of the process.  Modules loaded after the first call are
+            only reported after a refresh.
+        '''
 
         usePackageManager = kwargs.pop('usePackageManager', False)
         packageManager = kwargs.pop('packageManager', 'auto')
+        refresh = kwargs.pop('refresh', False)
+
+        # Do not allow this to run if it is already populated
+        if self.versionDataLoaded and not(refresh):
+            return
 
         if usePackageManager:
             self.versionMode = 'installed'
@@ -177,12 +192,28 @@ class SysInfo(object):
             self.versionMode = 'loaded'
 
         if packageManager == 'auto':
-            pythonEnv = self.detectPythonEnvironment()
-            self.packageManager = pythonEnv
+            self.packageManager = self.detectPythonEnvironment()
         else:
             self.packageManager = packageManager
 
-        if usePackageManager and pythonEnv == 'conda':
+        cacheKey = (self.versionMode, self.packageManager)
+        with _versionCacheLock:
+            cached = _versionCache.get(cacheKey, None)
+        if cached and not(refresh):
+            # Copies keep callers from changing the cached data
+            cached = copy.deepcopy(cached)
+            self.versionData = cached['versionData']
+            self.loadedPackages = cached['loadedPackages']
+            self.installedPackages = cached['installedPackages']
+            self.loadedPackageVersions = cached['loadedPackageVersions']
+            self.versionDataLoaded = True
+            return
+
+        if refresh:
+            self.resetVersionData()
+            self.versionMode = cacheKey[0]
+
+        if usePackageManager and self.packageManager == 'conda':
             # result = conda.cli.python_api.run_command(conda.cli.python_api.Commands.LIST, "--export")
             try:
                 import conda.cli.python_api
@@ -230,6 +261,14 @@ class SysInfo(object):
         
         self.versionData = itemList
         self.versionDataLoaded = True
+
+        with _versionCacheLock:
+            _versionCache[cacheKey] = copy.deepcopy({
+                'versionData': self.versionData,
+                'loadedPackages': self.loadedPackages,
+                'installedPackages': self.installedPackages,
+                'loadedPackageVersions': self.loadedPackageVersions,
+            })
         
     def printInfo(self, k, kd, msg):
         if hasattr(kd, k):
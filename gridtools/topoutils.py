@@ -1,12 +1,342 @@
 # General imports and definitions
-import os, sys, datetime, logging
-import xesmf as xe
+import os, sys, datetime, hashlib, json, logging, tempfile
 import xarray as xr
 import numpy as np
+import scipy.sparse
 import pdb
 
 # Referencing other internal routines
+from . import coordutils
 from . import datasource
+from . import spherical
+
+# xESMF (ESMF) is optional, the native regridder is used without it
+try:
+    import xesmf as xe
+except ImportError:
+    xe = None
+
+BACKENDS = ['auto', 'xesmf', 'native']
+
+class WeightsCache(object):
+    '''
+    On-disk cache of regridding weights.
+
+    Each entry is a weights file written by the regridder and a small JSON
+    record holding the key of the entry, the number of source and target
+    points and the sha256 of the weights file.  An entry is only used if
+    its record matches the key and shape of the request and the weights
+    file matches its checksum.  Anything else is treated as a corrupt or
+    mismatched entry, removed and rebuilt.
+
+    The default cache directory is ``$XDG_CACHE_HOME/gridtools/weights``
+    or ``~/.cache/gridtools/weights``.
+    '''
+
+    def __init__(self, cacheDir=None):
+        if cacheDir is None:
+            cacheHome = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+            cacheDir = os.path.join(cacheHome, 'gridtools', 'weights')
+        self.cacheDir = cacheDir
+
+    @staticmethod
+    def key(source, target, coarsenInt, method, periodic, backend='xesmf'):
+        '''Returns the key of the weights regridding source to target.  The
+        key is a sha256 of the center and corner coordinates of both grids,
+        the coarsening factor, the method, the periodicity and the regridder
+        backend.'''
+        h = hashlib.sha256()
+        for ds in [source, target]:
+            for coord in ['lon', 'lat', 'lon_b', 'lat_b']:
+                values = np.ascontiguousarray(ds[coord].values, dtype=np.float64)
+                h.update(str(values.shape).encode())
+                h.update(values.tobytes())
+        h.update(repr((int(coarsenInt), str(method), bool(periodic), str(backend))).encode())
+        return h.hexdigest()
+
+    def paths(self, key):
+        '''Returns the weights file and record file of an entry.'''
+        return os.path.join(self.cacheDir, key + '.nc'), os.path.join(self.cacheDir, key + '.json')
+
+    @staticmethod
+    def fileChecksum(fileName):
+        h = hashlib.sha256()
+        with open(fileName, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def remove(self, key):
+        for fileName in self.paths(key):
+            if os.path.exists(fileName):
+                os.remove(fileName)
+
+    def lookup(self, key, nIn, nOut):
+        '''Returns the weights file of a valid entry for key with nIn source
+        and nOut target points, or None.  Invalid entries are removed.'''
+        weightsFile, recordFile = self.paths(key)
+        if not(os.path.exists(weightsFile)) and not(os.path.exists(recordFile)):
+            return None
+        try:
+            with open(recordFile) as fp:
+                record = json.load(fp)
+            if record['key'] == key and record['nIn'] == nIn and record['nOut'] == nOut and\
+                record['sha256'] == WeightsCache.fileChecksum(weightsFile):
+                return weightsFile
+        except Exception:
+            pass
+        self.remove(key)
+        return None
+
+    def store(self, key, nIn, nOut, writer, **kwargs):
+        '''Stores an entry for key.  writer(fileName) writes the weights.
+        Other keyword arguments are kept in the record.  Files are written
+        to temporary names and moved into place so readers never see a
+        partial entry.  Returns the weights file.'''
+        os.makedirs(self.cacheDir, exist_ok=True)
+        weightsFile, recordFile = self.paths(key)
+        fd, tmpWeights = tempfile.mkstemp(prefix='.'+key, suffix='.nc', dir=self.cacheDir)
+        os.close(fd)
+        os.remove(tmpWeights)
+        try:
+            writer(tmpWeights)
+            record = dict(kwargs, key=key, nIn=nIn, nOut=nOut, sha256=WeightsCache.fileChecksum(tmpWeights))
+            fd, tmpRecord = tempfile.mkstemp(prefix='.'+key, suffix='.json', dir=self.cacheDir)
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(record, fp)
+            os.replace(tmpWeights, weightsFile)
+            os.replace(tmpRecord, recordFile)
+        finally:
+            if os.path.exists(tmpWeights):
+                os.remove(tmpWeights)
+        return weightsFile
+
+def oceanFraction(topo, out, topoVarName = 'depth'):
+    '''Sets out to the ocean fraction of the depths of topo[topoVarName]:
+    1 for depths of at least 1e-6, the depth itself for smaller positive
+    depths and 0 over land.  Only boolean temporaries are made.'''
+    depth = topo[topoVarName].values
+    out[...] = 0.0
+    np.copyto(out, depth, where=(depth > 0))
+    np.copyto(out, 1.0, where=(depth >= 0.000001))
+
+def regridderWeights(regridder):
+    '''Returns the weights of an xESMF or native regridder as a
+    ``scipy.sparse`` csc matrix of shape (target cells, source cells).
+    The source cells are in row major order of the source (ny, nx), so a
+    band of source rows is a contiguous slice of columns.'''
+    weights = regridder.weights
+    if isinstance(weights, xr.DataArray):
+        # xESMF keeps the weights as a sparse.COO array in a DataArray
+        weights = weights.data
+    return weights.tocsc()
+
+def clipPolygons(px, py, nv, xmin, xmax, ymin, ymax):
+    '''Clips a batch of convex polygons to axis aligned rectangles
+    (Sutherland-Hodgman).  px, py have shape (n, m) with the nv vertices of
+    each polygon first.  Returns the clipped vertices and their number.'''
+    n = px.shape[0]
+    rows = np.arange(n)
+    for (axis, bound, keepAbove) in [(0, xmin, True), (0, xmax, False), (1, ymin, True), (1, ymax, False)]:
+        # A convex polygon clipped by a half plane gains at most one vertex
+        m = px.shape[1] + 1
+        ox, oy = np.zeros((n, m)), np.zeros((n, m))
+        on = np.zeros(n, dtype=np.intp)
+        for k in range(0, m - 1):
+            valid = k < nv
+            kn = np.where(k + 1 < nv, k + 1, 0)
+            x0, y0 = px[:,k], py[:,k]
+            x1, y1 = px[rows,kn], py[rows,kn]
+            c0, c1 = (x0, x1) if axis == 0 else (y0, y1)
+            in0 = (c0 >= bound) if keepAbove else (c0 <= bound)
+            in1 = (c1 >= bound) if keepAbove else (c1 <= bound)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = (bound - c0) / (c1 - c0)
+                ix = np.where(axis == 0, bound, x0 + t*(x1 - x0))
+                iy = np.where(axis == 1, bound, y0 + t*(y1 - y0))
+            # Crossing the boundary adds the intersection, ending inside adds the end point
+            for (emit, ex, ey) in [(valid & (in0 != in1), ix, iy), (valid & in1, x1, y1)]:
+                r = rows[emit]
+                ox[r, on[r]], oy[r, on[r]] = ex[emit], ey[emit]
+                on[r] += 1
+        px, py, nv = ox, oy, on
+    return px, py, nv
+
+def polygonAreas(px, py, nv):
+    '''Returns the areas of a batch of polygons with nv vertices.'''
+    rows = np.arange(px.shape[0])
+    area = np.zeros(px.shape[0])
+    for k in range(0, px.shape[1]):
+        kn = np.where(k + 1 < nv, k + 1, 0)
+        term = px[:,k]*py[rows,kn] - px[rows,kn]*py[:,k]
+        area += np.where(k < nv, term, 0.)
+    return 0.5*np.abs(area)
+
+class NativeRegridder(object):
+    '''
+    Regridder from a rectilinear source to a curvilinear target grid
+    written with NumPy and SciPy.  It is used in place of the xESMF
+    regridder when ESMF is not available, see the *backend* of
+    :func:`TopoUtils.regridTopo`.
+
+    The weights are a ``scipy.sparse`` matrix of shape (target cells,
+    source cells) that can be saved with :py:meth:`to_netcdf` in the same
+    layout as xESMF (variables col, row and S) and read back with
+    *weights*.
+
+    Methods:
+
+        * *conservative* -- the weight of a source cell is the area of its
+          overlap with the target cell divided by the area of the target
+          cell.  Areas are computed in the equal area (lon, sin(lat))
+          projection, where the source cells are rectangles and their
+          areas are exact.  The edges of the target cells are taken as
+          straight lines in this projection.
+        * *bilinear* -- bilinear interpolation of the source cell centers
+          to the target cell centers.
+
+    Candidate source cells of each target cell are found by searching the
+    1d source axes for the bounds of the target cell.  Target cells
+    outside of the source get no weights, as with xESMF.
+
+    The source must have 1d axes: 2d coordinates lon, lat and lon_b,
+    lat_b whose rows (lon) and columns (lat) repeat.  The target has 2d
+    coordinates lon, lat and corners lon_b, lat_b.
+    '''
+
+    METHODS = ['conservative', 'bilinear']
+
+    def __init__(self, source, target, method='conservative', periodic=True, weights=None, chunkSize=1000000):
+        if not(method in NativeRegridder.METHODS):
+            raise Exception("The native regridder does not support method '%s', use one of %s" %
+                (method, ", ".join(NativeRegridder.METHODS)))
+        self.method = method
+        self.periodic = periodic
+        self.targetLon = target['lon']
+        self.targetLat = target['lat']
+        self.shapeIn = source['lon'].shape
+        self.shapeOut = target['lon'].shape
+        nIn, nOut = source['lon'].size, target['lon'].size
+        if weights is not None:
+            ds = xr.open_dataset(weights)
+            self.weights = scipy.sparse.csr_matrix((ds['S'].values,
+                (ds['row'].values - 1, ds['col'].values - 1)), shape=(nOut, nIn))
+            ds.close()
+            return
+        # Source axes, longitudes are unwrapped so the axis increases across the seam
+        lon = np.unwrap(np.asarray(source['lon'])[0,:], period=360.)
+        lat = np.asarray(source['lat'])[:,0]
+        if method == 'conservative':
+            self.weights = self.conservativeWeights(lon, lat, target, chunkSize)
+        else:
+            self.weights = self.bilinearWeights(lon, lat, target)
+
+    @staticmethod
+    def axisBounds(centers):
+        '''Returns the bounds of cells with the given increasing centers.'''
+        bounds = np.empty(centers.size + 1)
+        bounds[1:-1] = 0.5*(centers[:-1] + centers[1:])
+        bounds[0] = centers[0] - (bounds[1] - centers[0])
+        bounds[-1] = centers[-1] + (centers[-1] - bounds[-2])
+        return bounds
+
+    @staticmethod
+    def sortedAxis(centers):
+        '''Returns the increasing centers and the source index of each.'''
+        if centers.size > 1 and centers[-1] < centers[0]:
+            return centers[::-1], np.arange(centers.size - 1, -1, -1)
+        return centers, np.arange(centers.size)
+
+    def conservativeWeights(self, lon, lat, target, chunkSize):
+        nj, ni = self.shapeIn
+        lon, iIndex = NativeRegridder.sortedAxis(lon)
+        lat, jIndex = NativeRegridder.sortedAxis(lat)
+        xb = NativeRegridder.axisBounds(lon)
+        yb = np.sin(np.deg2rad(np.clip(NativeRegridder.axisBounds(lat), -90., 90.)))
+
+        # Corners of the target cells, counterclockwise, with the longitudes of each cell
+        # unwrapped next to its first corner and the first corner in [xb[0], xb[0]+360)
+        lon_b = np.asarray(target['lon_b'])
+        lat_b = np.asarray(target['lat_b'])
+        cx = np.stack((lon_b[:-1,:-1], lon_b[:-1,1:], lon_b[1:,1:], lon_b[1:,:-1]), axis=-1).reshape(-1, 4)
+        cy = np.stack((lat_b[:-1,:-1], lat_b[:-1,1:], lat_b[1:,1:], lat_b[1:,:-1]), axis=-1).reshape(-1, 4)
+        cx = cx[:,0:1] + np.mod(cx - cx[:,0:1] + 180., 360.) - 180.
+        cx = cx + (xb[0] + np.mod(cx[:,0:1] - xb[0], 360.) - cx[:,0:1])
+        cy = np.sin(np.deg2rad(cy))
+        targetArea = polygonAreas(cx, cy, np.full(cx.shape[0], 4))
+
+        rows, cols, values = [], [], []
+        # The part of a cell past the end of the source axis is also tried one period down
+        for shift in [0., -360.]:
+            sx = cx + shift
+            i0 = np.maximum(np.searchsorted(xb, sx.min(axis=1), side='right') - 1, 0)
+            i1 = np.minimum(np.searchsorted(xb, sx.max(axis=1), side='left'), ni)
+            j0 = np.maximum(np.searchsorted(yb, cy.min(axis=1), side='right') - 1, 0)
+            j1 = np.minimum(np.searchsorted(yb, cy.max(axis=1), side='left'), nj)
+            ci = np.maximum(i1 - i0, 0)
+            cj = np.maximum(j1 - j0, 0)
+            count = ci * cj
+            # Target cells are done in chunks of at most chunkSize candidate pairs
+            ends = np.cumsum(count)
+            start = 0
+            while start < count.size:
+                stop = max(np.searchsorted(ends, ends[start] - count[start] + chunkSize, side='right'), start + 1)
+                t = np.repeat(np.arange(start, stop), count[start:stop])
+                if t.size:
+                    offset = np.arange(t.size) - np.repeat(ends[start:stop] - count[start:stop] - (ends[start] - count[start]), count[start:stop])
+                    i = i0[t] + offset % ci[t]
+                    j = j0[t] + offset // ci[t]
+                    px, py, nv = clipPolygons(sx[t], cy[t], np.full(t.size, 4), xb[i], xb[i+1], yb[j], yb[j+1])
+                    overlap = polygonAreas(px, py, nv)
+                    keep = overlap > 0.
+                    rows.append(t[keep])
+                    cols.append(jIndex[j[keep]]*ni + iIndex[i[keep]])
+                    values.append(overlap[keep] / targetArea[t[keep]])
+                start = stop
+        nOut = cx.shape[0]
+        return scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(nOut, nj*ni))
+
+    def bilinearWeights(self, lon, lat, target):
+        nj, ni = self.shapeIn
+        lon, iIndex = NativeRegridder.sortedAxis(lon)
+        lat, jIndex = NativeRegridder.sortedAxis(lat)
+        x = np.asarray(target['lon']).ravel()
+        y = np.asarray(target['lat']).ravel()
+        # A global source wraps around from its last column to its first
+        wraps = self.periodic and ni > 1 and (lon[-1] - lon[0]) + (lon[1] - lon[0]) >= 360. - 1e-6
+        if wraps:
+            lon = np.append(lon, lon[0] + 360.)
+            iIndex = np.append(iIndex, iIndex[0])
+        x = lon[0] + np.mod(x - lon[0], 360.)
+        i = np.clip(np.searchsorted(lon, x, side='right') - 1, 0, lon.size - 2)
+        j = np.clip(np.searchsorted(lat, y, side='right') - 1, 0, lat.size - 2)
+        inside = (x >= lon[0]) & (x <= lon[-1]) & (y >= lat[0]) & (y <= lat[-1])
+        u = (x - lon[i]) / (lon[i+1] - lon[i])
+        v = (y - lat[j]) / (lat[j+1] - lat[j])
+        rows, cols, values = [], [], []
+        t = np.nonzero(inside)[0]
+        for (dj, di, w) in [(0, 0, (1-u)*(1-v)), (0, 1, u*(1-v)), (1, 0, (1-u)*v), (1, 1, u*v)]:
+            rows.append(t)
+            cols.append(jIndex[j[t]+dj]*ni + iIndex[i[t]+di])
+            values.append(w[t])
+        return scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(x.size, nj*ni))
+
+    def to_netcdf(self, fileName):
+        '''Writes the weights in the layout of xESMF weights files.'''
+        weights = self.weights.tocoo()
+        ds = xr.Dataset({'col': ('n_s', weights.col + 1), 'row': ('n_s', weights.row + 1), 'S': ('n_s', weights.data)})
+        ds.to_netcdf(fileName)
+
+    def __call__(self, da):
+        '''Regrid a DataArray whose last two dimensions are the source (ny, nx).'''
+        values = np.asarray(da.values)
+        lead = values.shape[:-2]
+        flat = values.reshape((-1, self.shapeIn[0]*self.shapeIn[1]))
+        out = (self.weights @ flat.T).T.reshape(lead + self.shapeOut)
+        return xr.DataArray(out, dims=da.dims[:-2] + self.targetLon.dims,
+            coords={'lon': self.targetLon, 'lat': self.targetLat}, name=da.name)
 
 class TopoUtils(object):
 
@@ -19,9 +349,427 @@ class TopoUtils(object):
 
     # Functions called from within a class need self as the first argument
     def find_nearest(self, array, value):
-        array = np.asarray(array)
-        idx = (np.abs(array - value)).argmin()
-        return idx
+        """Returns the index of the value of array nearest to value, or to
+        each of an array of values.  See :py:class:`coordutils.CoordinateIndex`.
+        """
+        if not(isinstance(array, coordutils.CoordinateIndex)):
+            array = coordutils.CoordinateIndex(np.asarray(array).ravel())
+        return array.nearest(value)
+
+    def autoCoarsenInt(self, topo, grid, minSourceCells = 2):
+        """Returns the largest coarsening factor of the topography that
+        leaves at least minSourceCells coarsened source cells across each
+        cell of the grid, in both directions, and at least 1.
+
+        The cell sizes of the grid are the supergrid metrics dx and dy, as
+        great arcs between the corners, taken as the smallest in each row
+        of cells so stretched and polar grids are not over-coarsened.  The
+        source cells of a row are as wide as at the latitude of the row
+        nearest to the equator.
+        """
+        lonCorners = np.asarray(grid['lon_corners'])
+        latCorners = np.asarray(grid['lat_corners'])
+        dx = spherical.angle_through_center((latCorners[:,1:], lonCorners[:,1:]), (latCorners[:,:-1], lonCorners[:,:-1]))
+        dy = spherical.angle_through_center((latCorners[1:,:], lonCorners[1:,:]), (latCorners[:-1,:], lonCorners[:-1,:]))
+        dxRow = np.minimum(dx[:-1,:], dx[1:,:]).min(axis=1)
+        dyRow = dy.min(axis=1)
+
+        sourceLon = np.asarray(topo['lon_centers'])
+        sourceLat = np.asarray(topo['lat_centers'])
+        sourceDx = np.deg2rad(np.median(np.abs(np.diff(sourceLon))))
+        sourceDy = np.deg2rad(np.median(np.abs(np.diff(sourceLat))))
+        rowLat = np.minimum(np.abs(latCorners[:-1,:]), np.abs(latCorners[1:,:])).min(axis=1)
+        # Rows crossing the equator
+        rowLat = np.where(latCorners[:-1,:].min(axis=1)*latCorners[1:,:].max(axis=1) < 0, 0., rowLat)
+        sourceDxRow = sourceDx*np.maximum(np.cos(np.deg2rad(rowLat)), 1e-6)
+
+        factor = np.floor(np.minimum(dxRow/sourceDxRow, dyRow/sourceDy) / minSourceCells).min()
+        factor = min(factor, sourceLon.size, sourceLat.size)
+        return int(max(factor, 1))
+
+    def sourceWindow(self, topo, grid, coarsenInt = 10, corners = False):
+        """Returns the window (j0, j1, i0, i1) of coarsened cells of the
+        topography covering the cell centers of a grid, or the cell corners
+        if corners is True.  Windows start and end on the coarsening blocks,
+        so coarsening source cells j0*coarsenInt:j1*coarsenInt and
+        i0*coarsenInt:i1*coarsenInt gives the same values as coarsening the
+        whole topography.  The window reaches one coarse cell past the
+        nearest cells on either side; regridders of any backend read the
+        window of the cell corners.
+        """
+        latName, lonName = ('lat_corners', 'lon_corners') if corners else ('lat_centers', 'lon_centers')
+
+        # Coarse coordinates of the whole source.  Only the 1d coordinates are
+        # coarsened to find the window of the source covering the grid.
+        coarseLon = self.coarsenTopo(topo['lon_centers'], coarsenInt, cells=topo.get('nx_cells')).values
+        coarseLon = coordutils.PeriodicLongitude(coarseLon, lonMin=-180.).values
+        coarseLat = self.coarsenTopo(topo['lat_centers'], coarsenInt, cells=topo.get('ny_cells')).values
+
+        # Function calls within a class need self.()
+        latMinInd, latMaxInd = self.find_nearest(array = coarseLat,
+            value = [np.min(grid[latName].values), np.max(grid[latName].values)])
+        lonMinInd, lonMaxInd = self.find_nearest(array = coarseLon,
+            value = [np.min(grid[lonName].values), np.max(grid[lonName].values)])
+
+        if lonMinInd > lonMaxInd:
+            temp = lonMinInd
+            lonMinInd = lonMaxInd
+            lonMaxInd = temp
+
+        # the window of the large topography file covering the extents of the grid file + 1 coarse
+        # cell on either side because we will slice down 2 points after the corner points are calculated.
+        # The end of a slice is excluded, so the cell past the last nearest cell is lonMaxInd + 2.
+        i0, i1, step = slice(lonMinInd - 1, lonMaxInd + 2).indices(coarseLon.size)
+        j0, j1, step = slice(latMinInd - 1, latMaxInd + 2).indices(coarseLat.size)
+
+        return j0, j1, i0, i1
+
+    def regridBackend(self, backend, method):
+        """Returns the regridder backend to use for a method: xesmf or
+        native.  auto uses xESMF if it is installed and otherwise the native
+        regridder, see :class:`NativeRegridder`.
+        """
+        if not(backend in BACKENDS):
+            raise Exception("Unknown regridder backend '%s', use one of %s" % (backend, ", ".join(BACKENDS)))
+        if backend == 'auto':
+            backend = 'xesmf' if xe is not None else 'native'
+        if backend == 'xesmf' and xe is None:
+            raise Exception("The xesmf regridder backend was requested but xesmf is not installed.")
+        if backend == 'native' and not(method in NativeRegridder.METHODS):
+            raise Exception("The native regridder does not support method '%s', use one of %s" %
+                (method, ", ".join(NativeRegridder.METHODS)))
+        return backend
+
+    def regridWindow(self, grd, topo, grid, topoVarName = "elevation", coarsenInt = 10,
+        method = 'conservative', periodic = True, weightsCache = True, weightsDir = None,
+        window = None, backend = 'auto'):
+        """Regrid the window of the topography covering a grid.  This is the
+        regridding step of :func:`regridTopo` for a grid or a tile of a grid.
+        topo is the source with dimensions (ny, nx) and 1d coordinates
+        lat_centers and lon_centers.  grid has 2d centers (lon, lat) and
+        corners (lon_b, lat_b).  Only the window of topo covering grid, see
+        :func:`sourceWindow`, or the given window is read and coarsened.
+        backend is the regridder, see :func:`regridTopo`.
+
+        Returns the regridded topography and ocean fraction.
+        """
+
+        if window is None:
+            window = self.sourceWindow(topo, grid, coarsenInt, corners=True)
+        j0, j1, i0, i1 = window
+        topo = topo.isel(nx=slice(i0*coarsenInt, i1*coarsenInt), ny=slice(j0*coarsenInt, j1*coarsenInt))
+        msg = ("Source window (ny, nx): %d x %d starting at %d %d" % (topo.sizes['ny'], topo.sizes['nx'],
+            j0*coarsenInt, i0*coarsenInt))
+        grd.printMsg(msg, level=logging.INFO)
+
+        # coarsen topo file down based on coarsenInt
+        topo = self.coarsenTopo(topo, coarsenInt)
+
+        # if longitudes are 0 to 360, convert to -180 to 180
+        if "lon_centers" in topo.coords:
+            topo = topo.assign_coords(lon_centers=(coordutils.PeriodicLongitude(topo['lon_centers'].values, lonMin=-180.).values))
+            topo = topo.swap_dims({'lon_centers' : 'nx'})
+        if "lon_centers" in topo.data_vars:
+            topo['lon_centers'].values = coordutils.PeriodicLongitude(topo['lon_centers'].values, lonMin=-180.).values
+
+        lon_centers = topo['lon_centers'].values
+        lat_centers = topo['lat_centers'].values
+
+        lon_corners = 0.25 * (
+            lon_centers[:-1]
+            + lon_centers[1:]
+            + lon_centers[:-1]
+            + lon_centers[1:]
+        )
+
+        lat_corners = 0.25 * (
+            lat_centers[:-1]
+            + lat_centers[1:]
+            + lat_centers[:-1]
+            + lat_centers[1:]
+        )
+
+        # trim down the centers so they are 1 less than the corner points we just calculated
+        topo = topo.isel(nx=slice(1,-1), ny=slice(1,-1))
+
+        # extract the topo values and add them back later with proper dimensions
+        elev = topo[topoVarName].values
+
+        # add nxp and nyp dimensions for the lat/lon corners to latch onto
+        topo = topo.expand_dims({'nyp':(len(topo.ny) + 1)})
+        topo = topo.expand_dims({'nxp':(len(topo.nx) + 1)})
+
+        # add the lat/lon corners as data variables
+        topo['lat_corners'] = xr.DataArray(data=lat_corners, dims=("nyp"))
+        topo['lon_corners'] = xr.DataArray(data=lon_corners, dims=("nxp"))
+
+        # drop elevation and bring it back, this time constraining the dimensions to lat/lon centers
+        topo = topo.drop_vars(topoVarName)
+        topo[topoVarName] = (('ny', 'nx'), elev)
+
+        lon2d, lat2d = np.meshgrid(topo.lon_centers.values, topo.lat_centers.values)
+        lon2d_b, lat2d_b = np.meshgrid(topo.lon_corners.values, topo.lat_corners.values)
+
+        # assign 2d coordinates as lat/lon
+        topo = topo.assign_coords({"lon" : (("ny", "nx"), lon2d)})
+        topo = topo.assign_coords({"lat" : (("ny", "nx"), lat2d)})
+        topo = topo.assign_coords({"lon_b" : (("nyp", "nxp"), lon2d_b)})
+        topo = topo.assign_coords({"lat_b" : (("nyp", "nxp"), lat2d_b)})
+
+        # regrid our topography and land/ocean mask based on method
+        # Weights are reused from the cache when the same windows are regridded again
+        backend = self.regridBackend(backend, method)
+        Regridder = NativeRegridder if backend == 'native' else xe.Regridder
+        regridder = None
+        if weightsCache:
+            cache = WeightsCache(weightsDir)
+            nIn = topo['lon'].size
+            nOut = grid['lon'].size
+            weightsKey = WeightsCache.key(topo, grid, coarsenInt, method, periodic, backend=backend)
+            weightsFile = cache.lookup(weightsKey, nIn, nOut)
+            if weightsFile:
+                msg = ("Reusing regridding weights: %s" % (weightsFile))
+                grd.printMsg(msg, level=logging.INFO)
+                try:
+                    regridder = Regridder(topo, grid, method=method, periodic=periodic, weights=weightsFile)
+                except Exception:
+                    msg = ("Unable to read cached regridding weights, rebuilding: %s" % (weightsFile))
+                    grd.printMsg(msg, level=logging.WARNING)
+                    cache.remove(weightsKey)
+                    regridder = None
+        if regridder is None:
+            regridder = Regridder(topo, grid, method=method, periodic=periodic)
+            if weightsCache:
+                weightsFile = cache.store(weightsKey, nIn, nOut, regridder.to_netcdf,
+                    method=method, periodic=bool(periodic), coarsenInt=coarsenInt, backend=backend)
+                msg = ("Saved regridding weights: %s" % (weightsFile))
+                grd.printMsg(msg, level=logging.INFO)
+
+        # Because we are now using depth some conditions are flipped below?
+        # regrid the topography and the ocean fraction, where ocean cells are 1 and land
+        # cells are 0, in one pass.  The ocean fraction is computed from the topography
+        # band by band as the weights are applied.
+        fields = [(topoVarName, topoVarName),
+            ('mask', lambda source, out: oceanFraction(source, out, topoVarName = topoVarName))]
+        result = self.regridFields(regridder, topo, fields, grid)
+        topo_out = result[topoVarName]
+        lm_ds_out = result['mask']
+
+        return topo_out, lm_ds_out
+
+    def regridFields(self, regridder, source, fields, grid, bandMb = 64):
+        """Regrid several fields of a source through one application of the
+        regridder weights.  The weights, a sparse matrix of shape (target
+        cells, source cells), are applied to bands of source rows and the
+        regridded fields of each band are summed.  The weights are held by
+        columns so the weights of a band are sliced without a pass over
+        all the weights.
+
+        fields is a list of (name, field) where field is either the name of
+        a variable of source or a function field(band, out) that sets out,
+        an array with the (ny, nx) shape of band, a row band of source, to a
+        field derived from it.  Derived fields, such as the ocean fraction or
+        moments of the depth, are only computed a band at a time, so no
+        source sized array is made besides the source itself.  bandMb is
+        the size in megabytes of the fields of a band.
+
+        Returns a dataset of the regridded fields on the (lon, lat) of grid.
+        """
+        weights = regridderWeights(regridder)
+        ny, nx = source.sizes['ny'], source.sizes['nx']
+        nFields = len(fields)
+        rows = max(1, int(bandMb*1024*1024) // (8*nFields*nx))
+        rows = min(rows, ny)
+
+        out = np.zeros((weights.shape[0], nFields))
+        work = np.empty((nFields, rows, nx))
+        for j0 in range(0, ny, rows):
+            j1 = min(j0 + rows, ny)
+            band = source.isel(ny=slice(j0, j1))
+            stack = work[:, :j1-j0, :]
+            for k, (name, field) in enumerate(fields):
+                if callable(field):
+                    field(band, stack[k])
+                else:
+                    stack[k] = band[field].values
+            out += weights[:, j0*nx:j1*nx] @ stack.reshape((nFields, -1)).T
+
+        dims = grid['lon'].dims
+        coords = {'lon': (dims, grid['lon'].values), 'lat': (dims, grid['lat'].values)}
+        result = xr.Dataset()
+        for k, (name, field) in enumerate(fields):
+            result[name] = xr.DataArray(out[:, k].reshape(grid['lon'].shape), dims=dims,
+                coords=coords, name=name)
+
+        return result
+
+    def renameTopo(self, topo, grid, topoDimX = None, topoDimY = None,
+        topoLatName = None, topoLonName = None):
+        """Rename the dimensions of a topography dataset to (ny, nx) and its
+        coordinates to lat_centers and lon_centers.  See :func:`regridTopo`
+        for the keyword arguments.
+        """
+        if 'nx' not in topo.dims:
+            if topoDimX != None:
+                topo = topo.rename_dims({topoDimX : "nx"})
+            elif 'lon' in topo.dims:
+                topo = topo.rename_dims({"lon" : "nx"})
+            elif 'longitude' in topo.dims:
+                topo = topo.rename_dims({"longitude" : "nx"})
+            elif 'x' in topo.dims:
+                topo = topo.rename_dims({"x" : "nx"})
+            else:
+                print ('Error: plase define topoDimX')
+        if 'ny' not in topo.dims:
+            if topoDimY != None:
+                topo = topo.rename_dims({topoDimY : "ny"})
+            elif 'lat' in topo.dims:
+                topo = topo.rename_dims({"lat" : "ny"})
+            elif 'latitude' in topo.dims:
+                topo = topo.rename_dims({"latitude" : "ny"})
+            elif 'y' in topo.dims:
+                topo = topo.rename_dims({"y" : "ny"})
+            else:
+                print ('Error: plase define topoDimY')
+
+        if 'lat_centers' not in topo.variables:
+            if topoLatName != None:
+                topo = topo.rename({topoLatName: 'lat_centers'})
+            elif 'y' in topo.variables:
+                topo = topo.rename({'y': 'lat_centers'})
+            elif 'lat' in topo.variables:
+                topo = topo.rename({'lat': 'lat_centers'})
+            elif 'latitude' in topo.variables:
+                topo = topo.rename({'latitude': 'lat_centers'})
+            else:
+                print('Error: please define gridlatname')
+        if 'lon_centers' not in topo.variables:
+            if topoLonName != None:
+                topo = topo.rename({topoLonName : 'lon_centers'})
+            elif 'x' in topo.variables:
+                topo = topo.rename({'x': 'lon_centers'})
+            elif 'lon' in topo.variables:
+                topo = topo.rename({'lon': 'lon_centers'})
+            elif 'longitude' in grid.variables:
+                topo = topo.rename({'longitude': 'lon_centers'})
+            else:
+                print('Error: Please define gridLonName')
+
+        return topo
+
+    def coarsenTopo(self, topo, coarsenInt, cells = None):
+        """Coarsen the (ny, nx) dimensions of a topography dataset or data array
+        by coarsenInt, padding the blocks at the end.  Blocks are averaged over
+        their valid source cells.
+
+        An overview, see :func:`writeOverviews`, holds the number of source
+        cells of each of its cells: name_count for the valid cells of each
+        variable and nx_cells and ny_cells along each axis.  Averages of an
+        overview are weighted by these counts and minimum and maximum
+        variables (name_min, name_max) are reduced by their extremes, so
+        coarsening an overview gives the blocks of the source, including
+        padded blocks and blocks with missing values.  cells are the counts
+        of a data array with one dimension.
+        """
+        if isinstance(topo, xr.DataArray):
+            if cells is None:
+                return topo.coarsen({dim: coarsenInt for dim in topo.dims if dim in ['ny', 'nx']},
+                    boundary='pad').mean()
+            return self.weightedCoarsen(topo, cells, coarsenInt)
+
+        if not('nx_cells' in topo.variables):
+            return topo.coarsen(nx=coarsenInt, ny=coarsenInt, boundary='pad').mean()
+
+        result = xr.Dataset()
+        for name in topo.variables:
+            var = topo[name].variable
+            dims = [dim for dim in var.dims if dim in ['ny', 'nx']]
+            if name in ['nx_cells', 'ny_cells'] or name.endswith('_count') or len(dims) == 0:
+                continue
+            blocks = dict([(dim, coarsenInt) for dim in dims])
+            if name.endswith('_min') or name.endswith('_max'):
+                reduced = xr.DataArray(var.data, dims=var.dims).coarsen(blocks, boundary='pad')
+                reduced = reduced.min() if name.endswith('_min') else reduced.max()
+            elif name + '_count' in topo.variables:
+                reduced = self.weightedCoarsen(topo[name], topo[name + '_count'], coarsenInt)
+            elif dims == ['nx'] or dims == ['ny']:
+                reduced = self.weightedCoarsen(topo[name], topo[dims[0] + '_cells'], coarsenInt)
+            else:
+                reduced = xr.DataArray(var.data, dims=var.dims).coarsen(blocks, boundary='pad').mean()
+            if name in topo.coords:
+                result = result.assign_coords({name: reduced.variable})
+            else:
+                result[name] = reduced.variable
+        result.attrs = topo.attrs
+
+        return result
+
+    def weightedCoarsen(self, da, weights, coarsenInt):
+        """Returns the averages of blocks of coarsenInt cells of the (ny, nx)
+        dimensions of da weighted by weights.  Missing values and padded
+        cells have no weight."""
+        # Coordinates are dropped, they are coarsened separately
+        da, weights = xr.DataArray(da.data, dims=da.dims), xr.DataArray(weights.data, dims=weights.dims)
+        blocks = dict([(dim, coarsenInt) for dim in da.dims if dim in ['ny', 'nx']])
+        weights = xr.where(da.notnull(), weights, 0)
+        total = (da.fillna(0.)*weights).coarsen(blocks, boundary='pad').sum()
+        count = weights.coarsen(blocks, boundary='pad').sum()
+        return total / count.where(count > 0)
+
+    def writeOverviews(self, grd, dsName, outDir, factors = [2, 4, 8, 16, 32], varNames = None,
+        latName = 'lat', lonName = 'lon', maxChunkMb = 128):
+        """Write overviews of a data source: copies of its variables coarsened
+        by each of factors, with the average (name), minimum (name_min) and
+        maximum (name_max) of each block of cells.  The variableMap and
+        evalMap of the data source are applied first.  Each overview is a
+        netCDF file in outDir.  Blocks start at the first cell of the data
+        source, as in :func:`regridTopo`, and are padded at the end.
+
+        The number of valid source cells of each block is written as
+        name_count, and the number of source cells of each block along each
+        axis as ny_cells and nx_cells.  :func:`coarsenTopo` uses them to
+        weight averages when an overview is coarsened again, so overviews
+        give the same blocks as the data source, up to round-off, when its
+        size is not a multiple of the coarsening or it has missing values.
+
+        The data source is read in bands of rows of at most maxChunkMb per
+        variable, so the data source does not have to fit in memory.
+        varNames are the variables to coarsen, default: all variables with
+        dimensions (latName, lonName).
+
+        Returns the list of overviews {'factor': factor, 'url': url}.
+        """
+        topo = grd.openDataset(dsName)
+        grd.applyEvalMap(dsName, topo)
+        if varNames is None:
+            varNames = [varName for varName in topo.data_vars if topo[varName].dims == (latName, lonName)]
+        os.makedirs(outDir, exist_ok=True)
+        baseName = os.path.basename(dsName.split(':')[-1].rstrip('/')) or 'overview'
+        overviews = list()
+        for factor in factors:
+            rows = max(factor, int(maxChunkMb*2**20/8/topo.sizes[lonName])//factor*factor)
+            overview = xr.Dataset()
+            for varName in varNames:
+                blocks = topo[varName].chunk({latName: rows, lonName: -1}).coarsen(
+                    {latName: factor, lonName: factor}, boundary='pad')
+                overview[varName] = blocks.mean()
+                overview[varName + '_min'] = blocks.min()
+                overview[varName + '_max'] = blocks.max()
+                overview[varName + '_count'] = topo[varName].notnull().chunk({latName: rows, lonName: -1}).coarsen(
+                    {latName: factor, lonName: factor}, boundary='pad').sum().astype(np.int32)
+            for (dimName, cellsName) in [(latName, 'ny_cells'), (lonName, 'nx_cells')]:
+                cells = xr.DataArray(np.ones(topo.sizes[dimName], dtype=np.int32), dims=(dimName,))
+                overview[cellsName] = cells.coarsen({dimName: factor}, boundary='pad').sum().astype(np.int32)
+            overview.attrs['overview_factor'] = factor
+            overview.attrs['overview_source'] = dsName
+            fileName = os.path.abspath(os.path.join(outDir, "%s_x%d.nc" % (baseName, factor)))
+            grd.closeDataset(fileName)
+            overview.to_netcdf(fileName)
+            overviews.append({'factor': factor, 'url': 'file:' + fileName})
+            msg = ("Wrote overview coarsened by %d: %s" % (factor, fileName))
+            grd.printMsg(msg, level=logging.INFO)
+
+        return overviews
 
     # Topography functions
     #def regridTopo(gridFile, topoFile, gridGeoLoc = "corner",
@@ -31,7 +779,9 @@ class TopoUtils(object):
         topoVarName = "elevation", coarsenInt = 10, method = 'conservative',
         superGrid = True, periodic = True, gridDimX = None, gridDimY = None,
         gridLatName = None, gridLonName = None, topoDimX = None, topoDimY = None,
-        topoLatName = None, topoLonName = None, convert_to_depth = True):
+        topoLatName = None, topoLonName = None, convert_to_depth = True,
+        weightsCache = True, weightsDir = None, tiles = None, tileShape = None,
+        backend = 'auto', minSourceCells = 2, useOverviews = True):
         """Regrid topography file to the grid of a given grid file. It is
         assumed that the topography file is on a rectangular grid and has a
         finer resolution than the grid file. It is also assumed that the
@@ -57,7 +807,17 @@ class TopoUtils(object):
               elevation. If it is not representing elevation, please set
               'convert_to_depth' to False.
             * coarsenInt: Integer value used to decrease resolution of a
-              given topography file - see `xarray.coarsen`
+              given topography file - see `xarray.coarsen`.  'auto' picks the
+              largest value that leaves minSourceCells coarsened source cells across
+              the smallest cell of each row of the grid, see :func:`autoCoarsenInt`.
+            * minSourceCells: Minimum number of coarsened source cells across a grid
+              cell, in each direction, for coarsenInt='auto'.  Default: 2
+            * useOverviews: Boolean, when True and the data source has overviews
+              whose factor divides coarsenInt, the overview with the largest such
+              factor is coarsened instead of the full resolution data.  Averages of
+              the overview blocks are weighted by their number of source cells, so
+              they are the averages of the full resolution blocks up to round-off.
+              See :func:`writeOverviews`.  Default: True
             * superGrid: When true, this assumes the gridFile is a supergrid
               and the resulting topography is coarsened to a regular grid.  Not
               currently implemented.
@@ -75,6 +835,23 @@ class TopoUtils(object):
             * topoDimY: The name of the dimension along the Y axis of the topography file
             * topoLatName: The name of the latitude variable within the topography file
             * topoLonName: The name of the longitude variable within the topography file
+            * weightsCache: Boolean, when True the regridding weights are kept in
+              an on-disk cache and reused when the same source window is regridded
+              onto the same grid with the same coarsenInt, method and periodic.
+              See :class:`WeightsCache`.
+            * weightsDir: Directory of the weights cache.  Default: None, which
+              uses ``$XDG_CACHE_HOME/gridtools/weights`` or ``~/.cache/gridtools/weights``
+            * tiles: (rows, columns) of target tiles to regrid one at a time.  Each
+              tile only reads and regrids the window of the topography covering it,
+              which bounds the memory needed for very large grids.  The tiles are
+              assembled into the same result.  Default: None (one tile)
+            * tileShape: (ny, nx) maximum number of target cells per tile.  Takes
+              precedence over tiles.  Default: None
+            * backend: Regridder used: 'xesmf', 'native' or 'auto'.  The native
+              regridder, see :class:`NativeRegridder`, only needs NumPy and SciPy
+              and supports the 'conservative' and 'bilinear' methods.  'auto' uses
+              xesmf if it is installed and otherwise the native regridder.
+              Default: 'auto'
 
         """
 
@@ -133,10 +910,10 @@ class TopoUtils(object):
 
             # fix longitude from -180 to 180
             if "lon_corners" in grid.coords:
-                grid = grid.assign_coords(lon_corners=(np.where(grid['lon_corners'].values > 180., grid['lon_corners'].values - 360, grid['lon_corners'].values)))
+                grid = grid.assign_coords(lon_corners=(coordutils.PeriodicLongitude(grid['lon_corners'].values, lonMin=-180.).values))
                 grid = grid.swap_dims({'lon_corners' : 'nxp'})
             if "lon_corners" in grid.data_vars:
-                grid['lon_corners'].values =  np.where(grid['lon_corners'].values > 180., grid['lon_corners'].values - 360, grid['lon_corners'].values)
+                grid['lon_corners'].values = coordutils.PeriodicLongitude(grid['lon_corners'].values, lonMin=-180.).values
 
             lon_centers = grid['lon_centers'].values
             lat_centers = grid['lat_centers'].values
@@ -232,10 +1009,10 @@ class TopoUtils(object):
 
             # fix longitude from -180 to 180
             if "lon_corners" in grid.coords:
-                grid = grid.assign_coords(lon_corners=(np.where(grid['lon_corners'].values > 180., grid['lon_corners'].values - 360, grid['lon_corners'].values)))
+                grid = grid.assign_coords(lon_corners=(coordutils.PeriodicLongitude(grid['lon_corners'].values, lonMin=-180.).values))
                 grid = grid.swap_dims({'lon_corners' : 'nxp'})
             if "lon_corners" in grid.data_vars:
-                grid['lon_corners'].values =  np.where(grid['lon_corners'].values > 180., grid['lon_corners'].values - 360, grid['lon_corners'].values)
+                grid['lon_corners'].values = coordutils.PeriodicLongitude(grid['lon_corners'].values, lonMin=-180.).values
 
             lon_corners = grid['lon_corners'].values
             lat_corners = grid['lat_corners'].values
@@ -268,149 +1045,87 @@ class TopoUtils(object):
         # In the example catalog, we change 'elevation' to 'depth'
         msg = ("Attempting to use the following topology data source: %s" % (dsName))
         grd.printMsg(msg, level=logging.INFO)
-        topo = grd.openDataset(dsName)
+        # Only the tiles of a tiled data source near the grid are opened.  The margin
+        # covers the coarse cells read around the grid.
+        bbox = coordutils.gridExtent(grid['lon_corners'].values, grid['lat_corners'].values, margin=1.0)
+        topo = grd.openDataset(dsName, bbox=bbox)
         # We have to apply any any evalMap for any data source in the catalog.
         grd.applyEvalMap(dsName, topo)
 
-        if 'nx' not in topo.dims:
-            if topoDimX != None:
-                topo = topo.rename_dims({topoDimX : "nx"})
-            elif 'lon' in topo.dims:
-                topo = topo.rename_dims({"lon" : "nx"})
-            elif 'longitude' in topo.dims:
-                topo = topo.rename_dims({"longitude" : "nx"})
-            elif 'x' in topo.dims:
-                topo = topo.rename_dims({"x" : "nx"})
-            else:
-                print ('Error: plase define topoDimX')
-        if 'ny' not in topo.dims:
-            if topoDimY != None:
-                topo = topo.rename_dims({topoDimY : "ny"})
-            elif 'lat' in topo.dims:
-                topo = topo.rename_dims({"lat" : "ny"})
-            elif 'latitude' in topo.dims:
-                topo = topo.rename_dims({"latitude" : "ny"})
-            elif 'y' in topo.dims:
-                topo = topo.rename_dims({"y" : "ny"})
-            else:
-                print ('Error: plase define topoDimY')
-
-        # coarsen topo file down based on coarsenInt
-        topo = topo.coarsen(nx=coarsenInt,ny=coarsenInt, boundary='pad').mean()
-
-        if 'lat_centers' not in topo.variables:
-            if topoLatName != None:
-                topo = topo.rename({topoLatName: 'lat_centers'})
-            elif 'y' in topo.variables:
-                topo = topo.rename({'y': 'lat_centers'})
-            elif 'lat' in topo.variables:
-                topo = topo.rename({'lat': 'lat_centers'})
-            elif 'latitude' in topo.variables:
-                topo = topo.rename({'latitude': 'lat_centers'})
-            else:
-                print('Error: please define gridlatname')
-        if 'lon_centers' not in topo.variables:
-            if topoLonName != None:
-                topo = topo.rename({topoLonName : 'lon_centers'})
-            elif 'x' in topo.variables:
-                topo = topo.rename({'x': 'lon_centers'})
-            elif 'lon' in topo.variables:
-                topo = topo.rename({'lon': 'lon_centers'})
-            elif 'longitude' in grid.variables:
-                topo = topo.rename({'longitude': 'lon_centers'})
-            else:
-                print('Error: Please define gridLonName')
-
-        # if longitudes are 0 to 360, convert to -180 to 180
-        if "lon_centers" in topo.coords:
-            topo = topo.assign_coords(lon_centers=(np.where(topo['lon_centers'].values > 180., topo['lon_centers'].values - 360, topo['lon_centers'].values)))
-            topo = topo.swap_dims({'lon_centers' : 'nx'})
-        if "lon_centers" in topo.data_vars:
-            topo['lon_centers'].values =  np.where(topo['lon_centers'].values > 180., topo['lon_centers'].values - 360, topo['lon_centers'].values)
-
-        # Function calls within a class need self.()
-        latMinInd = self.find_nearest(array = topo.lat_centers.values, value = np.min(grid.lat_centers.values))
-        latMaxInd = self.find_nearest(array = topo.lat_centers.values, value = np.max(grid.lat_centers.values))
-        lonMinInd = self.find_nearest(array = topo.lon_centers.values, value = np.min(grid.lon_centers.values))
-        lonMaxInd = self.find_nearest(array = topo.lon_centers.values, value = np.max(grid.lon_centers.values))
-
-        if lonMinInd > lonMaxInd:
-            temp = lonMinInd
-            lonMinInd = lonMaxInd
-            lonMaxInd = temp
-
-        # slice the large topography file down to the extents of the grid file + 1 on either side because we will slice down 2 points
-        # after the corner points are calculated
-        topo = topo.isel(nx=slice(lonMinInd - 1, lonMaxInd + 1), ny=slice(latMinInd - 1, latMaxInd + 1))
-
-        lon_centers = topo['lon_centers'].values
-        lat_centers = topo['lat_centers'].values
-
-        lon_corners = 0.25 * (
-            lon_centers[:-1]
-            + lon_centers[1:]
-            + lon_centers[:-1]
-            + lon_centers[1:]
-        )
-
-        lat_corners = 0.25 * (
-            lat_centers[:-1]
-            + lat_centers[1:]
-            + lat_centers[:-1]
-            + lat_centers[1:]
-        )
-
-        # trim down the centers so they are 1 less than the corner points we just calculated
-        topo = topo.isel(nx=slice(1,-1), ny=slice(1,-1))
-
-        # extract the topo values and add them back later with proper dimensions
-        elev = topo[topoVarName].values
-
-        # add nxp and nyp dimensions for the lat/lon corners to latch onto
-        topo = topo.expand_dims({'nyp':(len(topo.ny) + 1)})
-        topo = topo.expand_dims({'nxp':(len(topo.nx) + 1)})
-
-        # add the lat/lon corners as data variables
-        topo['lat_corners'] = xr.DataArray(data=lat_corners, dims=("nyp"))
-        topo['lon_corners'] = xr.DataArray(data=lon_corners, dims=("nxp"))
-
-        # drop elevation and bring it back, this time constraining the dimensions to lat/lon centers
-        topo = topo.drop_vars(topoVarName)
-        topo[topoVarName] = (('ny', 'nx'), elev)
-
-        lon2d, lat2d = np.meshgrid(topo.lon_centers.values, topo.lat_centers.values)
-        lon2d_b, lat2d_b = np.meshgrid(topo.lon_corners.values, topo.lat_corners.values)
-
-        # assign 2d coordinates as lat/lon
-        topo = topo.assign_coords({"lon" : (("ny", "nx"), lon2d)})
-        topo = topo.assign_coords({"lat" : (("ny", "nx"), lat2d)})
-        topo = topo.assign_coords({"lon_b" : (("nyp", "nxp"), lon2d_b)})
-        topo = topo.assign_coords({"lat_b" : (("nyp", "nxp"), lat2d_b)})
+        topo = self.renameTopo(topo, grid, topoDimX = topoDimX, topoDimY = topoDimY,
+            topoLatName = topoLatName, topoLonName = topoLonName)
 
         # rename for xesmf
         grid["lon"] = grid["lon_centers"]
         grid["lat"] = grid["lat_centers"]
         grid["lon_b"] = grid["lon_corners"]
         grid["lat_b"] = grid["lat_corners"]
-        # create xarray data array of the topography variable name containing the topographic elevation data
-        ds = topo[topoVarName]
 
-        # Because we are now using depth some conditions are flipped below?
+        if coarsenInt == 'auto':
+            coarsenInt = self.autoCoarsenInt(topo, grid, minSourceCells = minSourceCells)
+            msg = ("Chose coarsenInt=%d for at least %d source cells across each grid cell" % (coarsenInt, minSourceCells))
+            grd.printMsg(msg, level=logging.INFO)
 
-        # create ocean fraction array where ocean cells are 1 and land cells are 0
-        #lm_ds = topo[topoVarName].where(topo[topoVarName] < 0)
-        lm_ds = topo[topoVarName].where(topo[topoVarName] > 0)
-        lm_ds = lm_ds.fillna(0)
-        #lm_ds = lm_ds.where(lm_ds > -0.000001)
-        lm_ds = lm_ds.where(lm_ds < 0.000001)
-        lm_ds = lm_ds.fillna(1)
-        lm_ds.name = 'mask'
-        lm_ds.attrs['units'] = 'ocean fraction at T-cell centers'
+        # Start from the precomputed overview nearest to coarsenInt.  Overviews already have
+        # the evalMap applied.
+        overview = grd.findOverview(dsName, coarsenInt) if useOverviews else None
+        if overview:
+            overviewTopo = grd.openDataset(overview['url'])
+            if not('nx_cells' in overviewTopo.variables):
+                msg = ("WARNING: The overview (%s) has no cell counts, write it again with writeOverviews." %
+                    (overview['url']))
+                grd.printMsg(msg, level=logging.WARNING)
+                overview = None
+        if overview:
+            topo = self.renameTopo(overviewTopo, grid, topoDimX = topoDimX, topoDimY = topoDimY,
+                topoLatName = topoLatName, topoLonName = topoLonName)
+            coarsenInt = coarsenInt // overview['factor']
+            msg = ("Using the overview coarsened by %d (%s), coarsening it by %d" % (overview['factor'],
+                overview['url'], coarsenInt))
+            grd.printMsg(msg, level=logging.INFO)
 
-        # regrid our topography and land/ocean mask based on method
-        regridder = xe.Regridder(topo, grid, method=method, periodic=periodic)
-        topo_out = regridder(ds)
-        lm_ds_out = regridder(lm_ds)
+        # Regrid the grid in tiles of target cells.  Each tile reads, coarsens and regrids only
+        # the window of the source covering the tile, which bounds the memory used for large grids.
+        if tiles is None and tileShape is None:
+            topo_out, lm_ds_out = self.regridWindow(grd, topo, grid, topoVarName = topoVarName,
+                coarsenInt = coarsenInt, method = method, periodic = periodic,
+                weightsCache = weightsCache, weightsDir = weightsDir, backend = backend)
+        else:
+            # Tiles read the source under their cell corners, as the whole grid does, so that
+            # cells on the edges of tiles see the same source cells as without tiles, but no
+            # more than the window of the whole grid.
+            fj0, fj1, fi0, fi1 = self.sourceWindow(topo, grid, coarsenInt, corners=True)
+            ny, nx = grid.sizes['ny'], grid.sizes['nx']
+            nty, ntx = coordutils.block_layout((ny+1, nx+1), blocks=tiles, blockShape=tileShape)
+            jEdges = coordutils.block_edges(ny, nty)
+            iEdges = coordutils.block_edges(nx, ntx)
+            msg = ("Regridding in tiles (rows, columns): %d %d" % (nty, ntx))
+            grd.printMsg(msg, level=logging.INFO)
+            topoRows = []
+            maskRows = []
+            for jt in range(0, nty):
+                topoTiles = []
+                maskTiles = []
+                for it in range(0, ntx):
+                    j0, j1 = jEdges[jt], jEdges[jt+1]
+                    i0, i1 = iEdges[it], iEdges[it+1]
+                    msg = ("Regridding tile (%d, %d) cells (ny, nx): %d:%d %d:%d" % (jt, it, j0, j1, i0, i1))
+                    grd.printMsg(msg, level=logging.INFO)
+                    gridTile = grid.isel(ny=slice(j0, j1), nx=slice(i0, i1),
+                        nyp=slice(j0, j1+1), nxp=slice(i0, i1+1), missing_dims='ignore')
+                    tj0, tj1, ti0, ti1 = self.sourceWindow(topo, gridTile, coarsenInt, corners=True)
+                    window = (max(tj0, fj0), min(tj1, fj1), max(ti0, fi0), min(ti1, fi1))
+                    tileTopo, tileMask = self.regridWindow(grd, topo, gridTile, topoVarName = topoVarName,
+                        coarsenInt = coarsenInt, method = method, periodic = periodic,
+                        weightsCache = weightsCache, weightsDir = weightsDir, window = window,
+                        backend = backend)
+                    topoTiles.append(tileTopo)
+                    maskTiles.append(tileMask)
+                topoRows.append(xr.concat(topoTiles, dim='nx'))
+                maskRows.append(xr.concat(maskTiles, dim='nx'))
+            # Assemble the tiles in the same layout as a single regridding
+            topo_out = xr.concat(topoRows, dim='ny')
+            lm_ds_out = xr.concat(maskRows, dim='ny')
 
         # MOM6 really does not care about masking about heights over land
         #topo_out = topo_out.where(topo_out < 0.0000001)
@@ -3,10 +3,27 @@
 Generic utility functions
 '''
 
-import copy, datetime, hashlib, platform, subprocess, sys
+import copy, datetime, hashlib, platform, subprocess, sys, zlib
+import concurrent.futures
 import numpy as np
 from . import sysinfo
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Content hash algorithms; the algorithm name is also the attribute key
+HASH_ALGORITHMS = ['sha256', 'xxh3', 'crc32', 'none']
+# Attribute value of a hash deferred until the variable is written
+HASH_PENDING = 'pending'
+_hashPolicy = {
+    'algorithm': 'sha256',
+    'lazy': False,
+    'workers': 1,
+    'chunkMb': 64,
+}
+
 def checkArgument(vDict, vKey, vVal):
     '''
     This checks to see if there is a key in the passed dictionary.  If the
@@ -109,8 +126,177 @@ def runningHow():
     except:
         return "python"
 
-def sha256sum(xrData):
+def setHashPolicy(algorithm=None, lazy=None, workers=None, chunkMb=None):
+    """Set the content hash policy used to tag grid and topography variables.
+
+    :param algorithm: one of ``sha256`` (default), ``xxh3`` (requires the xxhash
+                      package), ``crc32`` or ``none`` to disable hashing
+    :type algorithm: string
+    :param lazy: defer hashing until the variable is written to a file
+    :type lazy: boolean
+    :param workers: number of threads used to hash several variables at once
+    :type workers: integer
+    :param chunkMb: size in megabytes of the blocks streamed into the digest
+    :type chunkMb: integer
+    :return: the updated policy
+    :rtype: dict
+
+    Digests are streamed block by block in memory order so values are identical
+    to hashing the full array at once.  A digest is sequential, so parallelism
+    is across variables, see :py:func:`resolveHashes`.
+    """
+
+    if algorithm is not None:
+        if not(algorithm in HASH_ALGORITHMS):
+            raise ValueError("Unknown hash algorithm (%s), use one of: %s" % (algorithm, ', '.join(HASH_ALGORITHMS)))
+        if algorithm == 'xxh3' and xxhash is None:
+            raise ValueError("The xxh3 hash algorithm requires the xxhash package.")
+        _hashPolicy['algorithm'] = algorithm
+    if lazy is not None:
+        _hashPolicy['lazy'] = bool(lazy)
+    if workers is not None:
+        _hashPolicy['workers'] = max(1, int(workers))
+    if chunkMb is not None:
+        _hashPolicy['chunkMb'] = max(1, int(chunkMb))
+
+    return getHashPolicy()
+
+def getHashPolicy():
+    """Returns a copy of the current content hash policy."""
+
+    return dict(_hashPolicy)
+
+def _iterHashBlocks(xrData, chunkMb):
+    """Yield contiguous blocks of the data along the first axis in memory order.
+    Contiguous numpy arrays are not copied and dask arrays are computed one
+    block at a time.
+    """
+
+    values = getattr(xrData, 'data', xrData)
+    if not(hasattr(values, 'shape') and hasattr(values, 'dtype')):
+        values = np.asarray(values)
+    if values.ndim == 0 or values.shape[0] == 0:
+        yield np.ascontiguousarray(np.asarray(values)).reshape(-1)
+        return
+
+    rowBytes = values.dtype.itemsize * int(np.prod(values.shape[1:]))
+    nRows = max(1, int(chunkMb * 2**20) // max(rowBytes, 1))
+    for i0 in range(0, values.shape[0], nRows):
+        block = values[i0:i0 + nRows]
+        if hasattr(block, 'compute'):
+            block = block.compute()
+        yield np.ascontiguousarray(block).reshape(-1)
+
+def hashData(xrData, algorithm=None, chunkMb=None):
     """Utility function that returns a hash of the data provided.
+
+    The digest matches ``hashlib.sha256(np.array(xrData)).hexdigest()`` for the
+    default algorithm.  Returns None if hashing is turned off.
+    """
+
+    if algorithm is None:
+        algorithm = _hashPolicy['algorithm']
+    if chunkMb is None:
+        chunkMb = _hashPolicy['chunkMb']
+
+    if algorithm == 'none':
+        return None
+
+    if algorithm == 'crc32':
+        crc = 0
+        for block in _iterHashBlocks(xrData, chunkMb):
+            crc = zlib.crc32(block, crc)
+        return "%08x" % (crc)
+
+    if algorithm == 'xxh3':
+        if xxhash is None:
+            raise ValueError("The xxh3 hash algorithm requires the xxhash package.")
+        h = xxhash.xxh3_64()
+    elif algorithm == 'sha256':
+        h = hashlib.sha256()
+    else:
+        raise ValueError("Unknown hash algorithm (%s), use one of: %s" % (algorithm, ', '.join(HASH_ALGORITHMS)))
+
+    for block in _iterHashBlocks(xrData, chunkMb):
+        h.update(block)
+
+    return h.hexdigest()
+
+def sha256sum(xrData):
+    """Utility function that returns a sha256 hash of the data provided.
+    """
+
+    return hashData(xrData, algorithm='sha256')
+
+def hashVariable(xrData, algorithm=None, lazy=None):
+    """Tag a data array with a content hash following the hash policy.
+
+    The hash is stored as an attribute named after the algorithm.  Hashes
+    of other algorithms are removed.  If the policy is lazy, the attribute
+    is marked pending and computed by :py:func:`resolveHashes` when written.
+
+    :param xrData: data array to tag
+    :type xrData: xarray.DataArray
+    :param algorithm: override the policy algorithm
+    :type algorithm: string
+    :param lazy: override the policy lazy setting
+    :type lazy: boolean
+    :return: none
+    :rtype: none
     """
 
-    return hashlib.sha256( np.array( xrData ) ).hexdigest()
+    if algorithm is None:
+        algorithm = _hashPolicy['algorithm']
+    if lazy is None:
+        lazy = _hashPolicy['lazy']
+
+    for hashKey in HASH_ALGORITHMS:
+        if hashKey != algorithm:
+            xrData.attrs.pop(hashKey, None)
+
+    if algorithm == 'none':
+        return
+
+    if lazy:
+        xrData.attrs[algorithm] = HASH_PENDING
+        return
+
+    xrData.attrs[algorithm] = hashData(xrData, algorithm=algorithm)
+
+def resolveHashes(dsData, workers=None):
+    """Compute hashes marked pending by :py:func:`hashVariable`.  Each
+    variable is hashed by its own thread, up to `workers` at once.
+
+    :param dsData: dataset or data array about to be written
+    :type dsData: xarray object
+    :param workers: override the policy workers setting
+    :type workers: integer
+    :return: none
+    :rtype: none
+    """
+
+    if workers is None:
+        workers = _hashPolicy['workers']
+
+    if hasattr(dsData, 'variables'):
+        dataArrays = [dsData[vName] for vName in dsData.variables]
+    else:
+        dataArrays = [dsData] + [dsData.coords[cName] for cName in dsData.coords]
+
+    pending = list()
+    for xrData in dataArrays:
+        for hashKey in HASH_ALGORITHMS:
+            if xrData.attrs.get(hashKey, None) == HASH_PENDING:
+                pending.append((xrData, hashKey))
+    if len(pending) == 0:
+        return
+
+    if workers > 1 and len(pending) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = list(pool.map(lambda job: hashData(job[0], algorithm=job[1]), pending))
+    else:
+        digests = [hashData(xrData, algorithm=hashKey) for (xrData, hashKey) in pending]
+
+    # Attributes are shared with the dataset variables
+    for ((xrData, hashKey), digest) in zip(pending, digests):
+        xrData.attrs[hashKey] = digest
@@ -0,0 +1,52 @@
+# Synthetic grid and data source shared by the tests
+import logging
+import numpy as np
+import xarray as xr
+
+def bathymetry(lon, lat):
+    '''Default synthetic bathymetry of SyntheticGrid.'''
+    return 2000.0*np.sin(np.radians(lon)*30.0)*np.cos(np.radians(lat)*50.0) - 1500.0
+
+class SyntheticGrid(object):
+    '''Minimal stand-in for GridUtils with a regular supergrid of nx by ny
+    cells and a uniform synthetic data source of spacing dx from 20N to
+    40N.  The data source variable 'depth' is depth(lon, lat).'''
+
+    def __init__(self, lon0=10., lon1=14., lat0=30., lat1=32., nx=16, ny=8, dx=0.125, depth=bathymetry):
+        x = np.linspace(lon0, lon1, nx+1)
+        y = np.linspace(lat0, lat1, ny+1)
+        lonGrid, latGrid = np.meshgrid(x, y)
+        self.grid = xr.Dataset()
+        self.grid['x'] = (('nyp','nxp'), lonGrid)
+        self.grid['y'] = (('nyp','nxp'), latGrid)
+        self.dx = dx
+        self.depth = depth
+        self.overviews = list()
+
+    def printMsg(self, msg, level=logging.INFO):
+        pass
+
+    def checkAvailableVariables(self, dsData, varList):
+        return all([varKey in dsData.variables for varKey in varList])
+
+    def findOverview(self, dsName, coarsenInt):
+        from gridtools.datasource import DataSource
+        return DataSource().nearestOverview({'overviews': self.overviews}, coarsenInt)
+
+    def closeDataset(self, dsName=None):
+        pass
+
+    def openDataset(self, dsName, **kwargs):
+        if dsName.startswith('file:'):
+            return xr.open_dataset(dsName[5:])
+        dx = self.dx
+        lon = np.arange(-180+dx/2, 180, dx)
+        lat = np.arange(20+dx/2, 40, dx)
+        lonGrid, latGrid = np.meshgrid(lon, lat)
+        dsData = xr.Dataset()
+        dsData['depth'] = (('lat','lon'), self.depth(lonGrid, latGrid))
+        dsData = dsData.assign_coords({'lon': lon, 'lat': lat})
+        return dsData
+
+    def applyEvalMap(self, dsName, dsData):
+        pass
@@ -0,0 +1,184 @@
+# Test bathymetric roughness using a small synthetic data
+# source and a regular grid.
+import numpy as np
+import xarray as xr
+
+from synthetic import SyntheticGrid
+
+def computeRoughness(**kwargs):
+    from gridtools import bathyutils
+    grd = SyntheticGrid()
+    kwargs.setdefault('maxMb', 50)
+    return bathyutils.computeBathymetricRoughness(grd, 'ds:synthetic',
+        auxVariables=['hStd', 'hMin', 'hMax', 'depth'], **kwargs)
+
+def test_parallel_blocks():
+    serial = computeRoughness()
+    parallel = computeRoughness(workers=2)
+    for var in ['h2', 'hStd', 'hMin', 'hMax', 'depth']:
+        assert serial[var].attrs['sha256'] == parallel[var].attrs['sha256']
+
+def test_is_lazy(tmp_path):
+    from gridtools import bathyutils
+    fileName = str(tmp_path / 'depth.nc')
+    SyntheticGrid().openDataset('ds:synthetic').to_netcdf(fileName)
+    with xr.open_dataset(fileName, chunks={}) as ds:
+        assert bathyutils.is_lazy(ds['depth'])
+    with xr.open_dataset(fileName) as ds:
+        assert not(bathyutils.is_lazy(ds['depth']))
+        assert not(bathyutils.is_lazy(ds['depth'].values))
+
+# sha256 of the roughness fields of computeRoughness() made by the
+# original 4x1 partition refinement code
+BASELINE_SHA256 = {
+    'h2': 'ed9420ca048001ff336b4a4ece37ae29765f8646455b7fa53b38befc38990872',
+    'hStd': '67f3c64b0edf4adc4b335b83c157af1feeb0112fc5e5321d825032552328ea98',
+    'hMin': 'b6db8c90aac0983fb49c99bfa22a7f68153f7919c7db0ecea88eea3422435c91',
+    'hMax': '78a35b6cdb8861a8ceab038bfc4e527164d4fe68555e4eb5f94805f70baaf6a8',
+    'depth': '7e9d6a70bfb5f2acd56c0f4ae9f7a8a332754a48bc6ae4a6694509ff8cf35c5d',
+}
+
+def test_refine_baseline():
+    for kernels in ['numpy', 'auto']:
+        refine = computeRoughness(kernels=kernels)
+        for var in BASELINE_SHA256.keys():
+            assert refine[var].attrs['sha256'] == BASELINE_SHA256[var]
+
+def test_stream_engine():
+    # A small budget makes the streaming engine use one row bands
+    refine = computeRoughness()
+    stream = computeRoughness(engine='stream', maxMb=3)
+    for var in ['h2', 'hStd', 'hMin', 'hMax', 'depth']:
+        assert refine[var].attrs['sha256'] == stream[var].attrs['sha256']
+
+def test_binning_engine():
+    # Compare with the statistics of the source points in each h-cell
+    binned = computeRoughness(engine='binning')
+    source = SyntheticGrid().openDataset('ds:synthetic')
+    lon = source['lon'].values
+    lat = source['lat'].values
+    depth = source['depth'].values
+    for j in range(0, 4):
+        for i in range(0, 8):
+            inLon = (lon > 10.0+0.5*i) & (lon < 10.5+0.5*i)
+            inLat = (lat > 30.0+0.5*j) & (lat < 30.5+0.5*j)
+            z = depth[np.ix_(inLat, inLon)]
+            x, y = np.meshgrid(lon[inLon], lat[inLat])
+            a = np.stack((x.ravel(), y.ravel(), np.ones(x.size)), axis=1)
+            coef = np.linalg.lstsq(a, z.ravel(), rcond=None)[0]
+            assert np.isclose(binned['depth'].values[j,i], z.mean())
+            assert binned['hMin'].values[j,i] == z.min()
+            assert binned['hMax'].values[j,i] == z.max()
+            assert np.isclose(binned['hStd'].values[j,i], np.std(z.ravel() - a.dot(coef)))
+    # A small budget bins the source in bands of rows
+    banded = computeRoughness(engine='binning', maxMb=0.05)
+    for var in ['h2', 'hStd', 'depth']:
+        assert np.allclose(banded[var].values, binned[var].values)
+    for var in ['hMin', 'hMax']:
+        assert np.array_equal(banded[var].values, binned[var].values)
+
+def test_binning_hits():
+    from gridtools import bathyutils
+    from gridtools.meshrefinement import MeshRefinement, UniformSource
+    class Log(object):
+        def __init__(self):
+            self.msgs = []
+        def printMsg(self, msg, level=None):
+            self.msgs.append(msg)
+    # A sheared mesh leaves the corners of its source window outside its cells
+    lon, lat = np.meshgrid(np.linspace(10, 12, 9), np.linspace(30, 31, 5))
+    lon = lon + 0.5*(lat - 30)
+    dx = 0.05
+    source = UniformSource(np.arange(10+dx/2, 12.5, dx), np.arange(30+dx/2, 31, dx))
+    z = np.add.outer(source.lat, source.lon)
+    mesh = MeshRefinement(lon=lon, lat=lat)
+    inCell = mesh.find_cells(source)[0] >= 0
+    assert 0 < inCell.sum() < inCell.size
+    log = Log()
+    hits = bathyutils.bin_block(log, mesh, source, z, max_mb=0.01)[4]
+    assert np.array_equal(hits, inCell)
+    assert "Non-hit ratio: %d / %d" % (inCell.size - inCell.sum(), inCell.size) in log.msgs
+    assert any([msg.startswith("Binning in") for msg in log.msgs])
+
+def test_block_round_trip():
+    from gridtools import bathyutils
+    a = np.arange(11*17, dtype=float).reshape((11, 17))
+    for (yb, xb) in [(1, 4), (2, 3), (3, 5), (10, 16)]:
+        for useSupergrid in [True, False]:
+            blocks = bathyutils.break_array_to_blocks(a, xb, yb, useSupergrid=useSupergrid)
+            assert len(blocks) == yb*xb
+            ao = bathyutils.undo_break_array_to_blocks(blocks, xb, yb, useSupergrid=useSupergrid)
+            if useSupergrid:
+                assert np.array_equal(ao, a)
+            else:
+                assert np.array_equal(ao, a[:-1,:-1])
+
+def test_block_layout():
+    from gridtools import coordutils
+    assert coordutils.block_layout((11, 17)) == (1, 4)
+    assert coordutils.block_layout((11, 17), blocks=(2, 3)) == (2, 3)
+    assert coordutils.block_layout((11, 17), blockShape=(4, 4)) == (3, 4)
+    assert coordutils.block_layout((11, 17), blocks=(50, 50)) == (10, 16)
+
+def test_block_plan():
+    plan = computeRoughness(dryRun=True, blocks=(1, 1))
+    assert plan['blocks'] == (1, 1)
+    # A smaller memory budget must split the grid into more blocks
+    autoPlan = computeRoughness(dryRun=True, blocks='auto', workers=2, maxMb=plan['peakMb'])
+    assert autoPlan['blocks'][0]*autoPlan['blocks'][1] > 1
+    assert autoPlan['fits']
+    assert autoPlan['peakMb'] <= autoPlan['budgetMb']
+    assert len(autoPlan['stages']) >= 1
+
+def test_source_window():
+    from gridtools import coordutils
+    a = np.arange(6*20, dtype=float).reshape((6, 20))
+    da = xr.DataArray(a, dims=('lat','lon'))
+    lon = np.arange(20)*18.
+    for shift in [0, 7, 19]:
+        rolled = np.roll(a, -shift, axis=1)
+        rolledLon = np.roll(lon, -shift)
+        if shift:
+            rolledLon = np.where(rolledLon>=rolledLon[0], rolledLon-360, rolledLon)
+        view = coordutils.PeriodicLongitude(lon, shift=shift)
+        assert np.array_equal(np.asarray(view), rolledLon)
+        for tis in [slice(0, 5), slice(10, 20), slice(3, 18)]:
+            assert np.array_equal(view[tis], rolledLon[tis])
+            w = view.read(da, slice(1, 4), tis)
+            assert np.array_equal(w, rolled[1:4, tis])
+    rebased = coordutils.PeriodicLongitude(lon, lonMin=-180.)
+    assert np.array_equal(rebased.values, np.where(lon > 180., lon - 360, lon))
+
+def test_coordinate_index():
+    from gridtools import coordutils
+    rng = np.random.default_rng(1)
+    x = np.concatenate((rng.uniform(-400, 400, 500), np.arange(-180, 180, 0.25)))
+    axes = [np.arange(-180+0.125, 180, 0.25), np.arange(0.05, 360, 0.1)[::-1],
+        np.sort(rng.uniform(-90, 90, 200)),
+        coordutils.PeriodicLongitude(np.arange(0.05, 360, 0.1), lonMin=-180.).values,
+        # Axes covering a period or more
+        np.linspace(-180, 180, 1441), np.linspace(-180, 180, 1441)[::-1], np.arange(0, 720, 0.7)]
+    for a in axes:
+        for periodic in [False, True]:
+            index = coordutils.CoordinateIndex(a, periodic=periodic)
+            if periodic:
+                scan = [np.minimum(np.mod(a-v, 360.), np.mod(v-a, 360.)).argmin() for v in x]
+            else:
+                scan = [np.abs(a-v).argmin() for v in x]
+            assert np.array_equal(index.nearest(x), scan)
+            assert index.nearest(x[3]) == scan[3]
+    # The repeated end point is dropped, the axis is looked up as uniform
+    index = coordutils.CoordinateIndex(np.linspace(-180, 180, 1441), periodic=True)
+    assert index.sorted.size == 1440 and index.step is not None
+
+def test_get_indices2D():
+    from gridtools import bathyutils
+    lon, lat = np.meshgrid(np.arange(10, 14, 0.25), np.arange(30, 32, 0.5))
+    axes = bathyutils.rectilinear_axes(lon, lat)
+    assert axes is not None
+    for (x, y) in [(11.1, 30.6), (13.9, 31.9), (9.0, 35.0)]:
+        expected = bathyutils.get_indices2D(lon, lat, x, y)
+        assert bathyutils.get_indices2D(axes[0], axes[1], x, y) == expected
+        assert expected == (np.abs(lat[:,0]-y).argmin(), np.abs(lon[0,:]-x).argmin())
+    # A curvilinear grid has no axes
+    assert bathyutils.rectilinear_axes(lon + 0.1*lat, lat) is None
@@ -0,0 +1,104 @@
+# Test the pool of open datasets
+import numpy as np
+import xarray as xr
+
+def test_dataset_pool(tmp_path):
+    from gridtools.datasource import DatasetPool
+    fileName = str(tmp_path / 'data.nc')
+    xr.Dataset({'depth': (('ny','nx'), np.arange(12.).reshape((3, 4)))}).to_netcdf(fileName)
+    with DatasetPool(maxSize=2) as pool:
+        first = pool.open(fileName)
+        first['depth'] = -first['depth']
+        first.close()
+        second = pool.open(fileName)
+        # Copies share the open dataset, closing or changing a copy does not affect it
+        assert len(pool) == 1 and fileName in pool
+        assert np.array_equal(second['depth'].values, np.arange(12.).reshape((3, 4)))
+        chunked = pool.open(fileName, chunks={'ny': 1})
+        assert len(pool) == 2 and chunked['depth'].chunks is not None
+        # Least recently used datasets are closed
+        other = str(tmp_path / 'other.nc')
+        xr.Dataset({'mask': ('n', np.ones(3))}).to_netcdf(other)
+        pool.open(other)
+        assert len(pool) == 2 and pool.close(fileName) == 1 and not(fileName in pool)
+    assert len(pool) == 0
+
+def test_eval_expression():
+    import pytest
+    from gridtools.datasource import EvalExpression, compileExpression
+    elevation = np.arange(-6., 6.).reshape((3, 4))
+    dsData = xr.Dataset({'elevation': (('ny','nx'), elevation), 'scale': (('ny','nx'), np.full((3, 4), 2.))})
+    depth = compileExpression('-[elevation]')
+    assert compileExpression('-[elevation]') is depth
+    result = depth(dsData)
+    # Derived variables are computed when used
+    assert result.chunks is not None
+    assert np.array_equal(result.values, -elevation)
+    result = EvalExpression('where([elevation] < 0, -[elevation]*[scale] + 1, 0)')(dsData)
+    assert np.array_equal(result.values, np.where(elevation < 0, -elevation*2 + 1, 0))
+    assert np.array_equal(EvalExpression('[elevation]**2 + 2**-1')(dsData).values, elevation**2 + 0.5)
+    # Operations on numbers are folded when compiled
+    assert np.array_equal(EvalExpression('[elevation]**(1+1)*2**3')(dsData).values, elevation**2*8)
+    for unsafe in ["__import__('os').getcwd()", "[elevation].values", "(lambda: 1)()", "open('x')",
+        "9**9**9**9", "2**[elevation]", "[elevation]**1e6", "(((9**64)**64)**64)**64",
+        "((((9**64)**64)**64)**64)**64", "10**400", "[elevation] + 1/(1-1)"]:
+        with pytest.raises(Exception):
+            EvalExpression(unsafe)
+
+def test_tiled_source(tmp_path):
+    from gridtools.coordutils import gridExtent
+    from gridtools.datasource import DataSource
+    dx = 0.5
+    files = list()
+    for lon0 in range(-180, 180, 90):
+        for lat0 in [-90, 0]:
+            lon = np.arange(lon0+dx/2, lon0+90, dx)
+            lat = np.arange(lat0+dx/2, lat0+90, dx)
+            fileName = str(tmp_path / ('tile_%d_%d.nc' % (lon0, lat0)))
+            xr.Dataset({'depth': (('lat','lon'), np.zeros((lat.size, lon.size)))},
+                coords={'lon': lon, 'lat': lat}).to_netcdf(fileName)
+            files.append(fileName)
+    dataSource = DataSource()
+    indexFile = str(tmp_path / 'index.json')
+    dataSource.writeTileIndex(files, indexFile)
+    dataSource.addDataSource({'tiled': {'tileIndex': indexFile}, 'single': {'url': 'file:' + files[0]}})
+    assert dataSource.isTiled(dataSource.catalog['tiled']) and not(dataSource.isTiled(dataSource.catalog['single']))
+    tiles = dataSource.getTiles(dataSource.catalog['tiled'])
+    assert tiles[0]['bbox'] == [-180., -90., -90., 0.]
+    # A grid from 170 to -170 crosses the seam of the tiles: all tiles of its latitudes
+    bbox = gridExtent([170., 175., -175., -170.], [10., 20., 10., 20.], margin=1.)
+    assert np.allclose(bbox, [169., 9., 191., 21.])
+    selected = dataSource.selectTiles(tiles, bbox)
+    assert len(selected) == 4 and all([tile['bbox'][1] == 0. for tile in selected])
+    selected = dataSource.selectTiles(tiles, gridExtent([10., 20.], [-5., 5.]))
+    assert sorted([tile['url'] for tile in selected]) == sorted([files[4], files[5]])
+    mosaic = xr.combine_by_coords([xr.open_dataset(tile['url'], chunks={}) for tile in selected])
+    assert mosaic['depth'].shape == (360, 180)
+
+def test_tiled_dataset(tmp_path):
+    from gridtools.datasource import DataSource
+    from gridtools.gridutils import GridUtils
+    dx = 0.5
+    files = list()
+    for lon0 in range(-180, 180, 90):
+        for lat0 in [-90, 0]:
+            lon = np.arange(lon0+dx/2, lon0+90, dx)
+            lat = np.arange(lat0+dx/2, lat0+90, dx)
+            fileName = str(tmp_path / ('tile_%d_%d.nc' % (lon0, lat0)))
+            xr.Dataset({'elevation': (('lat','lon'), np.add.outer(lat, lon))},
+                coords={'lon': lon, 'lat': lat}).to_netcdf(fileName)
+            files.append(fileName)
+    grd = GridUtils()
+    grd.useDataSource(DataSource())
+    indexFile = str(tmp_path / 'index.json')
+    grd.dataSourcesObj.writeTileIndex(files, indexFile)
+    grd.addDataSource({'tiled': {'tileIndex': indexFile, 'variableMap': {'depth': 'elevation'},
+        'evalMap': {'depth': '-[depth]'}}})
+    # Only the two tiles of the box are opened and mosaicked
+    dsData = grd.openDataset('ds:tiled', bbox=[10., -5., 20., 5.])
+    assert dsData['depth'].shape == (360, 180) and len(grd.datasetPool) == 2
+    grd.applyEvalMap('ds:tiled', dsData)
+    assert float(dsData['depth'].sel(lat=0.25, lon=10.25)) == -10.5
+    # Closing the catalog entry closes its tiles
+    grd.closeDataset('ds:tiled')
+    assert len(grd.datasetPool) == 0
@@ -0,0 +1,105 @@
+# Test mesh refinement routines against direct calculations
+# on a small uniform source.
+import numpy as np
+
+def test_least_square_plane_estimate():
+    from gridtools.meshrefinement import MeshRefinement
+    dx = 0.1
+    xs = np.arange(0.05, 6, dx)
+    ys = np.arange(-2.95, 3, dx)
+    x, y = np.meshgrid(xs, ys)
+    zs = 1000.0*np.sin(x/3)*np.cos(y/2) + 50.0*np.cos(7*x*y)
+    lon, lat = np.meshgrid(np.linspace(1, 5, 9), np.linspace(-2, 2, 5))
+    Zstd, Zmean, Zmin, Zmax = MeshRefinement(lon=lon, lat=lat).least_square_plane_estimate(xs, ys, zs)
+    for J in range(0, 4):
+        for I in range(0, 8):
+            inLon = (xs >= lon[J,I]) & (xs < lon[J,I+1])
+            inLat = (ys >= lat[J,I]) & (ys < lat[J+1,I])
+            z = zs[np.ix_(inLat, inLon)]
+            X, Y = np.meshgrid(xs[inLon], ys[inLat])
+            a = np.stack((X.ravel(), Y.ravel(), np.ones(X.size)), axis=1)
+            coef = np.linalg.lstsq(a, z.ravel(), rcond=None)[0]
+            assert np.isclose(Zmean[J,I], z.mean())
+            assert Zmin[J,I] == z.min()
+            assert Zmax[J,I] == z.max()
+            assert np.isclose(Zstd[J,I], np.std(z.ravel() - a.dot(coef)))
+
+def test_uniform_source():
+    from gridtools.meshrefinement import MeshRefinement, UniformSource
+    dx = 0.25
+    lon = np.arange(-180+dx/2, 180, dx)
+    lat = np.arange(-10+dx/2, 10, dx)
+    source = UniformSource(lon, lat)
+    assert source.shape == (lat.size, lon.size)
+    assert source.periodic and not(source.repeated)
+    mesh = MeshRefinement(lon=np.linspace(170, 190, 11), lat=np.linspace(-5, 5, 6))
+    i, j = mesh.find_nn_uniform_source(source)
+    assert np.all(np.abs(np.mod(lon[i] - mesh.lon + 180, 360) - 180) <= dx/2)
+    assert np.all(np.abs(lat[j] - mesh.lat) <= dx/2)
+    window = source.window(slice(4, 20), slice(100, 200))
+    i, j = MeshRefinement(lon=np.linspace(-150, -140, 5), lat=np.linspace(-8, -7, 3)).find_nn_uniform_source(window)
+    assert np.all(np.abs(window.lon[i] - np.linspace(-150, -140, 5)) <= dx/2)
+
+def test_source_coverage():
+    from gridtools.meshrefinement import MeshRefinement, UniformSource, SourceCoverage
+    dx = 0.5
+    source = UniformSource(np.arange(dx/2, 10, dx), np.arange(-5+dx/2, 5, dx))
+    coverage = SourceCoverage(source)
+    mesh = MeshRefinement(lon=np.linspace(1, 4, 13), lat=np.linspace(-2, 2, 17))
+    for stage in range(300):
+        coverage.new_stage()
+        coverage.add_mesh(mesh)
+    i, j = mesh.find_nn_uniform_source(source)
+    hits = np.zeros(source.shape, dtype=np.uint8)
+    hits[j, i] = 1
+    assert coverage.hits().dtype == np.uint8
+    assert np.array_equal(coverage.hits(), hits)
+    assert coverage.nhits == hits.sum() and coverage.newly == 0 and not(coverage.all())
+    assert np.array_equal(mesh.source_hits(source), hits)
+
+def test_refineby2():
+    from gridtools.meshrefinement import MeshRefinement, Workspace
+    lon, lat = np.meshgrid(np.linspace(-30, 40, 15), np.linspace(-60, 70, 12))
+    mesh, workspace = MeshRefinement(lon=lon, lat=lat), Workspace()
+    fine = mesh.refineby2().refineby2().refineby2()
+    reused = mesh.refineby2(workspace=workspace).refineby2(workspace=workspace).refineby2(workspace=workspace)
+    assert fine.shape == (8*11, 8*14) and fine.xyz is not None
+    # The nodes stay on the sphere
+    X, Y, Z = fine.xyz
+    assert np.allclose(X*X + Y*Y + Z*Z, 1.)
+    assert np.array_equal(fine.lon, reused.lon) and np.array_equal(fine.lat, reused.lat)
+    # The 3d coordinates are dropped once (lon,lat) are computed
+    assert fine.xyz is None and fine.lon.shape == (8*11+1, 8*14+1)
+    # Shared nodes keep their coordinates, up to the round-off of arccos near lon=0
+    assert np.allclose(fine.lon[::8,::8], lon, atol=1e-5) and np.allclose(fine.lat[::8,::8], lat)
+    # Each stage starts from the (lon,lat) of the previous one
+    stepped = mesh
+    for k in range(3):
+        refined = stepped.refineby2()
+        stepped = MeshRefinement(lon=refined.lon, lat=refined.lat)
+    assert np.array_equal(fine.lon, stepped.lon) and np.array_equal(fine.lat, stepped.lat)
+
+def test_kernels():
+    import pytest
+    pytest.importorskip('numba')
+    from gridtools import meshkernels
+    from gridtools.meshrefinement import MeshRefinement, UniformSource
+    dx = 0.125
+    source = UniformSource(np.arange(-180+dx/2, 180, dx), np.arange(-30+dx/2, 30, dx))
+    x, y = np.meshgrid(source.lon, source.lat)
+    zs = (1000.0*np.sin(x/7)*np.cos(y/5)).astype(np.float32)
+    lon, lat = np.meshgrid(np.linspace(170, 195, 11), np.linspace(-20, 20, 9))
+    results = {}
+    for (backend, parallel) in [('numpy', True), ('numba', True), ('numba', False)]:
+        kernels = meshkernels.Kernels(backend, parallel=parallel)
+        Glist = MeshRefinement(lon=lon, lat=lat, kernels=kernels).refine_loop(source, verbose=False, max_mb=16)
+        # Refined meshes use the kernels of the mesh they refine
+        assert Glist[-1].kernels is kernels
+        Glist[-1].sample_source_data_on_target_mesh(source, None, zs)
+        for i in reversed(range(1, len(Glist))):
+            Glist[i].coarsenby2(Glist[i-1])
+        results[(backend, parallel)] = [Glist[-1].lon, Glist[-1].lat, Glist[0].height, Glist[0].h_min,
+            Glist[0].h_max, Glist[0].xm, Glist[0].yzm, Glist[1].xxm]
+    for other in [('numba', True), ('numba', False)]:
+        for a, b in zip(results[('numpy', True)], results[other]):
+            assert np.array_equal(a, b)
@@ -0,0 +1,15 @@
+# Test the per process cache of software version data
+def test_version_cache():
+    from gridtools import sysinfo
+    sysinfo.clearVersionCache()
+    first = sysinfo.SysInfo()
+    first.loadVersionData()
+    assert 'python' in first.versionData
+    # Later objects are filled from the cache and changes are not shared
+    first.versionData['notAModule'] = '0.0'
+    second = sysinfo.SysInfo()
+    second.loadVersionData()
+    assert not('notAModule' in second.versionData)
+    # A refresh collects the data again
+    first.loadVersionData(refresh=True)
+    assert not('notAModule' in first.versionData)
@@ -0,0 +1,136 @@
+# Test topography regridding with the native regridder using a small
+# synthetic data source and a regular grid.
+import numpy as np
+import xarray as xr
+
+from synthetic import SyntheticGrid
+
+def topoGrid():
+    '''A 32 by 16 cell grid on a 1/60 degree synthetic topography.'''
+    return SyntheticGrid(nx=32, ny=16, dx=1/60.,
+        depth=lambda lon, lat: 1000.0*np.sin(np.radians(lon)*300.0)*np.cos(np.radians(lat)*500.0))
+
+def source_and_target():
+    dx = 0.25
+    lon = np.arange(-180+dx/2, 180, dx)
+    lat = np.arange(-60+dx/2, 60, dx)
+    source = xr.Dataset()
+    lonGrid, latGrid = np.meshgrid(lon, lat)
+    source = source.assign_coords({'lon': (('ny','nx'), lonGrid), 'lat': (('ny','nx'), latGrid)})
+    # A sheared target crossing the dateline
+    lon_b, lat_b = np.meshgrid(np.linspace(170, 190, 21), np.linspace(-10, 10, 11))
+    lon_b = lon_b + 0.5*lat_b
+    target = xr.Dataset()
+    target = target.assign_coords({'lon_b': (('nyp','nxp'), lon_b), 'lat_b': (('nyp','nxp'), lat_b),
+        'lon': (('ny','nx'), 0.25*(lon_b[:-1,:-1] + lon_b[1:,:-1] + lon_b[:-1,1:] + lon_b[1:,1:])),
+        'lat': (('ny','nx'), 0.25*(lat_b[:-1,:-1] + lat_b[1:,:-1] + lat_b[:-1,1:] + lat_b[1:,1:]))})
+    return source, target
+
+def test_native_regridder(tmp_path):
+    from gridtools.topoutils import NativeRegridder
+    source, target = source_and_target()
+    conservative = NativeRegridder(source, target, method='conservative')
+    # Target cells are covered by the source, the weights of each cell add up to 1
+    assert np.allclose(np.asarray(conservative.weights.sum(axis=1)).ravel(), 1.)
+    ones = xr.DataArray(np.ones(source['lon'].shape), dims=('ny','nx'))
+    assert np.allclose(conservative(ones).values, 1.)
+    bilinear = NativeRegridder(source, target, method='bilinear')
+    linear = xr.DataArray(2.0*source['lat'].values - 3.0, dims=('ny','nx'))
+    assert np.allclose(bilinear(linear).values, 2.0*target['lat'].values - 3.0)
+    weightsFile = str(tmp_path / 'weights.nc')
+    conservative.to_netcdf(weightsFile)
+    reused = NativeRegridder(source, target, method='conservative', weights=weightsFile)
+    assert (reused.weights != conservative.weights).nnz == 0
+
+def test_regrid_fields():
+    from gridtools.topoutils import NativeRegridder, TopoUtils, oceanFraction
+    source, target = source_and_target()
+    source['depth'] = (('ny','nx'), 100.0*np.sin(np.radians(source['lon'].values)*20.0) + 20.0)
+    regridder = NativeRegridder(source, target, method='conservative')
+    fields = [('depth', 'depth'), ('mask', lambda band, out: oceanFraction(band, out, topoVarName='depth'))]
+    # Bands of a few source rows give the regridding of the whole fields
+    result = TopoUtils().regridFields(regridder, source, fields, target, bandMb=0.1)
+    mask = np.zeros(source['depth'].shape)
+    oceanFraction(source, mask, topoVarName='depth')
+    assert np.allclose(result['depth'].values, regridder(source['depth']).values)
+    assert np.allclose(result['mask'].values, regridder(xr.DataArray(mask, dims=('ny','nx'))).values)
+    assert result['depth'].dims == target['lon'].dims
+
+def test_regrid_topo_native(tmp_path):
+    from gridtools.topoutils import TopoUtils
+    topoUtils = TopoUtils()
+    kwargs = dict(topoVarName='depth', coarsenInt=4, backend='native', weightsDir=str(tmp_path))
+    single = topoUtils.regridTopo(topoGrid(), 'ds:synthetic', **kwargs)
+    cached = topoUtils.regridTopo(topoGrid(), 'ds:synthetic', **kwargs)
+    tiled = topoUtils.regridTopo(topoGrid(), 'ds:synthetic', tiles=(2, 3), **kwargs)
+    for var in ['depth', 'ocean_mask']:
+        assert np.array_equal(single[var].values, cached[var].values)
+        assert np.array_equal(single[var].values, tiled[var].values)
+
+def test_source_window():
+    from gridtools.topoutils import TopoUtils
+    topoUtils = TopoUtils()
+    grd = topoGrid()
+    grid = grd.grid.rename({'x': 'lon_corners', 'y': 'lat_corners'})
+    centers = lambda c: 0.25*(c[:-1,:-1] + c[1:,:-1] + c[:-1,1:] + c[1:,1:])
+    grid['lon_centers'] = (('ny','nx'), centers(grid['lon_corners'].values))
+    grid['lat_centers'] = (('ny','nx'), centers(grid['lat_corners'].values))
+    topo = topoUtils.renameTopo(grd.openDataset('ds:synthetic'), None)
+    # The window the xESMF and native regridders read, 1/15 degree cells around 10E-14E, 30N-32N
+    j0, j1, i0, i1 = topoUtils.sourceWindow(topo, grid, 4, corners=True)
+    assert (j0, j1, i0, i1) == (149, 182, 2848, 2911)
+    # The first and last coarse cells of the window lie past the cell corners of the grid
+    coarseLon = topoUtils.coarsenTopo(topo['lon_centers'], 4).values
+    coarseLat = topoUtils.coarsenTopo(topo['lat_centers'], 4).values
+    assert coarseLon[i0] < 10. and coarseLon[i1-1] > 14.
+    assert coarseLat[j0] < 30. and coarseLat[j1-1] > 32.
+
+def test_auto_coarsen():
+    from gridtools.topoutils import TopoUtils
+    topoUtils = TopoUtils()
+    kwargs = dict(topoVarName='depth', backend='native', weightsCache=False)
+    # Grid cells of 1/8 degree on a 1/60 degree source: 7.5 source cells across
+    auto = topoUtils.regridTopo(topoGrid(), 'ds:synthetic', coarsenInt='auto', minSourceCells=2, **kwargs)
+    fixed = topoUtils.regridTopo(topoGrid(), 'ds:synthetic', coarsenInt=3, **kwargs)
+    assert np.array_equal(auto['depth'].values, fixed['depth'].values)
+    grid = topoGrid().grid.rename({'x': 'lon_corners', 'y': 'lat_corners'})
+    source = topoGrid().openDataset('ds:synthetic').rename({'lon': 'lon_centers', 'lat': 'lat_centers'})
+    assert topoUtils.autoCoarsenInt(source, grid, minSourceCells=1) == 7
+    assert topoUtils.autoCoarsenInt(source, grid, minSourceCells=100) == 1
+
+def test_overviews(tmp_path):
+    from gridtools.topoutils import TopoUtils
+    topoUtils = TopoUtils()
+    grd = topoGrid()
+    grd.overviews = topoUtils.writeOverviews(grd, 'ds:synthetic', str(tmp_path), factors=[2, 4], maxChunkMb=64)
+    assert [overview['factor'] for overview in grd.overviews] == [2, 4]
+    source = grd.openDataset('ds:synthetic')['depth']
+    overview = grd.openDataset(grd.overviews[0]['url'])
+    assert np.array_equal(overview['depth_max'].values, source.coarsen(lat=2, lon=2).max().values)
+    assert np.allclose(overview['depth'].values, source.coarsen(lat=2, lon=2).mean().values)
+    kwargs = dict(topoVarName='depth', coarsenInt=8, backend='native', weightsCache=False)
+    full = topoUtils.regridTopo(topoGrid(), 'ds:synthetic', **kwargs)
+    fromOverview = topoUtils.regridTopo(grd, 'ds:synthetic', **kwargs)
+    for var in ['depth', 'ocean_mask']:
+        assert np.allclose(full[var].values, fromOverview[var].values, rtol=1e-9, atol=1e-9)
+
+def test_overview_edges(tmp_path):
+    from gridtools.topoutils import TopoUtils
+    topoUtils = TopoUtils()
+    grd = topoGrid()
+    # A source whose size is not a multiple of the coarsening, with missing values
+    source = grd.openDataset('ds:synthetic').isel(lat=slice(0, 203), lon=slice(0, 301))
+    depth = source['depth'].values.copy()
+    depth[5:40, 7:90] = np.nan
+    depth[200:, 297:] = np.nan
+    source['depth'] = (('lat','lon'), depth)
+    grd.openDataset = lambda dsName, **kwargs: xr.open_dataset(dsName[5:]) if dsName.startswith('file:') else source
+    overviews = topoUtils.writeOverviews(grd, 'ds:odd', str(tmp_path), factors=[2, 4])
+    direct = topoUtils.coarsenTopo(topoUtils.renameTopo(source, None), 8)
+    directMin = topoUtils.renameTopo(source, None)['depth'].coarsen(ny=8, nx=8, boundary='pad').min()
+    for overview in overviews:
+        topo = topoUtils.renameTopo(grd.openDataset(overview['url']), None)
+        coarse = topoUtils.coarsenTopo(topo, 8 // overview['factor'])
+        for var in ['depth', 'lon_centers', 'lat_centers']:
+            assert np.allclose(coarse[var].values, direct[var].values, rtol=1e-12, atol=1e-9, equal_nan=True)
+        assert np.array_equal(coarse['depth_min'].values, directMin.values, equal_nan=True)
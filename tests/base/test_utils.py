@@ -0,0 +1,33 @@
+# Test content hashing of variables
+import hashlib, zlib
+import numpy as np
+import xarray as xr
+import dask.array as da
+
+def test_hash_policy():
+    from gridtools import utils
+    values = np.random.default_rng(1).random((40, 30))
+    expected = hashlib.sha256(values).hexdigest()
+    # Streamed blocks, strided views and dask arrays reproduce the full array digest
+    assert utils.sha256sum(xr.DataArray(values)) == expected
+    assert utils.hashData(da.from_array(values, chunks=(7, 11)), chunkMb=0.001) == expected
+    assert utils.hashData(values[::2, 1::3]) == hashlib.sha256(np.array(values[::2, 1::3])).hexdigest()
+    assert utils.hashData(values, algorithm='crc32') == "%08x" % (zlib.crc32(values))
+
+    ds = xr.Dataset({'depth': (('ny','nx'), values)})
+    saved = utils.getHashPolicy()
+    try:
+        utils.setHashPolicy(algorithm='sha256', lazy=True)
+        utils.hashVariable(ds['depth'])
+        assert ds['depth'].attrs['sha256'] == utils.HASH_PENDING
+        utils.resolveHashes(ds)
+        assert ds['depth'].attrs['sha256'] == expected
+        # The attribute key records the algorithm
+        utils.setHashPolicy(algorithm='crc32', lazy=False)
+        utils.hashVariable(ds['depth'])
+        assert list(ds['depth'].attrs.keys()) == ['crc32']
+        utils.setHashPolicy(algorithm='none')
+        utils.hashVariable(ds['depth'])
+        assert len(ds['depth'].attrs) == 0
+    finally:
+        utils.setHashPolicy(**saved)